@@ -1,9 +1,65 @@
 // 云函数 - analyzeAudio
-// 音频分析：音准、节奏、力度
+// 音频分析：音准、节奏、力度（转发到 Python 后端 /api/analyze/audio）
 
 const cloud = require('wx-server-sdk');
+const http = require('http');
+const https = require('https');
+
 cloud.init({ env: cloud.DYNAMIC_CURRENT_ENV });
 
+// Python 后端地址，在云函数环境变量中配置
+const ANALYZE_SERVER_URL = process.env.ANALYZE_SERVER_URL || '';
+
+/**
+ * 以 multipart/form-data 上传音频到 Python 后端，返回解析后的 JSON
+ * @param {string} url
+ * @param {Buffer} audioBuffer
+ * @param {object} fields - 其余表单字段
+ * @returns {Promise<object>}
+ */
+function postAudio(url, audioBuffer, fields) {
+  const boundary = `----guzheng${Date.now().toString(16)}`;
+  const parts = Object.entries(fields).map(([name, value]) => Buffer.from(
+    `--${boundary}\r\nContent-Disposition: form-data; name="${name}"\r\n\r\n${value}\r\n`
+  ));
+  parts.push(Buffer.from(
+    `--${boundary}\r\nContent-Disposition: form-data; name="audio"; filename="audio"\r\n`
+    + 'Content-Type: application/octet-stream\r\n\r\n'
+  ));
+  parts.push(audioBuffer);
+  parts.push(Buffer.from(`\r\n--${boundary}--\r\n`));
+  const body = Buffer.concat(parts);
+
+  const client = url.startsWith('https:') ? https : http;
+  return new Promise((resolve, reject) => {
+    const req = client.request(url, {
+      method: 'POST',
+      headers: {
+        'Content-Type': `multipart/form-data; boundary=${boundary}`,
+        'Content-Length': body.length,
+      },
+    }, (res) => {
+      const chunks = [];
+      res.on('data', (chunk) => chunks.push(chunk));
+      res.on('end', () => {
+        const text = Buffer.concat(chunks).toString('utf8');
+        try {
+          const data = JSON.parse(text);
+          if (res.statusCode !== 200) {
+            reject(new Error(data.detail || `分析服务返回 ${res.statusCode}`));
+          } else {
+            resolve(data);
+          }
+        } catch (err) {
+          reject(new Error(`分析服务返回 ${res.statusCode}: ${text.slice(0, 200)}`));
+        }
+      });
+    });
+    req.on('error', reject);
+    req.end(body);
+  });
+}
+
 /**
  * 分析古筝演奏音频
  *
@@ -19,79 +75,34 @@ exports.main = async (event, context) => {
   const openid = wxContext.OPENID;
 
   try {
-    // 1. 从云存储下载音频文件
-    // const audioRes = await cloud.downloadFile({ fileID });
-    // const audioBuffer = audioRes.fileContent;
-
-    // 2. 音频预处理
-    // TODO: 降噪、归一化
-    // const processedAudio = await preprocessAudio(audioBuffer);
+    if (!ANALYZE_SERVER_URL) {
+      throw new Error('未配置 ANALYZE_SERVER_URL');
+    }
 
-    // 3. 音频特征提取
-    // TODO: 使用信号处理库提取:
-    //   - 基频 (F0) 检测 → 音准分析
-    //   - Onset detection → 节奏分析
-    //   - RMS energy → 力度分析
-    //   - 频谱分析 → 音色评估
-    // 可选工具:
-    //   a) Python + librosa (通过子进程调用)
-    //   b) 腾讯云音频分析 API
-    //   c) 自训练的音频分析模型
-    // const features = await extractAudioFeatures(processedAudio);
-
-    // 4. 如果有参考曲目，与标准音频对比
-    // if (songId) {
-    //   const referenceAudio = await loadReferenceAudio(songId);
-    //   const comparison = await compareWithReference(features, referenceAudio);
-    // }
+    // 1. 从云存储下载音频文件
+    const audioRes = await cloud.downloadFile({ fileID });
+    const audioBuffer = audioRes.fileContent;
 
-    // 5. 生成分析报告
-    const mockResult = {
-      success: true,
-      data: {
-        pitchAccuracy: 85,
-        rhythmAccuracy: 80,
-        dynamics: 68,
-        overallScore: 78,
-        issues: [
-          {
-            severity: 'warning',
-            title: '第3-5小节音准偏低',
-            description: '按音段落音高整体偏低约20音分',
-            suggestion: '加强左手按弦力度，搭配调音器练习',
-            startTime: 8.2,
-            endTime: 15.5,
-          },
-          {
-            severity: 'info',
-            title: '节奏整体稳定',
-            description: '快速段落有轻微赶拍',
-            suggestion: '搭配节拍器从慢速开始练习',
-            startTime: 22.0,
-            endTime: 30.0,
-          },
-        ],
-        // 逐秒的音准数据（用于绘制音准曲线图）
-        pitchCurve: [],
-        // 节拍对齐数据
-        beatAlignment: [],
-      },
-    };
+    // 2. 后端在内存中解码音频，分析音准、节奏、力度（有参考演奏时逐小节对比）
+    const result = await postAudio(`${ANALYZE_SERVER_URL}/api/analyze/audio`, audioBuffer, {
+      songId: songId || '',
+      duration: duration || 0,
+    });
 
-    // 6. 保存记录
+    // 3. 保存记录
     const db = cloud.database();
     await db.collection('practice_records').add({
       data: {
         openid,
         type: 'audio',
         songId: songId || null,
-        duration,
-        result: mockResult.data,
+        duration: result.data.duration || duration,
+        result: result.data,
         createdAt: new Date(),
       },
     });
 
-    return mockResult;
+    return result;
   } catch (err) {
     console.error('音频分析失败', err);
     return { success: false, error: err.message };
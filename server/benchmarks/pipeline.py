@@ -0,0 +1,291 @@
+"""
+分析流水线基准 - 合成拨弦音与 lavfi 测试视频上的各阶段耗时、峰值内存和精度检查
+
+每个阶段在独立的 spawn 子进程中运行，峰值内存互不影响；准备工作（读入音频、
+复制视频等）不计入耗时。
+
+用法（在 server 目录下）:
+    python -m benchmarks.pipeline [--durations 30 120 300] [--json out.json]
+    python -m benchmarks.pipeline --json new.json --compare old.json
+
+精度检查失败或与 --compare 基线相比变慢超过 --threshold 时退出码为 1
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from benchmarks.synth import melody, make_video, read_wav, write_wav
+from config import ANALYSIS_SR, FRAME_FPS, FRAME_MAX_SIDE, PITCH_MODE, HAND_DETECTOR_MODE
+from services.uploads import peak_rss_mb
+
+# 合成录音的采样率；分析阶段与线上一致，使用 ANALYSIS_SR
+SR = 44100
+TEMPO = 90
+
+# 降采样分析路径与 44.1kHz 路径的评分允许差异（分）
+SCORE_TOLERANCE = 5
+
+
+# ---- 各阶段：做准备工作，返回要计时的函数 ----
+
+def _read_analysis_audio(path: str) -> tuple[np.ndarray, int]:
+    """读入合成录音并重采样到 ANALYSIS_SR（线上由 ffmpeg 解码时完成，不计入耗时）"""
+    import librosa
+    y, sr = read_wav(path)
+    if sr != ANALYSIS_SR:
+        y = librosa.resample(y, orig_sr=sr, target_sr=ANALYSIS_SR)
+    return y, ANALYSIS_SR
+
+
+def _stage_audio_batch(paths: dict):
+    from services.audio_analyzer import analyze_audio
+    y, sr = _read_analysis_audio(paths["wav"])
+    return lambda: analyze_audio(y, sr)
+
+
+def _stage_audio_stream(paths: dict):
+    from config import AUDIO_BLOCK_SECONDS
+    from services.audio_stream import analyze_audio_stream
+    y, sr = _read_analysis_audio(paths["wav"])
+    block = int(AUDIO_BLOCK_SECONDS * sr)
+    return lambda: analyze_audio_stream((y[i:i + block] for i in range(0, len(y), block)), sr)
+
+
+def _stage_probe(paths: dict):
+    from services.video_processor import probe_video
+    return lambda: probe_video(paths["mp4"])
+
+
+def _stage_demux(paths: dict):
+    from services.video_processor import VideoDemuxer
+
+    def run():
+        with VideoDemuxer(paths["mp4"], sr=ANALYSIS_SR, fps=FRAME_FPS,
+                          max_side=FRAME_MAX_SIDE) as demuxer:
+            frames = sum(1 for _ in demuxer.iter_frames())
+            return {"frames": frames, "audioSeconds": len(demuxer.read_audio()) / ANALYSIS_SR}
+    return run
+
+
+def _stage_hands(paths: dict):
+    from services.hand_analyzer import analyze_hands, warm_up_detectors
+    from services.video_processor import VideoDemuxer
+    warm_up_detectors()
+
+    def run():
+        with VideoDemuxer(paths["mp4"], sr=ANALYSIS_SR, fps=FRAME_FPS,
+                          max_side=FRAME_MAX_SIDE) as demuxer:
+            result = analyze_hands(demuxer.iter_frames())
+            demuxer.read_audio()
+            return result
+    return run
+
+
+def _stage_pipeline(paths: dict):
+    from services.pipeline import init_worker, run_video_analysis
+    init_worker()
+    # run_video_analysis 结束时会删除任务目录，使用副本
+    task_dir = tempfile.mkdtemp(prefix="bench_task_")
+    shutil.copy(paths["mp4"], os.path.join(task_dir, "input.mp4"))
+    return lambda: run_video_analysis("bench", task_dir)
+
+
+STAGES = {
+    "analyze_audio": _stage_audio_batch,
+    "analyze_audio_stream": _stage_audio_stream,
+    "probe_video": _stage_probe,
+    "demux": _stage_demux,
+    "analyze_hands": _stage_hands,
+    "run_video_analysis": _stage_pipeline,
+}
+
+
+def _measure(stage: str, paths: dict) -> dict:
+    """在子进程中执行：准备 → 计时运行 → 峰值内存"""
+    run = STAGES[stage](paths)
+    baseline = peak_rss_mb()
+    start = time.perf_counter()
+    run()
+    seconds = time.perf_counter() - start
+    return {"seconds": seconds, "baselineRssMB": baseline, "peakRssMB": peak_rss_mb()}
+
+
+def run_stage(stage: str, paths: dict, duration: float) -> dict:
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as executor:
+        m = executor.submit(_measure, stage, paths).result()
+    return {
+        "stage": stage,
+        "duration": duration,
+        "seconds": round(m["seconds"], 3),
+        "realtimeFactor": round(duration / m["seconds"], 1) if m["seconds"] > 0 else None,
+        "baselineRssMB": round(m["baselineRssMB"], 1),
+        "peakRssMB": round(m["peakRssMB"], 1),
+    }
+
+
+# ---- 精度检查 ----
+
+def _check(name: str, measured: float, expected: float, tolerance: float) -> dict:
+    return {
+        "name": name,
+        "expected": expected,
+        "measured": round(float(measured), 3),
+        "tolerance": tolerance,
+        "passed": bool(abs(measured - expected) <= tolerance),
+    }
+
+
+def _onset_recall(beats: list, onsets: np.ndarray, tolerance: float = 0.05) -> float:
+    """合成起始点中被检测到（±tolerance 秒）的比例，只统计检测结果覆盖的时间范围"""
+    detected = np.array([b["time"] for b in beats])
+    if len(detected) == 0:
+        return 0.0
+    onsets = onsets[onsets <= detected[-1] + tolerance]
+    if len(onsets) == 0:
+        return 0.0
+    nearest = np.min(np.abs(onsets[:, None] - detected[None, :]), axis=1)
+    return float(np.mean(nearest <= tolerance))
+
+
+def accuracy_checks(duration: float = 30.0) -> list[dict]:
+    """
+    已知音高/速度的合成音频（按 ANALYSIS_SR 分析）：音分偏差、起始点召回率、速度；
+    ANALYSIS_SR 低于 44.1kHz 时另检查各项评分与 44.1kHz 路径的差异
+    """
+    import librosa
+    from services.audio_analyzer import analyze_audio
+    from services.audio_stream import analyze_audio_stream
+
+    sr = ANALYSIS_SR
+    checks = []
+    for detune in (0.0, 20.0):
+        y, onsets, _ = melody(duration, sr, tempo=TEMPO, detune_cents=detune)
+        for name, result in (
+            ("batch", analyze_audio(y, sr)),
+            ("stream", analyze_audio_stream(
+                (y[i:i + sr * 5] for i in range(0, len(y), sr * 5)), sr)),
+        ):
+            cents = [p["cents_off"] for p in result["pitchCurve"]]
+            checks.append(_check(f"{name}.cents@{detune:g}", np.median(cents) if cents else 50.0,
+                                 detune, 8.0))
+            if detune == 0.0:
+                beats = result["beatAlignment"]
+                checks.append(_check(f"{name}.onsetRecall", _onset_recall(beats, onsets), 1.0, 0.1))
+                intervals = np.diff([b["time"] for b in beats])
+                tempo = 60.0 / np.median(intervals) if len(intervals) else 0.0
+                checks.append(_check(f"{name}.tempo", tempo, float(TEMPO), TEMPO * 0.05))
+
+    if sr != SR:
+        # 同一段 44.1kHz 录音：直接分析 vs 重采样后分析（略微跑调，避免音准满分掩盖差异）
+        y, _, _ = melody(duration, SR, tempo=TEMPO, detune_cents=10.0)
+        full = analyze_audio(y, SR)
+        low = analyze_audio(librosa.resample(y, orig_sr=SR, target_sr=sr), sr)
+        for key in ("pitchAccuracy", "rhythmAccuracy", "dynamics", "overallScore"):
+            checks.append(_check(f"sr{sr}.{key}", low[key], full[key], SCORE_TOLERANCE))
+    return checks
+
+
+# ---- 输入生成与结果比较 ----
+
+def make_inputs(work_dir: str, duration: float) -> dict:
+    y, _, _ = melody(duration, SR, tempo=TEMPO)
+    wav = os.path.join(work_dir, f"melody_{duration:g}s.wav")
+    mp4 = os.path.join(work_dir, f"video_{duration:g}s.mp4")
+    write_wav(wav, y, SR)
+    make_video(mp4, wav, duration)
+    return {"wav": wav, "mp4": mp4}
+
+
+def compare(results: list[dict], baseline_path: str, threshold: float) -> list[dict]:
+    """与基线结果逐阶段比较，返回变慢超过阈值的条目"""
+    with open(baseline_path) as f:
+        baseline = {(r["stage"], r["duration"]): r for r in json.load(f)["results"]}
+
+    regressions = []
+    print(f"\n{'stage':<24}{'dur':>6}{'base s':>10}{'new s':>10}{'ratio':>8}")
+    for r in results:
+        base = baseline.get((r["stage"], r["duration"]))
+        if base is None or base["seconds"] <= 0:
+            continue
+        ratio = r["seconds"] / base["seconds"]
+        flag = "  !" if ratio > 1 + threshold else ""
+        print(f"{r['stage']:<24}{r['duration']:>6g}{base['seconds']:>10}{r['seconds']:>10}"
+              f"{ratio:>8.2f}{flag}")
+        if ratio > 1 + threshold:
+            regressions.append({**r, "baselineSeconds": base["seconds"], "ratio": round(ratio, 2)})
+    return regressions
+
+
+def _git_commit() -> str:
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                             capture_output=True, check=True, timeout=5)
+        return out.stdout.decode().strip()
+    except (OSError, subprocess.SubprocessError):
+        return ""
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--durations", type=float, nargs="+", default=[30, 120, 300])
+    parser.add_argument("--stages", nargs="+", choices=list(STAGES), default=list(STAGES))
+    parser.add_argument("--json", help="结果写入 JSON 文件")
+    parser.add_argument("--compare", help="与之前的 JSON 结果比较")
+    parser.add_argument("--threshold", type=float, default=0.2, help="判定变慢的相对阈值")
+    parser.add_argument("--skip-accuracy", action="store_true")
+    args = parser.parse_args()
+
+    results = []
+    work_dir = tempfile.mkdtemp(prefix="guzheng_bench_")
+    try:
+        for duration in args.durations:
+            paths = make_inputs(work_dir, duration)
+            for stage in args.stages:
+                r = run_stage(stage, paths, duration)
+                results.append(r)
+                print(f"{stage:<24}{duration:>6g}s {r['seconds']:>9}s "
+                      f"x{r['realtimeFactor']:<8} peak {r['peakRssMB']} MB")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    checks = [] if args.skip_accuracy else accuracy_checks()
+    for c in checks:
+        status = "ok" if c["passed"] else "FAIL"
+        print(f"[{status}] {c['name']}: {c['measured']} (期望 {c['expected']} ± {c['tolerance']})")
+
+    regressions = compare(results, args.compare, args.threshold) if args.compare else []
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({
+                "commit": _git_commit(),
+                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "cpus": os.cpu_count(),
+                "config": {"pitchMode": PITCH_MODE, "handMode": HAND_DETECTOR_MODE,
+                           "sampleRate": ANALYSIS_SR, "fps": FRAME_FPS,
+                           "frameMaxSide": FRAME_MAX_SIDE},
+                "results": results,
+                "checks": checks,
+                "regressions": regressions,
+            }, f, indent=2, ensure_ascii=False)
+
+    if regressions or not all(c["passed"] for c in checks):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+音高检测模式对比 - 合成拨弦音上的精度与速度
+
+用法（在 server 目录下）:
+    python -m benchmarks.pitch_modes [--sr 22050] [--json out.json]
+
+--sr 默认为配置的分析采样率 ANALYSIS_SR；快速模式内部再降采样到 FAST_SR
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+
+from benchmarks.synth import GUZHENG_STRINGS, melody, note_to_hz, pluck
+from config import ANALYSIS_SR
+from services.pitch_tracker import PITCH_MODES, track_pitch
+
+DETUNES = (0.0, 10.0, 25.0)
+
+
+def tone_accuracy(mode: str, sr: int) -> dict:
+    """
+    单音：每根弦在若干偏差下的音分误差和有声召回率
+
+    前 1 秒琴弦一直在发声，其中判为有声的帧占比即有声召回率
+    """
+    errors = []
+    recalls = []
+    for note in GUZHENG_STRINGS:
+        for detune in DETUNES:
+            freq = note_to_hz(note) * 2 ** (detune / 1200)
+            y = pluck(freq, 1.5, sr)
+            f0, voiced, _, _ = track_pitch(y, sr, mode=mode)
+            # 只看前 1 秒（尾音衰减后可能判为无声）
+            head = slice(0, max(1, len(f0) * 2 // 3))
+            f0_head, voiced_head = f0[head], voiced[head]
+            recalls.append(float(np.mean(voiced_head)))
+            if voiced_head.any():
+                cents = 1200 * np.log2(f0_head[voiced_head] / freq)
+                errors.append(float(np.median(np.abs(cents))))
+            else:
+                errors.append(float("nan"))
+    errors = np.array(errors)
+    return {
+        "medianCentsError": round(float(np.nanmedian(errors)), 2),
+        "p95CentsError": round(float(np.nanpercentile(errors, 95)), 2),
+        "missedTones": int(np.sum(np.isnan(errors))),
+        "voicingRecall": round(float(np.mean(recalls)), 3),
+    }
+
+
+def speed(mode: str, sr: int, duration: float) -> dict:
+    """长音频：处理耗时与实时倍率"""
+    y, _, _ = melody(duration, sr)
+    start = time.perf_counter()
+    track_pitch(y, sr, mode=mode)
+    seconds = time.perf_counter() - start
+    return {"seconds": round(seconds, 3), "realtimeFactor": round(duration / seconds, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sr", type=int, default=ANALYSIS_SR)
+    parser.add_argument("--duration", type=float, default=30.0)
+    parser.add_argument("--json", help="结果写入 JSON 文件")
+    args = parser.parse_args()
+
+    results = {}
+    for mode in PITCH_MODES:
+        # 预热（numba JIT 等）
+        track_pitch(pluck(440.0, 0.5, args.sr), args.sr, mode=mode)
+        results[mode] = {**tone_accuracy(mode, args.sr), **speed(mode, args.sr, args.duration)}
+
+    print(f"{'mode':<10}{'median¢':>10}{'p95¢':>10}{'missed':>8}{'recall':>8}{'x realtime':>12}")
+    for mode, r in results.items():
+        print(f"{mode:<10}{r['medianCentsError']:>10}{r['p95CentsError']:>10}"
+              f"{r['missedTones']:>8}{r['voicingRecall']:>8}{r['realtimeFactor']:>12}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"sr": args.sr, "duration": args.duration, "modes": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+合成测试数据 - 已知音高、速度的拨弦音，以及 ffmpeg lavfi 合成的测试视频
+"""
+import subprocess
+import wave
+
+import numpy as np
+
+# 21 弦古筝定弦（D 调五声音阶，D2-D6）
+GUZHENG_STRINGS = [
+    "D2", "E2", "F#2", "A2", "B2",
+    "D3", "E3", "F#3", "A3", "B3",
+    "D4", "E4", "F#4", "A4", "B4",
+    "D5", "E5", "F#5", "A5", "B5",
+    "D6",
+]
+
+
+def note_to_hz(note: str) -> float:
+    """音名转频率（不依赖 librosa，便于独立生成数据）"""
+    names = {"C": 0, "D": 2, "E": 4, "F": 5, "G": 7, "A": 9, "B": 11}
+    pitch_class = names[note[0]]
+    rest = note[1:]
+    if rest.startswith("#"):
+        pitch_class += 1
+        rest = rest[1:]
+    midi = 12 * (int(rest) + 1) + pitch_class
+    return 440.0 * 2 ** ((midi - 69) / 12)
+
+
+def pluck(freq: float, duration: float, sr: int, decay: float = 3.0,
+          harmonics: int = 8) -> np.ndarray:
+    """拨弦音：谐波幅度 1/k，高次谐波衰减更快"""
+    t = np.arange(int(duration * sr)) / sr
+    tone = np.zeros_like(t)
+    for k in range(1, harmonics + 1):
+        if k * freq >= sr / 2:
+            break
+        tone += np.sin(2 * np.pi * k * freq * t) * np.exp(-decay * np.sqrt(k) * t) / k
+    # 2ms 起音，避免咔哒声
+    attack = min(len(t), int(0.002 * sr))
+    tone[:attack] *= np.linspace(0, 1, attack)
+    return (0.5 * tone / max(1e-9, np.max(np.abs(tone)))).astype(np.float32)
+
+
+def melody(duration: float, sr: int, tempo: float = 90, detune_cents: float = 0.0,
+           seed: int = 0) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    按固定速度在古筝定弦上随机弹奏
+
+    返回:
+        (y, onset_times, freqs)
+    """
+    rng = np.random.default_rng(seed)
+    interval = 60.0 / tempo
+    n_notes = max(1, int(duration / interval))
+    y = np.zeros(int(duration * sr), dtype=np.float32)
+    onsets = np.arange(n_notes) * interval
+    freqs = np.array([
+        note_to_hz(GUZHENG_STRINGS[i]) * 2 ** (detune_cents / 1200)
+        for i in rng.integers(3, len(GUZHENG_STRINGS) - 3, size=n_notes)
+    ])
+    for onset, freq in zip(onsets, freqs):
+        start = int(onset * sr)
+        tone = pluck(freq, min(interval * 1.5, duration - onset), sr)
+        end = min(len(y), start + len(tone))
+        y[start:end] += tone[:end - start]
+    peak = np.max(np.abs(y))
+    if peak > 0:
+        y *= 0.8 / peak
+    return y, onsets, freqs
+
+
+def write_wav(path: str, y: np.ndarray, sr: int):
+    """写入 16bit 单声道 WAV"""
+    pcm = (np.clip(y, -1, 1) * 32767).astype("<i2")
+    with wave.open(path, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sr)
+        f.writeframes(pcm.tobytes())
+
+
+def read_wav(path: str) -> tuple[np.ndarray, int]:
+    """读取 write_wav 写出的 WAV，返回 (float32 PCM, 采样率)"""
+    with wave.open(path, "rb") as f:
+        sr = f.getframerate()
+        pcm = np.frombuffer(f.readframes(f.getnframes()), dtype="<i2")
+    return pcm.astype(np.float32) / 32768, sr
+
+
+def make_video(path: str, audio_path: str, duration: float, size: str = "640x360",
+               fps: int = 30):
+    """
+    用 ffmpeg lavfi 测试画面 + 给定音频合成 MP4（H.264 + AAC）
+
+    画面中没有手，手部检测只反映检测器本身的耗时
+    """
+    cmd = [
+        "ffmpeg", "-v", "error", "-y",
+        "-f", "lavfi", "-i", f"testsrc2=size={size}:rate={fps}:duration={duration}",
+        "-i", audio_path,
+        "-map", "0:v:0", "-map", "1:a:0",
+        "-c:v", "libx264", "-preset", "ultrafast", "-pix_fmt", "yuv420p",
+        "-c:a", "aac", "-b:a", "128k",
+        "-shortest",
+        path,
+    ]
+    subprocess.run(cmd, check=True, capture_output=True)
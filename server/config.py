@@ -0,0 +1,141 @@
+"""
+服务配置 - 通过环境变量覆盖默认值
+"""
+import os
+
+
+def _env_int(name: str, default: int) -> int:
+    value = os.environ.get(name)
+    if value is None or value.strip() == "":
+        return default
+    return int(value)
+
+
+def _env_float(name: str, default: float) -> float:
+    value = os.environ.get(name)
+    if value is None or value.strip() == "":
+        return default
+    return float(value)
+
+
+# 分析进程池大小（默认 CPU 核数）
+ANALYSIS_WORKERS = _env_int("GUZHENG_ANALYSIS_WORKERS", os.cpu_count() or 1)
+
+# 等待队列长度上限，超过后拒绝新任务
+ANALYSIS_QUEUE_SIZE = _env_int("GUZHENG_ANALYSIS_QUEUE_SIZE", 32)
+
+# 已完成任务结果的保留时间（秒）
+TASK_RESULT_TTL = _env_int("GUZHENG_TASK_RESULT_TTL", 1800)
+
+# 长轮询最长等待时间（秒）
+TASK_MAX_WAIT = _env_float("GUZHENG_TASK_MAX_WAIT", 60.0)
+
+# 音频分析采样率（Hz）：ffmpeg 解码时一次重采样到该采样率，STFT / 音高的帧长与帧移
+# 按比例缩放，时间分辨率与 44.1kHz 相同；音高上限 C7（约 2.1kHz），22.05kHz 已足够
+ANALYSIS_SR = _env_int("GUZHENG_ANALYSIS_SR", 22050)
+
+# 断点续传：未完成的上传超过该时间（秒）没有新分块则放弃并清理
+RESUMABLE_UPLOAD_TTL = _env_int("GUZHENG_RESUMABLE_UPLOAD_TTL", 3600)
+
+# 断点续传建议的分块大小（字节）
+RESUMABLE_CHUNK_SIZE = _env_int("GUZHENG_RESUMABLE_CHUNK_SIZE", 1024 * 1024)
+
+# 上传过程中提前开始音频分析：auto（容器可边收边解复用且有空闲分析进程时）/ off
+RESUMABLE_EARLY_AUDIO = os.environ.get("GUZHENG_RESUMABLE_EARLY_AUDIO", "auto")
+
+# 上传期间音频分析等待新数据的最长时间（秒）：超时后释放分析进程，finalize 时改为完整分析
+RESUMABLE_EARLY_AUDIO_STALL = _env_float("GUZHENG_RESUMABLE_EARLY_AUDIO_STALL", 30.0)
+
+# 抽帧帧率
+FRAME_FPS = _env_int("GUZHENG_FRAME_FPS", 2)
+
+# 上传文件大小上限（字节）
+UPLOAD_MAX_BYTES = _env_int("GUZHENG_UPLOAD_MAX_BYTES", 512 * 1024 * 1024)
+
+# 纯音频分析：上传大小上限（字节），整段读入内存解码
+AUDIO_MAX_BYTES = _env_int("GUZHENG_AUDIO_MAX_BYTES", 64 * 1024 * 1024)
+
+# 纯音频分析进程数：与视频分析分开，录音分析不排在长视频后面
+AUDIO_WORKERS = _env_int("GUZHENG_AUDIO_WORKERS", max(1, (os.cpu_count() or 1) // 4))
+
+# 纯音频分析的延迟预算（秒）：预计排队 + 分析耗时超过该值时返回 503，不再排队
+AUDIO_LATENCY_BUDGET = _env_float("GUZHENG_AUDIO_LATENCY_BUDGET", 20.0)
+
+# 每秒音频的分析耗时初始估计（秒），之后按实际完成的任务滑动更新
+AUDIO_SECONDS_PER_AUDIO_SECOND = _env_float("GUZHENG_AUDIO_SECONDS_PER_AUDIO_SECOND", 0.2)
+
+# 分析截止时间上限（秒，从上传完成起算，0 为不限）：超过后停止解码、跳过未开始的阶段，
+# 返回已完成部分并在结果中标注 "partial"；客户端可通过 deadline 参数要求更短的截止时间
+ANALYSIS_DEADLINE = _env_float("GUZHENG_ANALYSIS_DEADLINE", 300.0)
+
+# 上传落盘的分块大小（字节）
+UPLOAD_CHUNK_SIZE = _env_int("GUZHENG_UPLOAD_CHUNK_SIZE", 1024 * 1024)
+
+# 抽帧画面最长边（像素），解码时直接缩放
+FRAME_MAX_SIDE = _env_int("GUZHENG_FRAME_MAX_SIDE", 640)
+
+# 抽帧预读缓冲的帧数，手部分析较慢时 ffmpeg 可继续解码
+FRAME_PREFETCH = _env_int("GUZHENG_FRAME_PREFETCH", 64)
+
+# 音高检测模式：accurate（librosa.pyin）/ fast（降采样向量化 YIN）
+PITCH_MODE = os.environ.get("GUZHENG_PITCH_MODE", "accurate")
+
+# 手部检测模式：static（逐帧完整检测，默认）/ tracking（连续帧关键点跟踪，可选）
+# 抽帧间隔 0.5 秒或自适应抽帧时帧不连续，跟踪模式不一定适用，需要时显式开启
+HAND_DETECTOR_MODE = os.environ.get("GUZHENG_HAND_DETECTOR_MODE", "static")
+
+# 结果缓存：内存 LRU 条目数（0 关闭）
+RESULT_CACHE_SIZE = _env_int("GUZHENG_RESULT_CACHE_SIZE", 256)
+
+# 结果缓存磁盘目录（留空则只用内存层）
+RESULT_CACHE_DIR = os.environ.get("GUZHENG_RESULT_CACHE_DIR", "")
+
+# 结果缓存磁盘层总大小上限（字节）
+RESULT_CACHE_DISK_MAX_BYTES = _env_int("GUZHENG_RESULT_CACHE_DISK_MAX_BYTES", 256 * 1024 * 1024)
+
+# 结果缓存有效期（秒，0 表示不过期）
+RESULT_CACHE_TTL = _env_int("GUZHENG_RESULT_CACHE_TTL", 7 * 24 * 3600)
+
+# 分析结果存储（SQLite）路径，默认留空，不保存历史记录；
+# /api/history、/api/progress 直接信任请求里的 userId，只应在做了身份认证的网关之后开启
+RESULT_STORE_PATH = os.environ.get("GUZHENG_RESULT_STORE", "")
+
+# 参考演奏特征索引目录（services/reference.py 离线生成）
+REFERENCE_DIR = os.environ.get(
+    "GUZHENG_REFERENCE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "references")
+)
+
+# 参考对齐 DTW 的 Sakoe-Chiba 带宽（相对较短一方的帧数），只在带内计算代价
+REFERENCE_BAND_RADIUS = _env_float("GUZHENG_REFERENCE_BAND_RADIUS", 0.2)
+
+# 流式音频分析：auto（时长超过阈值时启用）/ on / off
+AUDIO_STREAMING = os.environ.get("GUZHENG_AUDIO_STREAMING", "auto")
+
+# auto 模式下启用流式分析的最短时长（秒）
+AUDIO_STREAMING_MIN_SECONDS = _env_float("GUZHENG_AUDIO_STREAMING_MIN_SECONDS", 600.0)
+
+# 流式分析每块音频的时长（秒）
+AUDIO_BLOCK_SECONDS = _env_float("GUZHENG_AUDIO_BLOCK_SECONDS", 5.0)
+
+# 实时练习 WebSocket 同时连接数上限
+PRACTICE_MAX_SESSIONS = _env_int("GUZHENG_PRACTICE_MAX_SESSIONS", 8)
+
+# 抽帧方式：fixed（按 FRAME_FPS 均匀抽帧）/ adaptive（按音符起始点与画面运动挑帧）
+FRAME_SAMPLING = os.environ.get("GUZHENG_FRAME_SAMPLING", "fixed")
+
+# 自适应抽帧每个视频最多分析的帧数
+FRAME_BUDGET = _env_int("GUZHENG_FRAME_BUDGET", 120)
+
+# 自适应抽帧的运动检测：灰度小图的帧率与最长边（像素）
+MOTION_FPS = _env_int("GUZHENG_MOTION_FPS", 4)
+MOTION_MAX_SIDE = _env_int("GUZHENG_MOTION_MAX_SIDE", 96)
+
+# 排队视频总时长上限（秒，0 不限制），按时长加权，长视频占用更多排队额度
+ANALYSIS_QUEUE_SECONDS = _env_float("GUZHENG_ANALYSIS_QUEUE_SECONDS", 3600.0)
+
+# 每秒视频的分析耗时初始估计（秒），之后按实际完成的任务滑动更新
+ANALYSIS_SECONDS_PER_VIDEO_SECOND = _env_float("GUZHENG_ANALYSIS_SECONDS_PER_VIDEO_SECOND", 1.0)
+
+# 批量分析：单次最多视频数、请求总大小上限（字节）
+BATCH_MAX_FILES = _env_int("GUZHENG_BATCH_MAX_FILES", 50)
+BATCH_MAX_BYTES = _env_int("GUZHENG_BATCH_MAX_BYTES", 4 * 1024 * 1024 * 1024)
@@ -1,19 +1,56 @@
 """
 古筝练习助手 - Python 后端服务
 """
+import asyncio
+import json
 import os
 import shutil
 import tempfile
 import logging
 import time
+import uuid
+import zipfile
 from contextlib import asynccontextmanager
+from typing import Optional
 
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException
+# 开始导入服务代码的时刻，用于统计冷启动耗时
+STARTED = time.perf_counter()
+
+from fastapi import (
+    FastAPI, UploadFile, File, Form, Header, HTTPException, Request, WebSocket, WebSocketDisconnect,
+)
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+from starlette.requests import ClientDisconnect
 
-from services.video_processor import extract_audio, extract_frames, get_video_duration
-from services.audio_analyzer import analyze_audio
-from services.hand_analyzer import analyze_hands
+from config import (
+    ANALYSIS_WORKERS, ANALYSIS_QUEUE_SIZE, TASK_RESULT_TTL, TASK_MAX_WAIT,
+    UPLOAD_MAX_BYTES, UPLOAD_CHUNK_SIZE,
+    RESULT_CACHE_SIZE, RESULT_CACHE_DIR, RESULT_CACHE_DISK_MAX_BYTES, RESULT_CACHE_TTL,
+    PRACTICE_MAX_SESSIONS, ANALYSIS_QUEUE_SECONDS, ANALYSIS_SECONDS_PER_VIDEO_SECOND,
+    BATCH_MAX_FILES, BATCH_MAX_BYTES, REFERENCE_DIR,
+    RESUMABLE_UPLOAD_TTL, RESUMABLE_CHUNK_SIZE, RESUMABLE_EARLY_AUDIO, RESULT_STORE_PATH,
+    ANALYSIS_SR, AUDIO_MAX_BYTES, AUDIO_WORKERS, AUDIO_LATENCY_BUDGET,
+    AUDIO_SECONDS_PER_AUDIO_SECOND, ANALYSIS_DEADLINE,
+)
+from services.cancel import CANCEL_MARKER, CancelToken, deadline_at
+from services.encoding import MSGPACK_MEDIA_TYPES, dumps_msgpack, encode_result, negotiate
+from services.pipeline import (
+    init_worker, run_video_analysis, run_prefix_audio, analysis_params, is_complete,
+    init_audio_worker, run_audio_analysis, audio_analysis_params,
+)
+from services.metrics import (
+    Counter, Gauge, Timings, hand_frame_seconds, registry, span, stage_seconds, use_timings,
+)
+from services.result_cache import ResultCache, make_cache_key
+from services.result_store import KINDS as RESULT_KINDS, ResultStore
+from services.resumable import UploadRegistry, UploadOffsetError, UPLOAD_DONE_MARKER
+from services.task_queue import TaskQueue, QueueFullError
+from services.uploads import (
+    save_upload, save_stream, read_upload, archive_videos, UploadTooLargeError,
+)
+from services.video_processor import probe_video, decode_audio, VideoProbeError, AudioDecodeError
+from services.warmup import Readiness, warm_up_practice
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -22,11 +59,71 @@ logger = logging.getLogger(__name__)
 UPLOAD_DIR = os.path.join(tempfile.gettempdir(), "guzheng_uploads")
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
+# 分析任务队列
+task_queue = TaskQueue(ANALYSIS_WORKERS, ANALYSIS_QUEUE_SIZE, TASK_RESULT_TTL,
+                       initializer=init_worker,
+                       max_queued_weight=ANALYSIS_QUEUE_SECONDS,
+                       seconds_per_weight=ANALYSIS_SECONDS_PER_VIDEO_SECOND)
+
+# 纯音频分析队列：独立的进程池和延迟预算，录音分析不排在长视频后面
+audio_queue = TaskQueue(AUDIO_WORKERS, ANALYSIS_QUEUE_SIZE, TASK_RESULT_TTL,
+                        initializer=init_audio_worker,
+                        seconds_per_weight=AUDIO_SECONDS_PER_AUDIO_SECOND)
+
+# 分析结果缓存（重复上传同一视频时直接返回）
+result_cache = ResultCache(RESULT_CACHE_SIZE, RESULT_CACHE_DIR, RESULT_CACHE_DISK_MAX_BYTES,
+                           RESULT_CACHE_TTL)
+
+# 分析结果存储（历史记录与进步趋势）
+result_store = ResultStore(RESULT_STORE_PATH) if RESULT_STORE_PATH else None
+
+# 进行中的断点续传上传
+uploads = UploadRegistry(RESUMABLE_UPLOAD_TTL)
+
+# 启动预热状态（重量级依赖在后台加载，不阻塞 /api/health）
+readiness = Readiness(STARTED)
+
+# /metrics 指标
+tasks_total = registry.register(Counter(
+    "guzheng_tasks_total", "已结束的分析任务数", "status"
+))
+registry.register(Gauge("guzheng_queue_depth", "等待分析的任务数", lambda: task_queue.depth))
+registry.register(Gauge("guzheng_tasks_running", "正在分析的任务数", lambda: task_queue.running))
+registry.register(Gauge("guzheng_analysis_workers", "分析进程数", lambda: task_queue.workers))
+registry.register(Gauge("guzheng_queue_video_seconds", "排队中的视频总时长（秒）",
+                        lambda: task_queue.queued_weight))
+registry.register(Gauge("guzheng_seconds_per_video_second", "每秒视频的平均分析耗时（秒）",
+                        lambda: task_queue.seconds_per_weight))
+registry.register(Gauge("guzheng_audio_queue_depth", "等待分析的纯音频任务数",
+                        lambda: audio_queue.depth))
+registry.register(Gauge("guzheng_audio_tasks_running", "正在分析的纯音频任务数",
+                        lambda: audio_queue.running))
+registry.register(Gauge("guzheng_ready", "预热是否完成（1 为就绪）",
+                        lambda: int(readiness.ready)))
+registry.register(Gauge("guzheng_cold_start_seconds", "从导入服务代码到预热完成的耗时（秒）",
+                        lambda: readiness.ready_seconds or 0))
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     logger.info("古筝分析服务启动")
+    await task_queue.start()
+    await audio_queue.start()
+    await uploads.start()
+    # 后台预热：拉起分析进程（各自加载 MediaPipe 检测器、编译音频分析的 numba 函数），
+    # 同时在服务进程中加载实时练习用到的 librosa；预热期间请求照常排队
+    readiness.start({
+        "workers": task_queue.prestart,
+        "audioWorkers": audio_queue.prestart,
+        "practice": lambda: asyncio.to_thread(warm_up_practice),
+    })
     yield
+    await readiness.stop()
+    await uploads.stop()
+    await task_queue.stop()
+    await audio_queue.stop()
+    if result_store is not None:
+        result_store.close()
     # 清理临时文件
     if os.path.exists(UPLOAD_DIR):
         shutil.rmtree(UPLOAD_DIR, ignore_errors=True)
@@ -43,115 +140,870 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# multipart 表单字段、边界等额外开销
+UPLOAD_FORM_OVERHEAD = 1024 * 1024
+
+VIDEO_CONTENT_TYPES = ("video/mp4", "video/quicktime", "video/x-msvideo", "video/webm")
+VIDEO_EXTENSIONS = (".mp4", ".mov", ".avi", ".webm", ".m4v")
+
+# 小程序上传未知扩展名时的通用类型
+GENERIC_CONTENT_TYPE = "application/octet-stream"
+
+# 批量提交等待排队额度时的最长重试间隔（秒）
+BATCH_RETRY_SECONDS = 5
+
+# 同步等待分析结果时检查客户端是否断开的间隔（秒）
+DISCONNECT_POLL_SECONDS = 1.0
+
+# 客户端已断开时的状态码（nginx 约定），响应实际不会送达
+CLIENT_CLOSED_REQUEST = 499
+
+# 内存中解码音频的超时（秒），有截止时间时不超过剩余时间
+AUDIO_DECODE_TIMEOUT = 60.0
+
+
+@app.middleware("http")
+async def limit_upload_size(request: Request, call_next):
+    """
+    根据 Content-Length 提前拒绝超大上传；分析队列已满时直接返回 503，
+    都不等请求体读完
+    """
+    content_length = request.headers.get("content-length")
+    max_bytes = {
+        "/api/analyze/batch": BATCH_MAX_BYTES,
+        "/api/analyze/audio": AUDIO_MAX_BYTES,
+    }.get(request.url.path, UPLOAD_MAX_BYTES)
+    if content_length and content_length.isdigit() \
+            and int(content_length) > max_bytes + UPLOAD_FORM_OVERHEAD:
+        return JSONResponse(
+            status_code=413,
+            content={"detail": f"文件超过 {max_bytes // (1024 * 1024)}MB 上限"},
+        )
+    if request.url.path == "/api/analyze/video" and task_queue.saturated:
+        return _busy_response(task_queue.retry_after())
+    if request.url.path == "/api/analyze/audio" and audio_queue.saturated:
+        return _busy_response(audio_queue.retry_after())
+    return await call_next(request)
+
+
+def _busy_response(retry_after: int) -> JSONResponse:
+    tasks_total.inc("rejected")
+    return JSONResponse(
+        status_code=503,
+        headers={"Retry-After": str(retry_after)},
+        content={"detail": f"服务繁忙，请 {retry_after} 秒后重试", "retryAfter": retry_after},
+    )
+
 
 @app.get("/api/health")
 async def health_check():
     return {"status": "ok", "service": "guzheng-analyzer"}
 
 
+@app.get("/api/ready")
+async def ready_check():
+    """
+    预热是否完成：就绪返回 200，预热中或预热失败返回 503
+
+    附带导入耗时、冷启动耗时（导入服务代码到就绪）和各预热步骤的状态与耗时
+    """
+    return JSONResponse(status_code=200 if readiness.ready else 503,
+                        content={"success": readiness.ready, "data": readiness.to_dict()})
+
+
 @app.post("/api/analyze/video")
 async def analyze_video(
+    request: Request,
     file: UploadFile = File(...),
     songId: str = Form(default=""),
+    userId: str = Form(default=""),
+    mode: str = Form(default="sync"),
+    callbackUrl: str = Form(default=""),
+    timings: bool = Form(default=False),
+    encoding: str = Form(default=""),
+    deadline: float = Form(default=0),
+    accept: str = Header(default=""),
 ):
     """
     接收视频文件，执行综合分析（音频 + 手型）
+
+    mode=sync  等待分析完成后返回结果（默认，兼容旧版小程序）
+    mode=async 立即返回 taskId，通过 /api/tasks/{taskId} 轮询结果，
+               或在完成后回调 callbackUrl
+    timings=true 结果中附带各阶段耗时 "timings"（秒）
+    userId 非空时结果写入历史记录（/api/history、/api/progress）
+    encoding=packed  音准曲线、节拍点、手部关键点以 base64 定长数组返回（见 services/encoding.py）
+    encoding=msgpack 同上，整个响应用 MessagePack 编码（也可用 Accept: application/msgpack）
+    deadline 分析截止时间（秒，从上传完成起算，不超过 GUZHENG_ANALYSIS_DEADLINE）：
+             超过后返回已完成的部分，结果中 "partial" 列出被跳过或截断的阶段
+    sync 模式下客户端断开连接时取消分析；async 模式可用 DELETE /api/tasks/{taskId} 取消
     """
     # 验证文件类型
-    allowed_types = ["video/mp4", "video/quicktime", "video/x-msvideo", "video/webm"]
-    if file.content_type and file.content_type not in allowed_types:
+    if file.content_type and file.content_type not in VIDEO_CONTENT_TYPES:
         raise HTTPException(400, f"不支持的文件类型: {file.content_type}")
+    _check_options(mode, callbackUrl)
+    encoding = _negotiate(encoding, accept)
 
     # 保存上传的视频
-    task_id = f"task_{int(time.time() * 1000)}"
+    task_id, task_dir = _new_task_dir()
+    video_path = os.path.join(task_dir, "input.mp4")
+    request_timings = Timings()
+    try:
+        with use_timings(request_timings), span("upload"):
+            stats = await save_upload(file, video_path, UPLOAD_MAX_BYTES, UPLOAD_CHUNK_SIZE)
+        logger.info(
+            f"[{task_id}] 视频已保存: {stats['size']} bytes, 耗时 {stats['seconds']}s, "
+            f"{stats['throughputMBps']} MB/s, 复制期间内存增长 {stats['rssGrowthMB']} MB"
+        )
+        task = await _submit_video(task_id, task_dir, stats["sha256"], songId, request_timings,
+                                   callback_url=callbackUrl, user_id=userId,
+                                   deadline=deadline)
+    except UploadTooLargeError as e:
+        shutil.rmtree(task_dir, ignore_errors=True)
+        raise HTTPException(413, str(e))
+    except QueueFullError as e:
+        shutil.rmtree(task_dir, ignore_errors=True)
+        logger.warning(f"[{task_id}] 拒绝任务: {e}")
+        return _busy_response(e.retry_after)
+    except VideoProbeError as e:
+        shutil.rmtree(task_dir, ignore_errors=True)
+        raise HTTPException(400, f"无法解析视频: {e}")
+    except Exception as e:
+        shutil.rmtree(task_dir, ignore_errors=True)
+        logger.error(f"[{task_id}] 提交分析失败: {e}")
+        raise HTTPException(500, f"分析失败: {str(e)}")
+
+    return await _task_response(task, mode, timings, encoding, request)
+
+
+@app.post("/api/analyze/audio")
+async def analyze_audio_file(
+    request: Request,
+    audio: UploadFile = File(...),
+    songId: str = Form(default=""),
+    userId: str = Form(default=""),
+    duration: float = Form(default=0),
+    timings: bool = Form(default=False),
+    encoding: str = Form(default=""),
+    deadline: float = Form(default=0),
+    accept: str = Header(default=""),
+):
+    """
+    纯音频分析（录音模式）：只评音准、节奏、力度
+
+    接收压缩音频（AAC / M4A / MP3 等），整段读入内存由 ffmpeg 解码为 PCM 后分析，
+    不探测视频、不抽帧、不做手部分析。由独立的音频分析进程执行，预计排队 + 分析耗时
+    超过 GUZHENG_AUDIO_LATENCY_BUDGET 时立即返回 503 + Retry-After。
+    duration 为客户端记录的时长，仅作兼容保留，以解码结果为准；
+    timings / encoding / userId / deadline 同 /api/analyze/video，客户端断开时取消分析
+    """
+    content_type = audio.content_type or ""
+    if content_type and not content_type.startswith("audio/") \
+            and content_type != GENERIC_CONTENT_TYPE:
+        raise HTTPException(400, f"不支持的文件类型: {content_type}")
+    encoding = _negotiate(encoding, accept)
+
+    task_id = f"audio_{int(time.time() * 1000)}_{uuid.uuid4().hex[:8]}"
+    request_timings = Timings()
+    with use_timings(request_timings):
+        try:
+            with span("upload"):
+                data, sha256 = await read_upload(audio, AUDIO_MAX_BYTES, UPLOAD_CHUNK_SIZE)
+            cancel = _cancel_token(task_id, deadline)
+            cache_key = make_cache_key(sha256, **audio_analysis_params(songId))
+            with span("cache.lookup"):
+                cached = await asyncio.to_thread(result_cache.get, cache_key)
+            if cached is None:
+                if cancel.expired:
+                    raise HTTPException(504, "分析已取消: 超过截止时间，未开始分析")
+                samples = await asyncio.to_thread(decode_audio, data, ANALYSIS_SR,
+                                                  cancel.remaining(AUDIO_DECODE_TIMEOUT))
+        except UploadTooLargeError as e:
+            raise HTTPException(413, str(e))
+        except AudioDecodeError as e:
+            if cancel.expired:
+                # 截止时间到达导致解码超时，不是音频本身的问题
+                raise HTTPException(504, "分析已取消: 超过截止时间，未完成解码")
+            raise HTTPException(400, f"无法解码音频: {e}")
+
+    if cached is not None:
+        logger.info(f"[{task_id}] 命中结果缓存")
+        task = audio_queue.add_finished(task_id, {**cached, "taskId": task_id, "cached": True},
+                                        timings=request_timings.to_dict())
+        _observe(task)
+        if userId:
+            asyncio.create_task(_store_result(task, userId, songId, sha256, kind="audio"))
+    else:
+        seconds = len(samples) / ANALYSIS_SR
+        # 延迟预算：有任务在排队或进程全忙、且预计耗时超出预算时拒绝，空闲时总是接受
+        busy = audio_queue.depth > 0 or audio_queue.running >= audio_queue.workers
+        if busy and audio_queue.estimate_wait(seconds) > AUDIO_LATENCY_BUDGET:
+            logger.warning(f"[{task_id}] 超出音频分析延迟预算，拒绝任务")
+            return _busy_response(audio_queue.retry_after())
+        try:
+            task = audio_queue.submit(task_id, run_audio_analysis, task_id, samples, songId,
+                                      cancel, timings=request_timings.to_dict(), weight=seconds)
+        except QueueFullError as e:
+            logger.warning(f"[{task_id}] 拒绝任务: {e}")
+            return _busy_response(e.retry_after)
+        asyncio.create_task(_on_task_done(task, cache_key, userId, songId, sha256,
+                                          kind="audio"))
+
+    return await _task_response(task, "sync", timings, encoding, request, audio_queue)
+
+
+def _check_options(mode: str, callback_url: str):
+    if mode not in ("sync", "async"):
+        raise HTTPException(400, f"不支持的分析模式: {mode}")
+    if callback_url and not callback_url.startswith(("http://", "https://")):
+        raise HTTPException(400, "callbackUrl 必须是 http(s) 地址")
+
+
+async def _task_response(task, mode: str, timings: bool, encoding: str, request: Request,
+                         queue: TaskQueue = task_queue) -> Response:
+    """
+    async 模式立即返回任务状态（202），sync 模式等待分析完成后返回结果；
+    sync 模式下客户端中途断开时取消分析，不再占用分析进程
+    """
+    if mode == "async":
+        data = _encode_task(task.to_dict(timings), encoding)
+        if not task.finished:
+            data["estimatedSeconds"] = round(queue.estimate_wait(), 1)
+        return _respond({"success": True, "data": data}, encoding, status_code=202)
+
+    if not await _wait_for_client(task, request):
+        _cancel_task(task, queue)
+        logger.info(f"[{task.task_id}] 客户端已断开，取消分析")
+        return Response(status_code=CLIENT_CLOSED_REQUEST)
+    if task.status == "cancelled":
+        raise HTTPException(504, f"分析已取消: {task.error}")
+    if task.status != "done":
+        raise HTTPException(500, f"分析失败: {task.error}")
+
+    result = encode_result(task.to_dict(timings)["result"], encoding)
+    return _respond({"success": True, "data": result}, encoding)
+
+
+def _negotiate(encoding: str, accept: str) -> str:
+    try:
+        return negotiate(encoding, accept)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+
+
+def _encode_task(data: dict, encoding: str) -> dict:
+    """任务状态中的 result 按响应编码打包"""
+    if data.get("result") is not None:
+        data = {**data, "result": encode_result(data["result"], encoding)}
+    return data
+
+
+def _respond(content: dict, encoding: str, status_code: int = 200) -> Response:
+    if encoding == "msgpack":
+        return Response(dumps_msgpack(content), status_code=status_code,
+                        media_type=MSGPACK_MEDIA_TYPES[0])
+    return JSONResponse(status_code=status_code, content=content)
+
+
+async def _wait_for_client(task, request: Request) -> bool:
+    """等待任务完成，期间定时检查客户端连接；客户端先断开时返回 False"""
+    while not task.finished:
+        try:
+            await asyncio.wait_for(task.done.wait(), DISCONNECT_POLL_SECONDS)
+        except asyncio.TimeoutError:
+            if await request.is_disconnected():
+                return False
+    return True
+
+
+def _cancel_token(task_id: str, deadline: float = 0) -> CancelToken:
+    """任务的取消标记与截止时间：客户端要求的 deadline 不超过 ANALYSIS_DEADLINE"""
+    limits = [seconds for seconds in (deadline, ANALYSIS_DEADLINE) if seconds > 0]
+    return CancelToken(_cancel_path(task_id), deadline_at(min(limits)) if limits else None)
+
+
+def _cancel_path(task_id: str) -> str:
+    # 放在任务目录之外：分析进程清理任务目录后标记仍然有效
+    return os.path.join(UPLOAD_DIR, f"{task_id}.{CANCEL_MARKER}")
+
+
+def _cancel_task(task, queue: TaskQueue = task_queue):
+    """取消任务：排队中的直接移出队列，分析中的写入取消标记，由分析进程尽快停止"""
+    if task.finished or queue.cancel(task.task_id):
+        return
+    try:
+        open(_cancel_path(task.task_id), "w").close()
+    except OSError as e:
+        logger.warning(f"[{task.task_id}] 写入取消标记失败: {e}")
+
+
+def _new_task_dir() -> tuple[str, str]:
+    task_id = f"task_{int(time.time() * 1000)}_{uuid.uuid4().hex[:8]}"
     task_dir = os.path.join(UPLOAD_DIR, task_id)
     os.makedirs(task_dir, exist_ok=True)
+    return task_id, task_dir
 
-    video_path = os.path.join(task_dir, "input.mp4")
+
+async def _submit_video(task_id: str, task_dir: str, sha256: str, song_id: str,
+                        request_timings: Timings, callback_url: str = "",
+                        audio_result: dict = None, user_id: str = "", deadline: float = 0):
+    """
+    已保存到 task_dir/input.mp4 的视频：命中结果缓存则直接登记完成，
+    否则探测时长并按时长加权提交到分析队列；
+    audio_result 为上传过程中已完成的音频分析，分析进程只需再做手部分析；
+    user_id 非空时分析完成后写入结果存储；deadline 为客户端要求的分析截止时间（秒）
+    """
+    with use_timings(request_timings):
+        cache_key = make_cache_key(sha256, **analysis_params(song_id))
+        with span("cache.lookup"):
+            cached = await asyncio.to_thread(result_cache.get, cache_key)
+
+        if cached is not None:
+            logger.info(f"[{task_id}] 命中结果缓存")
+            shutil.rmtree(task_dir, ignore_errors=True)
+            task = task_queue.add_finished(task_id, {**cached, "taskId": task_id, "cached": True},
+                                           callback_url=callback_url,
+                                           timings=request_timings.to_dict())
+            _observe(task)
+            if user_id:
+                asyncio.create_task(_store_result(task, user_id, song_id, sha256))
+            return task
+
+        # 按视频时长加权准入：长视频占用更多排队额度
+        with span("ffprobe"):
+            info = await asyncio.to_thread(probe_video, os.path.join(task_dir, "input.mp4"))
+
+    weight = max(1.0, info["duration"])
+    cancel = _cancel_token(task_id, deadline)
+    # 任务目录交由分析进程处理并清理
+    task = task_queue.submit(task_id, run_video_analysis, task_id, task_dir, song_id, info,
+                             audio_result, cancel, callback_url=callback_url,
+                             timings=request_timings.to_dict(), weight=weight)
+    asyncio.create_task(_on_task_done(task, cache_key, user_id, song_id, sha256))
+    return task
+
+
+@app.post("/api/uploads")
+async def create_upload(size: int = Form(...), songId: str = Form(default=""),
+                        userId: str = Form(default="")):
+    """
+    开始断点续传上传（弱网下的长视频），返回 uploadId 与建议的分块大小
+
+    之后依次 PUT /api/uploads/{uploadId}?offset=N 上传分块（请求体为原始字节）；
+    断线后 GET /api/uploads/{uploadId} 取得已收到的字节数从该处继续；
+    收齐后 POST /api/uploads/{uploadId}/finalize 提交分析。
+    容器可边收边解复用（WebM、moov 在前的 MP4）且有空闲分析进程时，
+    上传过程中就开始音频分析
+    """
+    if size <= 0:
+        raise HTTPException(400, "文件大小无效")
+    if size > UPLOAD_MAX_BYTES:
+        raise HTTPException(413, f"文件超过 {UPLOAD_MAX_BYTES // (1024 * 1024)}MB 上限")
+    upload_id, task_dir = _new_task_dir()
+    session = uploads.create(upload_id, task_dir, size, songId, userId)
+    logger.info(f"[{upload_id}] 开始断点续传上传: {size} bytes")
+    return {"success": True, "data": {**session.to_dict(), "chunkSize": RESUMABLE_CHUNK_SIZE}}
+
+
+@app.put("/api/uploads/{uploadId}")
+async def append_upload(uploadId: str, offset: int, request: Request):
+    """追加一个分块；offset 与已收到的字节数不一致时返回 409 和正确的 offset"""
+    session = _get_upload(uploadId)
     try:
-        with open(video_path, "wb") as f:
-            content = await file.read()
-            f.write(content)
+        await session.append(offset, request.stream())
+    except UploadOffsetError as e:
+        return JSONResponse(status_code=409, content={"detail": str(e), "offset": e.offset})
+    except UploadTooLargeError as e:
+        raise HTTPException(413, str(e))
+    except ClientDisconnect:
+        # 已写入的部分保留，客户端重连后按 offset 续传
+        logger.info(f"[{uploadId}] 分块传输中断, 已收到 {session.offset} bytes")
+        return Response(status_code=400)
 
-        logger.info(f"[{task_id}] 视频已保存: {len(content)} bytes")
+    _maybe_start_early_audio(session)
+    return {"success": True, "data": session.to_dict()}
 
-        # 获取视频时长
-        duration = get_video_duration(video_path)
-        logger.info(f"[{task_id}] 视频时长: {duration:.1f}s")
 
-        # 1. 提取音频
-        audio_path = os.path.join(task_dir, "audio.wav")
-        extract_audio(video_path, audio_path)
+@app.get("/api/uploads/{uploadId}")
+async def get_upload(uploadId: str):
+    """查询已收到的字节数（断线续传）"""
+    return {"success": True, "data": _get_upload(uploadId).to_dict()}
+
+
+@app.delete("/api/uploads/{uploadId}")
+async def cancel_upload(uploadId: str):
+    """放弃上传并清理已收到的数据"""
+    _get_upload(uploadId)
+    uploads.discard(uploadId)
+    return {"success": True}
+
+
+@app.post("/api/uploads/{uploadId}/finalize")
+async def finalize_upload(
+    request: Request,
+    uploadId: str,
+    mode: str = Form(default="sync"),
+    callbackUrl: str = Form(default=""),
+    timings: bool = Form(default=False),
+    encoding: str = Form(default=""),
+    deadline: float = Form(default=0),
+    accept: str = Header(default=""),
+):
+    """
+    收齐全部分块后提交分析，参数与返回格式同 /api/analyze/video，taskId 即 uploadId
+
+    分析队列已满时返回 503，已上传的数据保留，稍后重试 finalize 即可
+    """
+    session = _get_upload(uploadId)
+    _check_options(mode, callbackUrl)
+    encoding = _negotiate(encoding, accept)
+    if not session.complete:
+        return JSONResponse(status_code=409, content={
+            "detail": f"上传未完成: {session.offset}/{session.size} bytes", "offset": session.offset,
+        })
 
-        # 2. 抽帧
-        frames_dir = os.path.join(task_dir, "frames")
-        frames = extract_frames(video_path, frames_dir, fps=2)
+    request_timings = Timings()
+    async with session.lock:
+        if uploads.get(uploadId) is not session:
+            raise HTTPException(404, f"上传不存在或已提交: {uploadId}")
+        # 通知上传期间的音频分析：数据已收齐
+        session.mark(UPLOAD_DONE_MARKER)
+        audio_result = None
+        if session.early_task is not None:
+            with use_timings(request_timings), span("upload.audio"):
+                await session.early_task.done.wait()
+            audio_result = _early_audio_result(session.early_task, request_timings)
 
-        # 3. 音频分析
-        audio_result = {}
         try:
-            audio_result = analyze_audio(audio_path)
-            logger.info(f"[{task_id}] 音频分析完成: 综合 {audio_result.get('overallScore', 0)} 分")
+            task = await _submit_video(uploadId, session.task_dir, session.sha256,
+                                       session.song_id, request_timings,
+                                       callback_url=callbackUrl, audio_result=audio_result,
+                                       user_id=session.user_id, deadline=deadline)
+        except QueueFullError as e:
+            logger.warning(f"[{uploadId}] 拒绝任务: {e}")
+            return _busy_response(e.retry_after)
+        except VideoProbeError as e:
+            uploads.discard(uploadId)
+            raise HTTPException(400, f"无法解析视频: {e}")
         except Exception as e:
-            logger.error(f"[{task_id}] 音频分析失败: {e}")
-            audio_result = {
-                "pitchAccuracy": 0, "rhythmAccuracy": 0, "dynamics": 0,
-                "overallScore": 0, "pitchCurve": [], "beatAlignment": [],
-                "issues": [{"severity": "error", "title": "音频分析失败",
-                           "description": str(e), "suggestion": "请重新录制"}]
-            }
-
-        # 4. 手部分析
-        hand_result = {}
+            uploads.discard(uploadId)
+            logger.error(f"[{uploadId}] 提交分析失败: {e}")
+            raise HTTPException(500, f"分析失败: {str(e)}")
+        # 任务目录交由分析任务处理
+        uploads.pop(uploadId)
+
+    return await _task_response(task, mode, timings, encoding, request)
+
+
+def _get_upload(upload_id: str):
+    session = uploads.get(upload_id)
+    if session is None:
+        raise HTTPException(404, f"上传不存在或已过期: {upload_id}")
+    return session
+
+
+def _maybe_start_early_audio(session):
+    """
+    容器可边收边解复用、曲目没有参考演奏（流式分析不做参考对比）、
+    且有空闲分析进程时，在上传过程中开始音频分析
+    """
+    if RESUMABLE_EARLY_AUDIO != "auto" or session.early_task is not None:
+        return
+    if not session.streamable or session.complete:
+        return
+    if session.song_id and os.path.exists(
+            os.path.join(REFERENCE_DIR, session.song_id, "meta.json")):
+        return
+    if task_queue.depth > 0 or task_queue.running >= task_queue.workers:
+        return
+    try:
+        # 等待数据期间占用一个分析进程：权重为 0，不计入排队额度和耗时滑动平均，
+        # 但估算等待时间时扣除该进程
+        session.early_task = task_queue.submit(f"{session.upload_id}_audio", run_prefix_audio,
+                                               session.upload_id, session.task_dir, weight=0,
+                                               reserve=True)
+    except QueueFullError:
+        return
+    logger.info(f"[{session.upload_id}] 上传过程中开始音频分析 ({session.offset}/{session.size})")
+
+
+def _early_audio_result(task, request_timings: Timings) -> Optional[dict]:
+    """上传期间音频分析的结果；失败时返回 None，由完整分析重新处理音频"""
+    if task.status != "done":
+        logger.warning(f"[{task.task_id}] 上传期间音频分析失败，改为完整分析: {task.error}")
+        return None
+    result = dict(task.result)
+    request_timings.update(result.pop("timings", {}))
+    return result
+
+
+@app.post("/api/analyze/batch")
+async def analyze_batch(
+    files: list[UploadFile] = File(default=[]),
+    archive: Optional[UploadFile] = File(default=None),
+    songId: str = Form(default=""),
+    encoding: str = Form(default=""),
+):
+    """
+    批量分析（教师批改一个班的录音）
+
+    接收多个视频文件（files），或一个包含视频的 zip 压缩包（archive）。
+    全部视频分摊到分析进程池并行执行（各进程常驻预热的检测器），
+    按完成先后以 NDJSON 逐行返回：
+        {"index": 0, "filename": "...", "taskId": "...", "success": true, "data": {...}}
+        ...
+        {"summary": {"videos": n, "succeeded": k, "seconds": t, "videosPerMinute": v}}
+    排队额度不足时等待已提交的视频完成后再继续提交，不会中途拒绝；
+    encoding=packed 时每行的 data 按紧凑格式打包（NDJSON 不支持 msgpack）
+    """
+    if not files and archive is None:
+        raise HTTPException(400, "请上传视频文件或 zip 压缩包")
+    if encoding not in ("", "json", "packed"):
+        raise HTTPException(400, f"批量分析不支持的响应编码: {encoding}")
+    if len(files) > BATCH_MAX_FILES:
+        raise HTTPException(400, f"单次最多 {BATCH_MAX_FILES} 个视频")
+
+    started = time.perf_counter()
+    items = []      # (文件名, task_id, task_dir, sha256)
+    try:
+        for file in files:
+            if file.content_type and file.content_type not in VIDEO_CONTENT_TYPES:
+                raise HTTPException(400, f"不支持的文件类型: {file.filename} ({file.content_type})")
+            task_id, task_dir = _new_task_dir()
+            items.append((file.filename, task_id, task_dir, None))
+            stats = await save_upload(file, os.path.join(task_dir, "input.mp4"),
+                                      UPLOAD_MAX_BYTES, UPLOAD_CHUNK_SIZE)
+            items[-1] = (file.filename, task_id, task_dir, stats["sha256"])
+        if archive is not None:
+            items.extend(await _extract_archive(archive))
+        if len(items) > BATCH_MAX_FILES:
+            raise HTTPException(400, f"单次最多 {BATCH_MAX_FILES} 个视频")
+    except UploadTooLargeError as e:
+        _cleanup(items)
+        raise HTTPException(413, str(e))
+    except Exception:
+        _cleanup(items)
+        raise
+
+    logger.info(f"批量分析: {len(items)} 个视频")
+    return StreamingResponse(_batch_results(items, songId, started, encoding or "json"),
+                             media_type="application/x-ndjson")
+
+
+async def _extract_archive(archive: UploadFile) -> list[tuple]:
+    """保存 zip 压缩包并把其中每个视频解压到各自的任务目录"""
+    archive_dir = tempfile.mkdtemp(dir=UPLOAD_DIR)
+    archive_path = os.path.join(archive_dir, "archive.zip")
+    items = []
+    try:
+        await save_upload(archive, archive_path, BATCH_MAX_BYTES, UPLOAD_CHUNK_SIZE)
         try:
-            hand_result = analyze_hands(frames)
-            logger.info(f"[{task_id}] 手部分析完成: {hand_result.get('overallScore', 0)} 分")
-        except Exception as e:
-            logger.error(f"[{task_id}] 手部分析失败: {e}")
-            hand_result = {
-                "handDetected": False, "frameCount": 0, "detectedFrames": 0,
-                "overallScore": 0, "issues": [{"severity": "error", "title": "手部分析失败",
-                                                "description": str(e), "suggestion": "请重新录制"}],
-                "handPoints": []
-            }
-
-        # 5. 合并结果
-        all_issues = audio_result.get("issues", []) + hand_result.get("issues", [])
-
-        # 综合评分：音频 60% + 手型 40%
-        overall = int(
-            audio_result.get("overallScore", 0) * 0.6 +
-            hand_result.get("overallScore", 0) * 0.4
-        )
+            members = await asyncio.to_thread(archive_videos, archive_path, VIDEO_EXTENSIONS)
+        except zipfile.BadZipFile:
+            raise HTTPException(400, "压缩包格式错误，仅支持 zip")
 
-        result = {
-            "success": True,
-            "data": {
-                "taskId": task_id,
-                "duration": round(duration, 1),
-                "overallScore": overall,
-                "pitchAccuracy": audio_result.get("pitchAccuracy", 0),
-                "rhythmAccuracy": audio_result.get("rhythmAccuracy", 0),
-                "dynamics": audio_result.get("dynamics", 0),
-                "handScore": hand_result.get("overallScore", 0),
-                "handDetected": hand_result.get("handDetected", False),
-                "pitchCurve": audio_result.get("pitchCurve", []),
-                "beatAlignment": audio_result.get("beatAlignment", []),
-                "handPoints": hand_result.get("handPoints", []),
-                "issues": all_issues,
-            }
-        }
-
-        return result
-
-    except HTTPException:
+        with zipfile.ZipFile(archive_path) as zf:
+            for member in members[:BATCH_MAX_FILES + 1]:
+                task_id, task_dir = _new_task_dir()
+                items.append((member.filename, task_id, task_dir, None))
+                with zf.open(member) as stream:
+                    # 按实际解压字节数限制大小，不信任压缩包记录的文件大小
+                    stats = await asyncio.to_thread(
+                        save_stream, stream, os.path.join(task_dir, "input.mp4"),
+                        UPLOAD_MAX_BYTES, UPLOAD_CHUNK_SIZE
+                    )
+                items[-1] = (member.filename, task_id, task_dir, stats["sha256"])
+        return items
+    except Exception:
+        _cleanup(items)
         raise
+    finally:
+        shutil.rmtree(archive_dir, ignore_errors=True)
+
+
+async def _batch_results(items: list[tuple], song_id: str, started: float, encoding: str):
+    """逐个提交，任一视频完成即输出一行 NDJSON"""
+    waiting = {}        # asyncio.Task(task.done.wait) -> (index, 文件名, Task)
+    succeeded = 0
+
+    def line(data: dict) -> bytes:
+        return (json.dumps(data, ensure_ascii=False) + "\n").encode("utf-8")
+
+    def finished_line(index: int, filename: str, task) -> bytes:
+        if task.status == "done":
+            data = encode_result(task.to_dict()["result"], encoding)
+            return line({"index": index, "filename": filename, "taskId": task.task_id,
+                         "success": True, "data": data})
+        return line({"index": index, "filename": filename, "taskId": task.task_id,
+                     "success": False, "error": task.error})
+
+    async def next_finished():
+        done, _ = await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+        for waiter in done:
+            yield waiting.pop(waiter)
+
+    submitted = 0
+    try:
+        for index, (filename, task_id, task_dir, sha256) in enumerate(items):
+            while True:
+                try:
+                    task = await _submit_video(task_id, task_dir, sha256, song_id, Timings())
+                    waiting[asyncio.create_task(task.done.wait())] = (index, filename, task)
+                    break
+                except QueueFullError as e:
+                    # 排队额度不足：先等本批已提交的视频完成一个
+                    if waiting:
+                        async for i, name, finished in next_finished():
+                            succeeded += finished.status == "done"
+                            yield finished_line(i, name, finished)
+                    else:
+                        await asyncio.sleep(min(e.retry_after, BATCH_RETRY_SECONDS))
+                except Exception as e:
+                    shutil.rmtree(task_dir, ignore_errors=True)
+                    error = f"无法解析视频: {e}" if isinstance(e, VideoProbeError) else str(e)
+                    yield line({"index": index, "filename": filename, "taskId": task_id,
+                                "success": False, "error": error})
+                    break
+            submitted = index + 1
+
+        while waiting:
+            async for i, name, finished in next_finished():
+                succeeded += finished.status == "done"
+                yield finished_line(i, name, finished)
+    finally:
+        # 客户端中途断开时清理尚未提交的视频，并取消已提交但尚未完成的分析
+        _cleanup(items[submitted:])
+        for waiter, (_, _, task) in waiting.items():
+            waiter.cancel()
+            _cancel_task(task)
+
+    seconds = time.perf_counter() - started
+    yield line({"summary": {
+        "videos": len(items),
+        "succeeded": succeeded,
+        "seconds": round(seconds, 1),
+        "videosPerMinute": round(len(items) / seconds * 60, 2) if seconds > 0 else 0.0,
+    }})
+
+
+def _cleanup(items: list[tuple]):
+    for item in items:
+        shutil.rmtree(item[2], ignore_errors=True)
+
+
+async def _on_task_done(task, cache_key: str, user_id: str = "", song_id: str = "",
+                        sha256: str = "", kind: str = "video"):
+    """
+    任务完成后记录阶段耗时指标，并写入结果缓存（分支降级的结果不缓存）；
+    指定了用户时写入结果存储，kind 区分视频分析和纯音频分析
+    """
+    await task.done.wait()
+    _remove_cancel_marker(task.task_id)
+    _observe(task)
+    if task.status == "done" and is_complete(task.result):
+        result = {k: v for k, v in task.result.items() if k != "timings"}
+        await asyncio.to_thread(result_cache.put, cache_key, result)
+    if user_id:
+        await _store_result(task, user_id, song_id, sha256, kind)
+
+
+def _remove_cancel_marker(task_id: str):
+    try:
+        os.remove(_cancel_path(task_id))
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.warning(f"[{task_id}] 清理取消标记失败: {e}")
+
+
+async def _store_result(task, user_id: str, song_id: str, sha256: str, kind: str = "video"):
+    """
+    成功的分析结果写入存储并增量更新汇总（写入失败只记日志，不影响返回结果）；
+    超过截止时间的部分结果不计入历史
+    """
+    if result_store is None or task.status != "done" or task.result.get("partial"):
+        return
+    try:
+        await asyncio.to_thread(result_store.record, task.task_id, user_id, song_id, sha256,
+                                task.result, kind=kind)
     except Exception as e:
-        logger.error(f"[{task_id}] 分析失败: {e}")
-        raise HTTPException(500, f"分析失败: {str(e)}")
+        logger.error(f"[{task.task_id}] 保存分析结果失败: {e}")
+
+
+def _observe(task):
+    cached = bool(task.result and task.result.get("cached"))
+    tasks_total.inc("cached" if cached else task.status)
+    for stage, seconds in task.all_timings().items():
+        stage_seconds.observe(stage, seconds)
+    if task.status == "done" and not cached and task.result.get("handFrameMs"):
+        hand_frame_seconds.observe(task.result["handDetectorMode"],
+                                   task.result["handFrameMs"] / 1000)
+
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus 文本格式指标：各阶段耗时直方图、任务数、队列深度"""
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/api/cache/stats")
+async def cache_stats():
+    """结果缓存命中统计"""
+    return {"success": True, "data": result_cache.stats()}
+
+
+@app.get("/api/history")
+async def get_history(userId: str, songId: str = "", limit: int = 20,
+                      before: Optional[float] = None, kind: str = ""):
+    """
+    历史分析记录（按时间倒序，含评分与问题列表，不含曲线）
+
+    分页：下一页传 before=上一页最后一条的 createdAt
+    kind=video / audio 只返回视频分析或纯音频分析，默认两者都返回（每条带 kind）
+    """
+    store = _require_store()
+    if kind:
+        _check_kind(kind)
+    records = await asyncio.to_thread(store.history, userId, songId, min(max(limit, 1), 100),
+                                      before, kind)
+    return {"success": True, "data": records}
+
+
+@app.get("/api/history/{taskId}")
+async def get_history_record(taskId: str, userId: str):
+    """单次分析的完整记录，音准曲线、节拍点、手部关键点为 packed 格式（见 services/encoding.py）"""
+    store = _require_store()
+    record = await asyncio.to_thread(store.get, userId, taskId)
+    if record is None:
+        raise HTTPException(404, f"记录不存在: {taskId}")
+    return {"success": True, "data": record}
+
+
+@app.get("/api/progress")
+async def get_progress(userId: str, days: int = 30, kind: str = "video"):
+    """
+    进步趋势（来自增量维护的汇总表，不扫描历史记录）
+
+    kind=video（默认）/ audio：视频分析与纯音频分析的综合分构成不同，分别汇总
+    total：全部记录的平均 / 最好 / 最差 / 近期水平（指数滑动平均）
+    rolling：近 7 天、近 30 天平均；daily：最近 days 天的逐日平均
+    songs：各曲目的汇总，strongest / weakest 为平均分最高 / 最低的维度
+    """
+    store = _require_store()
+    _check_kind(kind)
+    data = await asyncio.to_thread(store.progress, userId, min(max(days, 1), 365), kind)
+    return {"success": True, "data": data}
+
+
+def _check_kind(kind: str):
+    if kind not in RESULT_KINDS:
+        raise HTTPException(400, f"不支持的分析类型: {kind}")
+
+
+def _require_store() -> ResultStore:
+    if result_store is None:
+        raise HTTPException(404, "未启用结果存储")
+    return result_store
+
+
+@app.get("/api/tasks/{taskId}")
+async def get_task(taskId: str, wait: float = 0, timings: bool = False, encoding: str = "",
+                   accept: str = Header(default="")):
+    """
+    查询分析任务状态
+
+    wait > 0 时长轮询：最多等待 wait 秒（不超过 TASK_MAX_WAIT），任务完成后立即返回
+    timings=true 时结果附带各阶段耗时
+    encoding 与 /api/analyze/video 相同
+    """
+    encoding = _negotiate(encoding, accept)
+    task = task_queue.get(taskId)
+    if task is None:
+        raise HTTPException(404, f"任务不存在或已过期: {taskId}")
+
+    await task_queue.wait(task, min(max(wait, 0), TASK_MAX_WAIT))
+    return _respond({"success": True, "data": _encode_task(task.to_dict(timings), encoding)},
+                    encoding)
+
+
+@app.delete("/api/tasks/{taskId}")
+async def cancel_task(taskId: str):
+    """取消分析任务：排队中的立即取消，分析中的尽快停止（之后查询状态为 cancelled）"""
+    task = task_queue.get(taskId)
+    if task is None:
+        raise HTTPException(404, f"任务不存在或已过期: {taskId}")
+    _cancel_task(task)
+    return {"success": True, "data": task.to_dict()}
+
+
+# 当前实时练习连接数
+practice_sessions = 0
+
+
+@app.websocket("/ws/practice")
+async def practice_feedback(
+    websocket: WebSocket,
+    sampleRate: int = 44100,
+    format: str = "s16le",
+    tempo: float = 0.0,
+):
+    """
+    实时练习反馈
+
+    客户端以二进制消息发送单声道 PCM 分块（默认 s16le，即小程序 RecorderManager
+    的 PCM 帧），每块返回一条 {"type": "update", ...}：音名、音分偏差、局部速度
+    与速度漂移、处理耗时；发送文本消息 {"type": "stop"} 后返回
+    {"type": "summary", "data": {...}}（与批量分析的音频结果格式相同）并关闭连接
+    """
+    global practice_sessions
+    await websocket.accept()
+    if practice_sessions >= PRACTICE_MAX_SESSIONS:
+        await websocket.close(code=1013, reason="服务繁忙，请稍后重试")
+        return
+    # 检查后立即占位：创建会话需要等待线程，同时到达的连接不能都通过上限检查
+    practice_sessions += 1
+    try:
+        try:
+            session = await asyncio.to_thread(_practice_session, sampleRate, format, tempo)
+        except ValueError as e:
+            await websocket.close(code=1003, reason=str(e))
+            return
+
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                return
+            if message.get("bytes"):
+                # 分析放到线程中执行，不阻塞其他连接
+                update = await asyncio.to_thread(session.feed, message["bytes"])
+                await websocket.send_json(update)
+            elif message.get("text") and _control_type(message["text"]) == "stop":
+                await websocket.send_json(await asyncio.to_thread(session.finish))
+                await websocket.close()
+                return
+    except WebSocketDisconnect:
+        pass
+    except Exception as e:
+        logger.error(f"实时练习分析失败: {e}")
+        await websocket.close(code=1011, reason="分析失败")
     finally:
-        # 清理临时文件
-        shutil.rmtree(task_dir, ignore_errors=True)
+        practice_sessions -= 1
+
+
+def _control_type(text: str) -> str:
+    """文本控制消息的 type；无法解析的消息忽略，不中断练习"""
+    try:
+        message = json.loads(text)
+    except json.JSONDecodeError:
+        logger.warning(f"忽略无法解析的实时练习消息: {text[:100]!r}")
+        return ""
+    return message.get("type", "") if isinstance(message, dict) else ""
+
+
+def _practice_session(sr: int, pcm_format: str, tempo: float):
+    # 预热完成前首次导入 librosa 需要数秒，在线程中执行
+    from services.practice import PracticeSession
+    return PracticeSession(sr, pcm_format, tempo)
 
 
 if __name__ == "__main__":
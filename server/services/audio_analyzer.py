@@ -5,13 +5,29 @@ import librosa
 import numpy as np
 import logging
 
+from config import ANALYSIS_SR
+from services.audio_features import AudioFeatures
+from services.cancel import AnalysisCancelled, current_cancel
+from services.downsample import beat_points, pitch_curve
+from services.metrics import span
+from services.reference import compare_with_reference
+
 logger = logging.getLogger(__name__)
 
+# 分析采样率
+SAMPLE_RATE = ANALYSIS_SR
+
 
-def analyze_audio(audio_path: str) -> dict:
+def analyze_audio(audio, sr: int = None, song_id: str = "", with_onsets: bool = False) -> dict:
     """
     分析古筝演奏音频
 
+    参数:
+        audio:   音频文件路径，或已解码的单声道 float32 PCM 数组
+        sr:      audio 为数组时的采样率
+        song_id: 曲目 ID，有参考索引时与参考演奏逐小节对比
+        with_onsets: 结果中附带全部音符起始点 "onsetTimes"（秒），供自适应抽帧使用
+
     返回:
         {
             "pitchAccuracy": int,      # 音准评分 0-100
@@ -20,35 +36,48 @@ def analyze_audio(audio_path: str) -> dict:
             "overallScore": int,       # 综合评分 0-100
             "pitchCurve": [...],       # 逐帧音高数据
             "beatAlignment": [...],    # 节拍时间点
-            "issues": [...]            # 问题列表
+            "issues": [...],           # 问题列表
+            "reference": {...}         # 参考演奏对比（仅当曲目有参考索引）
         }
     """
     try:
         # 加载音频
-        y, sr = librosa.load(audio_path, sr=44100, mono=True)
-        duration = librosa.get_duration(y=y, sr=sr)
+        if isinstance(audio, str):
+            with span("audio.load"):
+                y, sr = librosa.load(audio, sr=SAMPLE_RATE, mono=True)
+        else:
+            y, sr = np.asarray(audio, dtype=np.float32), sr or SAMPLE_RATE
+        features = AudioFeatures(y, sr)
+        duration = features.duration
         logger.info(f"音频加载完成: {duration:.1f}秒, 采样率={sr}")
 
         # 1. 音准分析
-        pitch_result = _analyze_pitch(y, sr)
+        pitch_result = _run_stage("audio.pitch", _analyze_pitch, features)
 
         # 2. 节奏分析
-        rhythm_result = _analyze_rhythm(y, sr)
+        rhythm_result = _run_stage("audio.rhythm", _analyze_rhythm, features)
 
         # 3. 力度分析
-        dynamics_result = _analyze_dynamics(y, sr)
+        dynamics_result = _run_stage("audio.dynamics", _analyze_dynamics, features)
 
         # 4. 综合评分
-        overall = int(
-            pitch_result["score"] * 0.4 +
-            rhythm_result["score"] * 0.35 +
-            dynamics_result["score"] * 0.25
-        )
+        overall = overall_score(pitch_result["score"], rhythm_result["score"], dynamics_result["score"])
 
         # 5. 汇总问题
         issues = pitch_result["issues"] + rhythm_result["issues"] + dynamics_result["issues"]
 
-        return {
+        # 6. 参考演奏对比
+        reference = None
+        if song_id and not _skip_stage("audio.reference"):
+            try:
+                with span("audio.reference"):
+                    reference = compare_with_reference(features, song_id)
+            except Exception as e:
+                logger.error(f"参考演奏对比失败: {e}")
+        if reference is not None:
+            issues += reference.pop("issues")
+
+        result = {
             "pitchAccuracy": pitch_result["score"],
             "rhythmAccuracy": rhythm_result["score"],
             "dynamics": dynamics_result["score"],
@@ -58,30 +87,48 @@ def analyze_audio(audio_path: str) -> dict:
             "issues": issues,
             "duration": round(duration, 1),
         }
+        if reference is not None:
+            result["reference"] = reference
+        if with_onsets:
+            result["onsetTimes"] = features.onset_times.tolist()
+        return result
 
+    except AnalysisCancelled:
+        raise
     except Exception as e:
         logger.error(f"音频分析失败: {e}")
         raise
 
 
-def _analyze_pitch(y: np.ndarray, sr: int) -> dict:
+def _skip_stage(stage: str) -> bool:
+    """客户端已断开时中止分析；已过截止时间时跳过该项（记为未完成）"""
+    cancel = current_cancel()
+    cancel.check()
+    if cancel.expired:
+        cancel.mark_incomplete(stage)
+        return True
+    return False
+
+
+def _run_stage(stage: str, analyze, features: AudioFeatures) -> dict:
+    """执行一项子分析，被跳过时返回 0 分、无数据的结果"""
+    if _skip_stage(stage):
+        return {"score": 0, "curve": [], "beats": [], "issues": []}
+    return analyze(features)
+
+
+def _analyze_pitch(features: AudioFeatures) -> dict:
     """音准分析 - 基频检测"""
-    # 使用 pyin 算法检测基频（适合单音乐器）
-    f0, voiced_flag, voiced_probs = librosa.pyin(
-        y, fmin=librosa.note_to_hz("C2"),
-        fmax=librosa.note_to_hz("C7"),
-        sr=sr
-    )
+    # 基频检测：默认 pyin（适合单音乐器），可切换为快速 YIN
+    f0, voiced_flag, voiced_probs, times = features.pitch
 
     # 过滤有效音高
-    valid_f0 = f0[voiced_flag]
+    voiced = np.flatnonzero(voiced_flag)
+    valid_f0 = f0[voiced]
 
     if len(valid_f0) == 0:
-        return {"score": 50, "curve": [], "issues": [
-            {"severity": "warning", "title": "未检测到明显音高",
-             "description": "录音中未检测到清晰的音高信息",
-             "suggestion": "请确保录音环境安静，古筝靠近麦克风"}
-        ]}
+        score, issues = score_pitch(None)
+        return {"score": score, "curve": [], "issues": issues}
 
     # 将频率转换为最近的音符，计算偏差（音分）
     midi_notes = librosa.hz_to_midi(valid_f0)
@@ -90,26 +137,84 @@ def _analyze_pitch(y: np.ndarray, sr: int) -> dict:
 
     # 音准评分：偏差越小越好
     avg_deviation = np.mean(deviations)
+    score, issues = score_pitch(avg_deviation)
+
+    # 音准曲线：先在有声帧上按峰谷降采样，只为保留的点生成数据
+    curve = pitch_curve(times[voiced], valid_f0, deviations)
+
+    return {"score": score, "curve": curve, "issues": issues}
+
+
+def _analyze_rhythm(features: AudioFeatures) -> dict:
+    """节奏分析 - 节拍检测与稳定性"""
+    # 检测 onset（音符起始点），与 beat_track 共用同一条 onset 包络
+    onset_times = features.onset_times
+
+    if len(onset_times) < 3:
+        score, issues = score_rhythm(None, 0.0)
+        return {"score": score, "beats": [], "issues": issues}
+
+    # 计算相邻 onset 的时间间隔
+    intervals = np.diff(onset_times)
+
+    # 节奏稳定性：间隔的变异系数（CV）越小越稳定
+    if np.mean(intervals) > 0:
+        cv = np.std(intervals) / np.mean(intervals)
+    else:
+        cv = 1.0
+
+    # 检测 tempo
+    tempo = features.tempo
+    score, issues = score_rhythm(cv, tempo)
+
+    beats = beat_points(onset_times)
+
+    return {"score": score, "beats": beats, "issues": issues}
+
+
+def _analyze_dynamics(features: AudioFeatures) -> dict:
+    """力度分析 - 音量变化与控制"""
+    # RMS 能量（由共享的 STFT 幅度谱计算）
+    rms = features.rms
+
+    if len(rms) == 0 or np.max(rms) == 0:
+        score, issues = score_dynamics(None, 0.0)
+        return {"score": score, "issues": issues}
+
+    # 归一化 RMS
+    rms_norm = rms / np.max(rms)
+
+    # 力度评分基于：
+    # 1. 动态范围（有高有低说明有表现力）
+    dynamic_range = float(np.max(rms) - np.min(rms[rms > 0.01 * np.max(rms)])) / float(np.max(rms))
+
+    # 2. 力度变化的平滑度（不要突变）
+    rms_diff = np.abs(np.diff(rms_norm))
+    smoothness = 1.0 - min(1.0, float(np.mean(rms_diff)) * 10)
+
+    score, issues = score_dynamics(dynamic_range, smoothness)
+    return {"score": score, "issues": issues}
+
+
+# ---- 评分规则：批量分析与分块流式分析共用，输入为汇总统计量 ----
+
+def overall_score(pitch_score: int, rhythm_score: int, dynamics_score: int) -> int:
+    """音频综合评分：音准 40% + 节奏 35% + 力度 25%"""
+    return int(pitch_score * 0.4 + rhythm_score * 0.35 + dynamics_score * 0.25)
+
+
+def score_pitch(avg_deviation) -> tuple[int, list]:
+    """音准评分，avg_deviation 为平均偏差（音分），None 表示未检测到音高"""
+    if avg_deviation is None:
+        return 50, [
+            {"severity": "warning", "title": "未检测到明显音高",
+             "description": "录音中未检测到清晰的音高信息",
+             "suggestion": "请确保录音环境安静，古筝靠近麦克风"}
+        ]
+
     # 0 音分 → 100 分，50 音分 → 0 分
     score = max(0, min(100, int(100 - avg_deviation * 2)))
 
-    # 生成音准曲线（每 0.5 秒一个数据点）
-    times = librosa.times_like(f0, sr=sr)
-    curve = []
-    for i in range(len(f0)):
-        if voiced_flag[i]:
-            curve.append({
-                "time": round(float(times[i]), 2),
-                "frequency": round(float(f0[i]), 1),
-                "note": librosa.hz_to_note(f0[i]),
-                "cents_off": round(float(deviations[i] if i < len(deviations) else 0), 1)
-            })
-
-    # 降采样曲线数据（最多 200 个点）
-    if len(curve) > 200:
-        step = len(curve) // 200
-        curve = curve[::step]
-
     # 检测问题段落
     issues = []
     if avg_deviation > 25:
@@ -122,41 +227,21 @@ def _analyze_pitch(y: np.ndarray, sr: int) -> dict:
     if avg_deviation > 40:
         issues[0]["severity"] = "error"
 
-    return {"score": score, "curve": curve, "issues": issues}
-
+    return score, issues
 
-def _analyze_rhythm(y: np.ndarray, sr: int) -> dict:
-    """节奏分析 - 节拍检测与稳定性"""
-    # 检测 onset（音符起始点）
-    onset_frames = librosa.onset.onset_detect(y=y, sr=sr, units="frames")
-    onset_times = librosa.frames_to_time(onset_frames, sr=sr)
 
-    if len(onset_times) < 3:
-        return {"score": 60, "beats": [], "issues": [
+def score_rhythm(cv, tempo: float) -> tuple[int, list]:
+    """节奏评分，cv 为起始点间隔的变异系数，None 表示音符数量不足"""
+    if cv is None:
+        return 60, [
             {"severity": "info", "title": "音符数量过少",
              "description": "检测到的音符数量不足，无法准确评估节奏",
              "suggestion": "建议录制更长的练习片段"}
-        ]}
-
-    # 计算相邻 onset 的时间间隔
-    intervals = np.diff(onset_times)
-
-    # 节奏稳定性：间隔的变异系数（CV）越小越稳定
-    if np.mean(intervals) > 0:
-        cv = np.std(intervals) / np.mean(intervals)
-    else:
-        cv = 1.0
+        ]
 
     # CV 0 → 100 分，CV 1.0 → 0 分
     score = max(0, min(100, int(100 - cv * 100)))
 
-    # 检测 tempo
-    tempo, _ = librosa.beat.beat_track(y=y, sr=sr)
-    if isinstance(tempo, np.ndarray):
-        tempo = float(tempo[0])
-
-    beats = [{"time": round(float(t), 2)} for t in onset_times[:100]]
-
     issues = []
     if cv > 0.3:
         issues.append({
@@ -168,31 +253,17 @@ def _analyze_rhythm(y: np.ndarray, sr: int) -> dict:
     if cv > 0.5:
         issues[0]["severity"] = "error"
 
-    return {"score": score, "beats": beats, "issues": issues}
-
+    return score, issues
 
-def _analyze_dynamics(y: np.ndarray, sr: int) -> dict:
-    """力度分析 - 音量变化与控制"""
-    # RMS 能量
-    rms = librosa.feature.rms(y=y)[0]
 
-    if len(rms) == 0 or np.max(rms) == 0:
-        return {"score": 50, "issues": [
+def score_dynamics(dynamic_range, smoothness: float) -> tuple[int, list]:
+    """力度评分，dynamic_range 为 None 表示音量过低"""
+    if dynamic_range is None:
+        return 50, [
             {"severity": "warning", "title": "音量过低",
              "description": "录音音量极低",
              "suggestion": "请靠近麦克风录制"}
-        ]}
-
-    # 归一化 RMS
-    rms_norm = rms / np.max(rms)
-
-    # 力度评分基于：
-    # 1. 动态范围（有高有低说明有表现力）
-    dynamic_range = float(np.max(rms) - np.min(rms[rms > 0.01 * np.max(rms)])) / float(np.max(rms))
-
-    # 2. 力度变化的平滑度（不要突变）
-    rms_diff = np.abs(np.diff(rms_norm))
-    smoothness = 1.0 - min(1.0, float(np.mean(rms_diff)) * 10)
+        ]
 
     # 综合评分
     score = max(0, min(100, int(dynamic_range * 50 + smoothness * 50)))
@@ -213,4 +284,4 @@ def _analyze_dynamics(y: np.ndarray, sr: int) -> dict:
             "suggestion": "注意触弦力度的均匀控制"
         })
 
-    return {"score": score, "issues": issues}
+    return score, issues
@@ -0,0 +1,93 @@
+"""
+音频特征上下文 - 单次分析内共享 STFT、onset 包络、RMS、基频等中间结果
+"""
+from functools import cached_property
+
+import librosa
+import numpy as np
+
+from services.metrics import span
+from services.pitch_tracker import frame_sizes, track_pitch
+
+
+class AudioFeatures:
+    """
+    按需计算并缓存音频特征
+
+    所有基于频谱的特征都从同一次 STFT 派生，各分析模块（以及后续新增的模块）
+    通过属性访问，不再各自重复分帧和 FFT
+    """
+
+    def __init__(self, y: np.ndarray, sr: int, n_fft: int = None, hop_length: int = None):
+        # 默认帧长 / 帧移按采样率缩放（2048 / 512 @ 44.1kHz）
+        default_n_fft, default_hop = frame_sizes(sr)
+        self.y = y
+        self.sr = sr
+        self.n_fft = n_fft or default_n_fft
+        self.hop_length = hop_length or default_hop
+
+    @cached_property
+    def duration(self) -> float:
+        return librosa.get_duration(y=self.y, sr=self.sr)
+
+    @cached_property
+    def magnitude(self) -> np.ndarray:
+        """STFT 幅度谱 (1 + n_fft/2, frames)"""
+        with span("audio.stft"):
+            return np.abs(librosa.stft(self.y, n_fft=self.n_fft, hop_length=self.hop_length))
+
+    @cached_property
+    def power(self) -> np.ndarray:
+        return self.magnitude ** 2
+
+    @cached_property
+    def onset_envelope(self) -> np.ndarray:
+        """onset 强度包络（与 librosa 默认一致：对数 mel 谱的正向差分）"""
+        power = self.power
+        with span("audio.onset"):
+            mel = librosa.feature.melspectrogram(S=power, sr=self.sr)
+            return librosa.onset.onset_strength(
+                S=librosa.power_to_db(mel), sr=self.sr, hop_length=self.hop_length
+            )
+
+    @cached_property
+    def onset_frames(self) -> np.ndarray:
+        envelope = self.onset_envelope
+        with span("audio.onset"):
+            return librosa.onset.onset_detect(
+                onset_envelope=envelope, sr=self.sr,
+                hop_length=self.hop_length, units="frames"
+            )
+
+    @cached_property
+    def onset_times(self) -> np.ndarray:
+        return librosa.frames_to_time(self.onset_frames, sr=self.sr, hop_length=self.hop_length)
+
+    @cached_property
+    def tempo(self) -> float:
+        envelope = self.onset_envelope
+        with span("audio.beat"):
+            tempo, _ = librosa.beat.beat_track(
+                onset_envelope=envelope, sr=self.sr, hop_length=self.hop_length
+            )
+        if isinstance(tempo, np.ndarray):
+            tempo = float(tempo[0])
+        return float(tempo)
+
+    @cached_property
+    def rms(self) -> np.ndarray:
+        """
+        逐帧 RMS（由幅度谱计算）
+
+        含 STFT 窗函数增益，绝对值与时域 RMS 不同；力度评分只使用相对比例
+        """
+        magnitude = self.magnitude
+        with span("audio.rms"):
+            return librosa.feature.rms(S=magnitude, frame_length=self.n_fft,
+                                       hop_length=self.hop_length)[0]
+
+    @cached_property
+    def pitch(self) -> tuple:
+        """(f0, voiced_flag, voiced_prob, times)，基频检测有自己的分帧"""
+        with span("audio.pitch"):
+            return track_pitch(self.y, self.sr)
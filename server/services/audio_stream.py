@@ -0,0 +1,306 @@
+"""
+分块流式音频分析 - 长录音按块处理，只保留运行统计量和降采样曲线，峰值内存与时长无关
+"""
+import logging
+from array import array
+from typing import Iterable
+
+import librosa
+import numpy as np
+
+from services.audio_analyzer import overall_score, score_pitch, score_rhythm, score_dynamics
+from services.cancel import current_cancel
+from services.downsample import (
+    MAX_BEATS, MAX_CURVE_POINTS, beat_points, bucket_minmax, pitch_curve,
+)
+from services.metrics import span
+from services.pitch_tracker import frame_sizes, track_pitch
+
+logger = logging.getLogger(__name__)
+
+# onset 峰值检测参数（与 librosa.onset.onset_detect 默认值一致，单位秒）
+ONSET_PRE_MAX = 0.03
+ONSET_POST_MAX = 0.0
+ONSET_PRE_AVG = 0.10
+ONSET_POST_AVG = 0.10
+ONSET_WAIT = 0.03
+ONSET_DELTA = 0.07
+
+# RMS 直方图（对数分箱），用于结束时求“高于最大值 1% 的最小 RMS”
+RMS_HIST_BINS = 1024
+RMS_HIST_MIN = 1e-6
+RMS_HIST_MAX = 10.0
+
+
+class StreamingAudioAnalyzer:
+    """
+    分块流式分析
+
+    - process() 可接收任意长度的 PCM 块，内部保留 frame_length - hop_length 个样本的重叠，
+      每帧只计算一次（center=False 分帧，与 librosa.stream 的块语义相同）
+    - 音准：累计平均偏差；曲线按时间分桶，每桶保留频率最小 / 最大的点，
+      桶数超过上限的一半时桶宽加倍，曲线均匀覆盖整段录音
+    - 节奏：onset 包络保留峰值检测所需的前后窗口，间隔用 Welford 法累计均值/方差
+    - 力度：运行最大值、相邻帧差累计和、RMS 对数直方图
+
+    与批量分析的差异：onset 包络按运行最大值归一化；速度由平均间隔估算；
+    不做参考演奏对比
+    """
+
+    def __init__(self, sr: int, n_fft: int = None, hop_length: int = None,
+                 max_curve_points: int = MAX_CURVE_POINTS, max_beats: int = MAX_BEATS,
+                 pitch_mode: str = None):
+        default_n_fft, default_hop = frame_sizes(sr)
+        n_fft = n_fft or default_n_fft
+        self.sr = sr
+        self.n_fft = n_fft
+        self.hop_length = hop_length or default_hop
+        self.max_curve_points = max_curve_points
+        self.max_beats = max_beats
+        self.pitch_mode = pitch_mode
+
+        self._carry = np.zeros(0, dtype=np.float32)
+        self._frames_done = 0
+        self._mel_basis = librosa.filters.mel(sr=sr, n_fft=n_fft)
+
+        # 音准
+        self._deviation_sum = 0.0
+        self._voiced_frames = 0
+        # 曲线候选点：时间、频率、音分偏差；初始每帧一个桶
+        self._curve = np.zeros((3, 0))
+        self._curve_bucket_seconds = self.hop_length / sr
+
+        # 节奏
+        self._prev_mel_db = None
+        self._env = np.zeros(0, dtype=np.float32)
+        self._env_start = 0           # _env[0] 对应的帧号
+        self._env_checked = 0         # 已完成峰值判断的帧号上界
+        self._env_max = 0.0
+        self._last_onset_frame = None
+        self._onset_times = array("f")
+        self._interval_n = 0
+        self._interval_mean = 0.0
+        self._interval_m2 = 0.0
+
+        # 力度
+        self._rms_max = 0.0
+        self._rms_prev = None
+        self._rms_diff_sum = 0.0
+        self._rms_frames = 0
+        self._rms_hist = np.zeros(RMS_HIST_BINS, dtype=np.int64)
+
+        frames_per_second = sr / self.hop_length
+        self._pre_max = max(1, int(ONSET_PRE_MAX * frames_per_second))
+        self._post_max = max(1, int(ONSET_POST_MAX * frames_per_second) + 1)
+        self._pre_avg = max(1, int(ONSET_PRE_AVG * frames_per_second))
+        self._post_avg = max(1, int(ONSET_POST_AVG * frames_per_second) + 1)
+        self._wait = max(1, int(ONSET_WAIT * frames_per_second))
+
+    @property
+    def duration(self) -> float:
+        return (self._frames_done * self.hop_length + len(self._carry)) / self.sr
+
+    @property
+    def tempo(self) -> float:
+        """由起始点平均间隔估算的全曲速度（BPM），间隔不足时为 0"""
+        if self._interval_n < 2 or self._interval_mean <= 0:
+            return 0.0
+        return 60.0 / self._interval_mean
+
+    def frame_time(self, frame):
+        """帧中心对应的时间（秒）"""
+        return (np.asarray(frame) * self.hop_length + self.n_fft / 2) / self.sr
+
+    def process(self, block: np.ndarray) -> dict:
+        """
+        处理一块 PCM，返回该块内新增的逐帧结果：
+            {"f0", "voiced", "rms", "onsets"(秒), "startFrame"}
+        """
+        y = np.concatenate([self._carry, np.asarray(block, dtype=np.float32)])
+        n_frames = 0 if len(y) < self.n_fft else 1 + (len(y) - self.n_fft) // self.hop_length
+        if n_frames == 0:
+            self._carry = y
+            return {"f0": np.zeros(0), "voiced": np.zeros(0, dtype=bool), "rms": np.zeros(0),
+                    "onsets": np.zeros(0), "startFrame": self._frames_done}
+
+        used = (n_frames - 1) * self.hop_length + self.n_fft
+        y_frames = y[:used]
+        self._carry = y[n_frames * self.hop_length:]
+        start_frame = self._frames_done
+        self._frames_done += n_frames
+
+        # 阶段名与批量分析（AudioFeatures）一致，便于对比
+        with span("audio.stft"):
+            magnitude = np.abs(librosa.stft(y_frames, n_fft=self.n_fft,
+                                            hop_length=self.hop_length, center=False))
+        with span("audio.rms"):
+            rms = librosa.feature.rms(S=magnitude, frame_length=self.n_fft,
+                                      hop_length=self.hop_length)[0]
+            self._update_dynamics(rms)
+        with span("audio.pitch"):
+            f0, voiced, _, _ = track_pitch(y_frames, self.sr, mode=self.pitch_mode, center=False)
+            f0, voiced = f0[:n_frames], voiced[:n_frames]
+            self._update_pitch(f0, voiced, start_frame)
+        with span("audio.onset"):
+            onsets = self._update_onsets(magnitude, start_frame)
+
+        return {"f0": f0, "voiced": voiced, "rms": rms,
+                "onsets": self.frame_time(onsets), "startFrame": start_frame}
+
+    @property
+    def onset_times(self) -> list:
+        """到目前为止检测到的全部起始点（秒，float32 紧凑存储）"""
+        return self._onset_times.tolist()
+
+    def finalize(self) -> dict:
+        """结束分析，返回与 analyze_audio 相同格式的结果"""
+        self._flush_onsets()
+
+        avg_deviation = self._deviation_sum / self._voiced_frames if self._voiced_frames else None
+        pitch_score, pitch_issues = score_pitch(avg_deviation)
+
+        if self._interval_n >= 2 and self._interval_mean > 0:
+            cv = float(np.sqrt(self._interval_m2 / self._interval_n) / self._interval_mean)
+        elif self._interval_n >= 2:
+            cv = 1.0
+        else:
+            cv = None
+        rhythm_score, rhythm_issues = score_rhythm(cv, self.tempo)
+
+        if self._rms_frames == 0 or self._rms_max == 0:
+            dynamics_score, dynamics_issues = score_dynamics(None, 0.0)
+        else:
+            dynamic_range = (self._rms_max - self._rms_floor()) / self._rms_max
+            mean_diff = self._rms_diff_sum / max(1, self._rms_frames - 1) / self._rms_max
+            smoothness = 1.0 - min(1.0, mean_diff * 10)
+            dynamics_score, dynamics_issues = score_dynamics(dynamic_range, smoothness)
+
+        times, frequencies, cents_off = self._curve
+        curve = pitch_curve(times, frequencies, cents_off, self.max_curve_points)
+        beats = beat_points(np.frombuffer(self._onset_times, dtype=np.float32), self.max_beats)
+
+        return {
+            "pitchAccuracy": pitch_score,
+            "rhythmAccuracy": rhythm_score,
+            "dynamics": dynamics_score,
+            "overallScore": overall_score(pitch_score, rhythm_score, dynamics_score),
+            "pitchCurve": curve if avg_deviation is not None else [],
+            "beatAlignment": beats if cv is not None else [],
+            "issues": pitch_issues + rhythm_issues + dynamics_issues,
+            "duration": round(self.duration, 1),
+        }
+
+    def _update_pitch(self, f0: np.ndarray, voiced: np.ndarray, start_frame: int):
+        voiced_idx = np.flatnonzero(voiced)
+        if len(voiced_idx) == 0:
+            return
+        midi = librosa.hz_to_midi(f0[voiced_idx])
+        deviations = np.abs(midi - np.round(midi)) * 100
+        self._deviation_sum += float(np.sum(deviations))
+        self._voiced_frames += len(voiced_idx)
+
+        # 有声帧追加为候选点后按时间分桶取峰谷；桶宽加倍时新桶恰为相邻两桶的合并，
+        # 已压缩的部分与新数据同样按时间均匀保留，内存与时长无关
+        points = np.stack([self.frame_time(start_frame + voiced_idx), f0[voiced_idx], deviations])
+        curve = np.concatenate([self._curve, points], axis=1)
+        bucket = np.floor(curve[0] / self._curve_bucket_seconds).astype(np.int64)
+        while bucket[-1] >= max(1, self.max_curve_points // 2):
+            self._curve_bucket_seconds *= 2
+            bucket //= 2
+        self._curve = curve[:, bucket_minmax(curve[1], bucket)]
+
+    def _update_dynamics(self, rms: np.ndarray):
+        if len(rms) == 0:
+            return
+        self._rms_max = max(self._rms_max, float(np.max(rms)))
+        prev = np.concatenate([[self._rms_prev], rms]) if self._rms_prev is not None else rms
+        self._rms_diff_sum += float(np.sum(np.abs(np.diff(prev))))
+        self._rms_prev = float(rms[-1])
+        self._rms_frames += len(rms)
+        self._rms_hist += np.histogram(
+            np.clip(rms, RMS_HIST_MIN, RMS_HIST_MAX), bins=_RMS_EDGES
+        )[0]
+
+    def _rms_floor(self) -> float:
+        """高于最大值 1% 的最小 RMS（直方图分箱下沿近似）"""
+        threshold = 0.01 * self._rms_max
+        above = np.flatnonzero((self._rms_hist > 0) & (_RMS_EDGES[1:] > threshold))
+        if len(above) == 0:
+            return self._rms_max
+        return max(threshold, float(_RMS_EDGES[above[0]]))
+
+    def _update_onsets(self, magnitude: np.ndarray, start_frame: int) -> np.ndarray:
+        # onset 强度：对数 mel 谱相邻帧正向差分的均值（librosa 默认 lag=1）
+        mel_db = librosa.power_to_db(self._mel_basis @ (magnitude ** 2))
+        prev = self._prev_mel_db if self._prev_mel_db is not None else mel_db[:, :1]
+        flux = np.diff(np.concatenate([prev, mel_db], axis=1), axis=1)
+        env = np.mean(np.maximum(0.0, flux), axis=0).astype(np.float32)
+        self._prev_mel_db = mel_db[:, -1:]
+
+        self._env = np.concatenate([self._env, env])
+        self._env_max = max(self._env_max, float(np.max(env)) if len(env) else 0.0)
+        return self._detect_onsets(final=False)
+
+    def _flush_onsets(self):
+        self._detect_onsets(final=True)
+
+    def _detect_onsets(self, final: bool) -> np.ndarray:
+        """对已有足够后向窗口的帧做峰值检测，只保留检测所需的包络窗口"""
+        env_end = self._env_start + len(self._env)
+        ready_end = env_end if final else env_end - max(self._post_max, self._post_avg)
+        if ready_end <= self._env_checked or self._env_max <= 0:
+            return np.zeros(0, dtype=int)
+
+        normalized = self._env / self._env_max
+        peaks = librosa.util.peak_pick(
+            normalized, pre_max=self._pre_max, post_max=self._post_max,
+            pre_avg=self._pre_avg, post_avg=self._post_avg,
+            delta=ONSET_DELTA, wait=self._wait,
+        ) + self._env_start
+        peaks = peaks[(peaks >= self._env_checked) & (peaks < ready_end)]
+
+        onsets = []
+        for frame in peaks:
+            if self._last_onset_frame is not None and frame - self._last_onset_frame <= self._wait:
+                continue
+            if self._last_onset_frame is not None:
+                interval = float(frame - self._last_onset_frame) * self.hop_length / self.sr
+                self._interval_n += 1
+                delta = interval - self._interval_mean
+                self._interval_mean += delta / self._interval_n
+                self._interval_m2 += delta * (interval - self._interval_mean)
+            self._last_onset_frame = int(frame)
+            onsets.append(int(frame))
+            self._onset_times.append(float(self.frame_time(frame)))
+
+        # 丢弃不再需要的包络，只留前向窗口
+        self._env_checked = ready_end
+        keep_from = max(self._env_start, ready_end - max(self._pre_max, self._pre_avg))
+        self._env = self._env[keep_from - self._env_start:]
+        self._env_start = keep_from
+        return np.array(onsets, dtype=int)
+
+
+_RMS_EDGES = np.geomspace(RMS_HIST_MIN, RMS_HIST_MAX, RMS_HIST_BINS + 1)
+
+
+def analyze_audio_stream(blocks: Iterable[np.ndarray], sr: int, pitch_mode: str = None,
+                         with_onsets: bool = False) -> dict:
+    """
+    逐块分析 PCM 流，返回与 analyze_audio 相同格式的结果
+
+    客户端已断开时中止；已过截止时间时停止读取，只汇总已分析的部分
+    """
+    analyzer = StreamingAudioAnalyzer(sr, pitch_mode=pitch_mode)
+    cancel = current_cancel()
+    for block in blocks:
+        if cancel.stopped:
+            cancel.check()
+            cancel.mark_incomplete("audio")
+            break
+        analyzer.process(block)
+    result = analyzer.finalize()
+    if with_onsets:
+        result["onsetTimes"] = analyzer.onset_times
+    logger.info(f"流式音频分析完成: {result['duration']}秒, 综合 {result['overallScore']} 分")
+    return result
@@ -0,0 +1,100 @@
+"""
+取消与截止时间 - 客户端断开或超过截止时间时，分析流水线各阶段尽早停止
+
+服务进程与分析进程之间通过标记文件传递取消（客户端断开、主动取消），
+截止时间为绝对时间戳（time.time()）。CancelToken 随任务参数传入分析进程，
+在其中用 use_cancel() 放入 contextvars，与 Timings 一样经 bind() 传给分析线程：
+- 已取消：各阶段调用 check() 抛出 AnalysisCancelled，结果无人接收，直接放弃
+- 已过截止时间：尚未开始的阶段跳过、进行中的循环提前结束，已完成部分照常返回，
+  被截断的阶段记入 incomplete
+"""
+import contextvars
+import os
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+# 取消标记文件的扩展名
+CANCEL_MARKER = "cancel"
+
+# 检查取消标记文件的最短间隔（秒），逐帧检查时不必每次访问文件系统
+POLL_INTERVAL = 0.5
+
+
+class AnalysisCancelled(Exception):
+    """分析已取消（客户端断开或主动取消），结果无人接收"""
+
+
+class CancelToken:
+    """
+    一次分析的取消标记与截止时间，可序列化后传给分析进程
+
+    cancel_path 为空表示不可取消，deadline 为 None 表示没有截止时间
+    """
+
+    def __init__(self, cancel_path: str = "", deadline: Optional[float] = None):
+        self.cancel_path = cancel_path
+        self.deadline = deadline
+        self.incomplete: set[str] = set()
+        self._cancelled = False
+        self._checked_at = 0.0
+
+    @property
+    def cancelled(self) -> bool:
+        if self._cancelled or not self.cancel_path:
+            return self._cancelled
+        now = time.monotonic()
+        if now - self._checked_at >= POLL_INTERVAL:
+            self._checked_at = now
+            self._cancelled = os.path.exists(self.cancel_path)
+        return self._cancelled
+
+    @property
+    def expired(self) -> bool:
+        return self.deadline is not None and time.time() >= self.deadline
+
+    @property
+    def stopped(self) -> bool:
+        """已取消或已过截止时间：不应再继续耗时的工作"""
+        return self.expired or self.cancelled
+
+    def remaining(self, default: float) -> float:
+        """距截止时间的秒数，没有截止时间时返回 default（不超过 default）"""
+        if self.deadline is None:
+            return default
+        return max(0.0, min(default, self.deadline - time.time()))
+
+    def check(self):
+        """已取消时抛出 AnalysisCancelled"""
+        if self.cancelled:
+            raise AnalysisCancelled("客户端已断开，分析已取消")
+
+    def mark_incomplete(self, stage: str):
+        """记录因截止时间被跳过或截断的阶段"""
+        self.incomplete.add(stage)
+
+
+# 当前上下文的取消标记；未设置时为永不停止的空标记
+_NEVER = CancelToken()
+_current: contextvars.ContextVar[CancelToken] = contextvars.ContextVar(
+    "cancel_token", default=_NEVER
+)
+
+
+@contextmanager
+def use_cancel(token: CancelToken):
+    """在当前上下文中启用取消检查"""
+    reset = _current.set(token)
+    try:
+        yield token
+    finally:
+        _current.reset(reset)
+
+
+def current_cancel() -> CancelToken:
+    return _current.get()
+
+
+def deadline_at(seconds: float) -> Optional[float]:
+    """从现在起 seconds 秒后的截止时间戳，seconds <= 0 表示不限"""
+    return time.time() + seconds if seconds > 0 else None
@@ -0,0 +1,80 @@
+"""
+曲线降采样 - 在生成 JSON 之前对 NumPy 数组挑点，保留按音 / 滑音等音高峰谷
+"""
+import librosa
+import numpy as np
+
+# 音准曲线最多返回的点数
+MAX_CURVE_POINTS = 200
+
+# 节拍点最多返回的个数
+MAX_BEATS = 100
+
+
+def minmax_indices(times: np.ndarray, values: np.ndarray, max_points: int) -> np.ndarray:
+    """
+    按时间最小 / 最大值分桶降采样，返回保留点的下标（升序）
+
+    把 [首点时间, 末点时间] 均分为 max_points // 2 个桶，每桶保留最小值和最大值各一个点：
+    短时的音高起伏不会因为等间隔抽取而丢失，长静音两侧的乐句也按各自时长分配点数；
+    点数不超过 max_points 时全部保留。times 非递减
+    """
+    n = len(values)
+    if n <= max_points:
+        return np.arange(n)
+    buckets = max(1, max_points // 2)
+    span = float(times[-1] - times[0])
+    if span <= 0:
+        return bucket_minmax(values, np.zeros(n, dtype=np.int64))
+    bucket = np.floor((times - times[0]) * (buckets / span)).astype(np.int64)
+    return bucket_minmax(values, np.minimum(bucket, buckets - 1))
+
+
+def bucket_minmax(values: np.ndarray, bucket: np.ndarray) -> np.ndarray:
+    """每个桶保留最小值和最大值各一个点，返回下标（升序）；bucket 为各点的桶号，非递减"""
+    n = len(values)
+    if n == 0:
+        return np.arange(0)
+    # 桶内按值排序：每桶第一个为最小值，最后一个为最大值
+    order = np.lexsort((values, bucket))
+    ends = np.flatnonzero(np.diff(bucket[order])) + 1
+    first = order[np.concatenate([[0], ends])]
+    last = order[np.concatenate([ends - 1, [n - 1]])]
+    return np.unique(np.concatenate([first, last]))
+
+
+def even_indices(n: int, max_points: int) -> np.ndarray:
+    """在 [0, n) 内均匀取不超过 max_points 个下标，覆盖首尾"""
+    if n <= max_points:
+        return np.arange(n)
+    return np.unique(np.linspace(0, n - 1, max_points).round().astype(int))
+
+
+def pitch_curve(times: np.ndarray, frequencies: np.ndarray, cents_off: np.ndarray,
+                max_points: int = MAX_CURVE_POINTS) -> list[dict]:
+    """
+    有声帧的时间、频率、音分偏差降采样后生成音准曲线，只为保留的点计算音名
+
+    按时间分桶取频率的峰谷，与流式分析的候选点同一口径，三个数组一一对应
+    """
+    if len(frequencies) == 0:
+        return []
+    keep = minmax_indices(times, frequencies, max_points)
+    frequencies = frequencies[keep]
+    notes = librosa.hz_to_note(frequencies)
+    return [
+        {"time": t, "frequency": f, "note": str(note), "cents_off": c}
+        for t, f, note, c in zip(
+            np.round(times[keep], 2).tolist(),
+            np.round(frequencies, 1).tolist(),
+            notes,
+            np.round(cents_off[keep], 1).tolist(),
+        )
+    ]
+
+
+def beat_points(onset_times: np.ndarray, max_points: int = MAX_BEATS) -> list[dict]:
+    """起始点均匀抽取为节拍点，覆盖整首曲子而不只是开头"""
+    onset_times = np.asarray(onset_times, dtype=np.float64)
+    keep = even_indices(len(onset_times), max_points)
+    return [{"time": t} for t in np.round(onset_times[keep], 2).tolist()]
@@ -0,0 +1,128 @@
+"""
+紧凑响应编码 - 音准曲线、节拍点、手部关键点打包为定长整数数组，减小移动网络下的响应体积
+
+评分、问题列表等其余字段保持普通 JSON，只替换三组序列：
+    "pitchCurve":    {"count": n, "time": A, "frequency": A, "midi": A, "centsOff": A}
+    "beatAlignment": {"count": n, "time": A}
+    "handPoints":    {"count": n, "landmarks": 21, "frameIndex": A, "hand": A,
+                      "xyz": A（n × 21 × 3，按行展开）, "time": A（仅自适应抽帧）}
+每个数组 A = {"dtype": "uint32", "scale": 1000, "data": ...}，小端序，
+原值 = 整数 / scale；packed 编码中 data 为 base64 字符串，msgpack 编码中为二进制
+
+音名不逐点传字符串，由 midi 还原（60 = C4）
+"""
+import base64
+from typing import Optional
+
+import numpy as np
+
+# MessagePack 作为可选依赖
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+ENCODINGS = ("json", "packed", "msgpack")
+
+MSGPACK_MEDIA_TYPES = ("application/msgpack", "application/x-msgpack")
+
+# 各序列字段：(名称, numpy dtype, 量化倍数)
+PITCH_FIELDS = (
+    ("time", "<u4", 1000),          # 毫秒
+    ("frequency", "<u2", 10),       # 0.1 Hz，音高上限 C7 远小于 6553 Hz
+    ("centsOff", "<i2", 10),        # 0.1 音分
+)
+LANDMARK_SCALE = 10000              # 关键点坐标保留 4 位小数，与 JSON 输出一致
+
+_DTYPE_NAMES = {"<u1": "uint8", "<i1": "int8", "<u2": "uint16", "<i2": "int16", "<u4": "uint32"}
+
+_NOTE_STEPS = {"C": 0, "D": 2, "E": 4, "F": 5, "G": 7, "A": 9, "B": 11}
+_ACCIDENTALS = {"♯": 1, "#": 1, "♭": -1, "b": -1}
+
+
+def negotiate(encoding: str = "", accept: str = "") -> str:
+    """
+    确定响应编码：显式参数优先，其次 Accept 头（application/msgpack），默认 json
+
+    显式请求 msgpack 但服务器未安装时抛出 ValueError
+    """
+    if not encoding:
+        wants_msgpack = any(t in (accept or "") for t in MSGPACK_MEDIA_TYPES)
+        encoding = "msgpack" if wants_msgpack and msgpack is not None else "json"
+    if encoding not in ENCODINGS:
+        raise ValueError(f"不支持的响应编码: {encoding}")
+    if encoding == "msgpack" and msgpack is None:
+        raise ValueError("服务器未安装 msgpack，请使用 packed 编码")
+    return encoding
+
+
+def encode_result(result: Optional[dict], encoding: str) -> Optional[dict]:
+    """把分析结果中的序列字段替换为紧凑数组（json 编码或无结果时原样返回）"""
+    if encoding == "json" or not result:
+        return result
+    binary = encoding == "msgpack"
+    encoded = dict(result)
+    if isinstance(result.get("pitchCurve"), list):
+        encoded["pitchCurve"] = _pack_pitch_curve(result["pitchCurve"], binary)
+    if isinstance(result.get("beatAlignment"), list):
+        encoded["beatAlignment"] = _pack_beats(result["beatAlignment"], binary)
+    if isinstance(result.get("handPoints"), list):
+        encoded["handPoints"] = _pack_hand_points(result["handPoints"], binary)
+    return encoded
+
+
+def dumps_msgpack(content) -> bytes:
+    return msgpack.packb(content, use_bin_type=True)
+
+
+def _array(values, dtype: str, scale: int, binary: bool) -> dict:
+    # 超出整数范围的值截断，不回绕
+    limits = np.iinfo(dtype)
+    scaled = np.round(np.asarray(values, dtype=np.float64) * scale)
+    data = np.clip(scaled, limits.min, limits.max).astype(dtype).tobytes()
+    return {
+        "dtype": _DTYPE_NAMES[dtype],
+        "scale": scale,
+        "data": data if binary else base64.b64encode(data).decode("ascii"),
+    }
+
+
+def _pack_pitch_curve(curve: list, binary: bool) -> dict:
+    packed = {"count": len(curve)}
+    for name, dtype, scale in PITCH_FIELDS:
+        key = "cents_off" if name == "centsOff" else name
+        packed[name] = _array([p[key] for p in curve], dtype, scale, binary)
+    packed["midi"] = _array([note_to_midi(p["note"]) for p in curve], "<u1", 1, binary)
+    return packed
+
+
+def _pack_beats(beats: list, binary: bool) -> dict:
+    return {"count": len(beats), "time": _array([b["time"] for b in beats], "<u4", 1000, binary)}
+
+
+def _pack_hand_points(samples: list, binary: bool) -> dict:
+    hands = {"Left": 0, "Right": 1}
+    xyz = [[(p["x"], p["y"], p["z"]) for p in s["landmarks"]] for s in samples]
+    packed = {
+        "count": len(samples),
+        "landmarks": len(xyz[0]) if xyz else 0,
+        "frameIndex": _array([s["frameIndex"] for s in samples], "<u4", 1, binary),
+        "hand": _array([hands.get(s["hand"], -1) for s in samples], "<i1", 1, binary),
+        "xyz": _array(xyz, "<i2", LANDMARK_SCALE, binary),
+    }
+    if samples and all("time" in s for s in samples):
+        packed["time"] = _array([s["time"] for s in samples], "<u4", 1000, binary)
+    return packed
+
+
+def note_to_midi(note: str) -> int:
+    """librosa 音名（如 "C♯4"、"A4"、"B-1"）转 MIDI 音符编号，无法解析时为 0"""
+    try:
+        step = _NOTE_STEPS[note[0].upper()]
+        i = 1
+        while i < len(note) and note[i] in _ACCIDENTALS:
+            step += _ACCIDENTALS[note[i]]
+            i += 1
+        return min(127, max(0, (int(note[i:]) + 1) * 12 + step))
+    except (IndexError, KeyError, ValueError):
+        return 0
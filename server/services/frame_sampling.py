@@ -0,0 +1,93 @@
+"""
+自适应抽帧 - 按音符起始点和画面运动量挑选需要做手部分析的帧
+"""
+import bisect
+import logging
+from typing import Iterable
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# 拨弦动作在声音起始点之后略有延迟，取起始点后这么久的画面（秒）
+PLUCK_OFFSET = 0.05
+
+# 无起始点、无运动的慢段落也至少每隔这么久取一帧（秒）
+MAX_GAP_SECONDS = 4.0
+
+# 两个选中帧的最小间隔（秒），避免同一动作重复检测
+MIN_GAP_SECONDS = 0.15
+
+
+def motion_scores(frames: Iterable[np.ndarray]) -> np.ndarray:
+    """
+    低分辨率灰度帧的相邻帧平均绝对差（0-255），第一帧为 0
+
+    frames 可以是生成器，只保留上一帧
+    """
+    scores = []
+    prev = None
+    for frame in frames:
+        current = frame.astype(np.int16)
+        scores.append(0.0 if prev is None else float(np.mean(np.abs(current - prev))))
+        prev = current
+    return np.asarray(scores, dtype=np.float32)
+
+
+def select_frame_times(duration: float, onset_times: np.ndarray, motion: np.ndarray,
+                       motion_fps: float, budget: int, native_fps: float = 0.0) -> list[float]:
+    """
+    在帧数预算内挑选手部分析的时间点（秒，升序）
+
+    优先级：
+    1. 覆盖帧：每 MAX_GAP_SECONDS 一帧，保证慢段落也有手型样本（最多占预算的 1/4）
+    2. 起始点帧：音符起始点后 PLUCK_OFFSET，按该时刻运动量从大到小
+    3. 运动峰值帧：运动量高于中位数的局部极大值
+    """
+    if duration <= 0 or budget <= 0:
+        return []
+
+    # 间隔至少一帧，保证 select 滤镜的时间窗口互不重叠
+    frame_gap = 1.0 / native_fps if native_fps > 0 else 0.0
+    min_gap = max(MIN_GAP_SECONDS, frame_gap)
+    last_time = max(0.0, duration - max(frame_gap, 0.05))
+
+    motion = np.asarray(motion, dtype=np.float32)
+    motion_times = np.arange(len(motion)) / motion_fps if motion_fps > 0 else np.zeros(0)
+    peak = float(motion.max()) if len(motion) and motion.max() > 0 else 1.0
+
+    def motion_at(times: np.ndarray) -> np.ndarray:
+        if len(motion) == 0:
+            return np.zeros(len(times))
+        return np.interp(times, motion_times, motion) / peak
+
+    coverage = np.arange(MAX_GAP_SECONDS / 2, duration, MAX_GAP_SECONDS)[:max(1, budget // 4)]
+
+    onsets = np.clip(np.asarray(onset_times, dtype=np.float64) + PLUCK_OFFSET, 0, last_time)
+    onset_order = np.argsort(-motion_at(onsets), kind="stable")
+
+    peaks = np.zeros(0)
+    if len(motion) >= 3:
+        is_peak = (motion[1:-1] >= motion[:-2]) & (motion[1:-1] > motion[2:]) \
+            & (motion[1:-1] > np.median(motion))
+        peak_idx = np.flatnonzero(is_peak) + 1
+        peak_idx = peak_idx[np.argsort(-motion[peak_idx], kind="stable")]
+        peaks = motion_times[peak_idx]
+
+    candidates = np.concatenate([coverage, onsets[onset_order], peaks])
+    selected = []
+    for t in np.clip(candidates, 0, last_time).tolist():
+        if len(selected) >= budget:
+            break
+        i = bisect.bisect_left(selected, t)
+        if i > 0 and t - selected[i - 1] < min_gap:
+            continue
+        if i < len(selected) and selected[i] - t < min_gap:
+            continue
+        selected.insert(i, t)
+
+    logger.info(
+        f"自适应抽帧: {len(selected)}/{budget} 帧, 起始点 {len(onsets)} 个, "
+        f"运动峰值 {len(peaks)} 个"
+    )
+    return [round(t, 3) for t in selected]
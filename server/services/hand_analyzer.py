@@ -2,30 +2,159 @@
 手部分析服务 - 基于 MediaPipe Hands 的手型检测与评估
 """
 import numpy as np
-import math
 import logging
+import queue
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Iterable
+
+from config import HAND_DETECTOR_MODE
+from services.cancel import AnalysisCancelled, current_cancel
+from services.metrics import record, span
 
 logger = logging.getLogger(__name__)
 
-# MediaPipe 和 OpenCV 作为可选依赖
-try:
-    import mediapipe as mp
-    import cv2
+# MediaPipe 和 OpenCV 作为可选依赖，导入要数秒，首次使用时才加载
+mp_hands = None
+cv2 = None
+
+
+@lru_cache(maxsize=None)
+def mediapipe_available() -> bool:
+    """加载 MediaPipe 与 OpenCV，返回是否可用（只尝试一次）"""
+    global mp_hands, cv2
+    try:
+        import mediapipe as mp
+        import cv2 as opencv
+    except ImportError as e:
+        logger.warning(f"MediaPipe 不可用，手部分析将返回降级结果: {e}")
+        return False
+    except RuntimeError as e:
+        logger.warning(f"MediaPipe 运行时错误，手部分析将返回降级结果: {e}")
+        return False
     mp_hands = mp.solutions.hands
-    MEDIAPIPE_AVAILABLE = True
+    cv2 = opencv
     logger.info("MediaPipe 加载成功")
-except ImportError as e:
-    MEDIAPIPE_AVAILABLE = False
-    logger.warning(f"MediaPipe 不可用，手部分析将返回降级结果: {e}")
-except RuntimeError as e:
-    MEDIAPIPE_AVAILABLE = False
-    logger.warning(f"MediaPipe 运行时错误，手部分析将返回降级结果: {e}")
+    return True
+
+
+HAND_DETECTOR_MODES = ("static", "tracking")
+
+# 每帧最多检测的手数（与检测器 max_num_hands 一致）
+MAX_HANDS = 2
+NUM_LANDMARKS = 21
+
+# 前端展示的关键点：每 HAND_POINTS_EVERY 帧采样一次，最多 MAX_HAND_POINTS 条
+HAND_POINTS_EVERY = 10
+MAX_HAND_POINTS = 20
+
+HANDEDNESS_LABELS = ("Left", "Right")
+
+FINGER_NAMES = ("thumb", "index", "middle", "ring", "pinky")
+JOINT_NAMES = ("dip", "pip", "mcp")
+
+# 手指关节索引: [指尖, DIP, PIP, MCP]，MCP 角度以腕部（0）为第三点
+FINGER_JOINTS = np.array([
+    [4, 3, 2, 1],
+    [8, 7, 6, 5],
+    [12, 11, 10, 9],
+    [16, 15, 14, 13],
+    [20, 19, 18, 17],
+])
+WRIST = 0
+
+# DIP 关节理想角度范围
+DIP_IDEAL = {
+    "thumb": (130, 160),
+    "index": (140, 170),
+    "middle": (140, 170),
+    "ring": (140, 170),
+    "pinky": (140, 170),
+}
+
+# PIP 关节理想角度范围（大指不计）
+PIP_IDEAL = (110, 160)
+
+
+class HandDetectorPool:
+    """
+    预热的 MediaPipe Hands 检测器池
 
+    - static:   static_image_mode=True，每帧都做完整的手掌检测
+    - tracking: static_image_mode=False，连续帧用上一帧关键点跟踪，
+                跟踪置信度不足时才重新检测
+    检测器常驻进程内复用，避免每次请求重新加载 TFLite 模型
+    """
 
-def analyze_hands(frame_paths: list[str]) -> dict:
+    def __init__(self):
+        self._idle = {mode: queue.SimpleQueue() for mode in HAND_DETECTOR_MODES}
+
+    def warm_up(self, modes: Iterable[str] = HAND_DETECTOR_MODES):
+        """为每种模式创建一个检测器，并处理一帧空白画面完成图初始化"""
+        if not mediapipe_available():
+            return
+        blank = np.zeros((256, 256, 3), dtype=np.uint8)
+        for mode in modes:
+            with self.acquire(mode) as hands:
+                hands.process(blank)
+        logger.info(f"MediaPipe 检测器预热完成: {', '.join(modes)}")
+
+    @contextmanager
+    def acquire(self, mode: str):
+        """取出一个检测器，用完归还；tracking 模式归还前重置跟踪状态"""
+        if mode not in HAND_DETECTOR_MODES:
+            raise ValueError(f"未知的手部检测模式: {mode}")
+        try:
+            hands = self._idle[mode].get_nowait()
+        except queue.Empty:
+            hands = self._create(mode)
+
+        try:
+            yield hands
+        except AnalysisCancelled:
+            # 取消或超过截止时间不是检测器的问题，归还继续复用，不必重新加载模型
+            self._release(mode, hands)
+            raise
+        except BaseException:
+            hands.close()
+            raise
+        self._release(mode, hands)
+
+    def _release(self, mode: str, hands):
+        if mode == "tracking":
+            # 清除上一段视频的跟踪状态
+            hands.reset()
+        self._idle[mode].put(hands)
+
+    def _create(self, mode: str):
+        return mp_hands.Hands(
+            static_image_mode=(mode == "static"),
+            max_num_hands=MAX_HANDS,
+            min_detection_confidence=0.5,
+            min_tracking_confidence=0.5,
+        )
+
+
+detector_pool = HandDetectorPool()
+
+
+def warm_up_detectors():
+    """分析进程启动时调用，提前加载模型"""
+    detector_pool.warm_up()
+
+
+def analyze_hands(frames: Iterable, mode: str = None, expected_frames: int = 0,
+                  frame_times: list = None) -> dict:
     """
     分析多帧图片中的手部姿态
 
+    参数:
+        frames:          RGB 画面数组（height, width, 3）或图片路径组成的序列，可以是生成器
+        mode:            检测器模式 static / tracking，默认取配置
+        expected_frames: 预计帧数，用于预分配关键点数组（不足时自动扩容）
+        frame_times:     各帧的时间（秒），给定时 handPoints 附带 "time"（自适应抽帧）
+
     返回:
         {
             "handDetected": bool,
@@ -33,24 +162,21 @@ def analyze_hands(frame_paths: list[str]) -> dict:
             "detectedFrames": int,
             "overallScore": int,
             "issues": [...],
-            "handPoints": [...]     # 关键帧的手部关键点
+            "handPoints": [...],    # 关键帧的手部关键点
+            "fingerAngles": {...},  # 各手指 DIP/PIP/MCP 平均角度
+            "detectorMode": str,
+            "avgFrameMs": float     # 每帧检测耗时
         }
     """
-    if not frame_paths:
+    mode = mode or HAND_DETECTOR_MODE
+    if not mediapipe_available():
+        # 仍需消费完所有帧，避免上游解码阻塞
+        frame_count = sum(1 for _ in frames)
+        if frame_count == 0:
+            return _no_frames_result()
         return {
             "handDetected": False,
-            "frameCount": 0,
-            "detectedFrames": 0,
-            "overallScore": 0,
-            "issues": [{"severity": "error", "title": "无视频帧",
-                        "description": "未提取到视频帧", "suggestion": "请重新录制视频"}],
-            "handPoints": []
-        }
-
-    if not MEDIAPIPE_AVAILABLE:
-        return {
-            "handDetected": False,
-            "frameCount": len(frame_paths),
+            "frameCount": frame_count,
             "detectedFrames": 0,
             "overallScore": 0,
             "issues": [{"severity": "info", "title": "手部分析暂不可用",
@@ -59,62 +185,53 @@ def analyze_hands(frame_paths: list[str]) -> dict:
             "handPoints": []
         }
 
-    all_issues = []
-    hand_points_samples = []
-    detected_count = 0
-    angle_records = []
-
-    with mp_hands.Hands(
-        static_image_mode=True,
-        max_num_hands=2,
-        min_detection_confidence=0.5
-    ) as hands:
-        for i, frame_path in enumerate(frame_paths):
-            img = cv2.imread(frame_path)
-            if img is None:
+    track = LandmarkTrack(expected_frames)
+    frame_count = 0
+    process_seconds = 0.0
+    processed = 0
+    cancel = current_cancel()
+
+    with detector_pool.acquire(mode) as hands:
+        for i, frame in enumerate(frames):
+            if cancel.stopped:
+                # 客户端已断开则中止；已过截止时间则只评估已检测的帧
+                cancel.check()
+                cancel.mark_incomplete("hands")
+                break
+            frame_count += 1
+            rgb = _to_rgb(frame)
+            if rgb is None:
                 continue
 
-            # BGR → RGB
-            rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+            start = time.perf_counter()
             results = hands.process(rgb)
+            process_seconds += time.perf_counter() - start
+            processed += 1
 
             if results.multi_hand_landmarks:
-                detected_count += 1
-
-                for hand_idx, hand_landmarks in enumerate(results.multi_hand_landmarks):
-                    # 提取关键点坐标
-                    landmarks = []
-                    for lm in hand_landmarks.landmark:
-                        landmarks.append({
-                            "x": round(lm.x, 4),
-                            "y": round(lm.y, 4),
-                            "z": round(lm.z, 4)
-                        })
-
-                    # 分析手指角度
-                    angles = _calculate_finger_angles(hand_landmarks)
-                    angle_records.append(angles)
-
-                    # 每 10 帧采样一次关键点用于前端展示
-                    if i % 10 == 0:
-                        handedness = "unknown"
-                        if results.multi_handedness:
-                            handedness = results.multi_handedness[hand_idx].classification[0].label
-                        hand_points_samples.append({
-                            "frameIndex": i,
-                            "hand": handedness,
-                            "landmarks": landmarks
-                        })
-
-    frame_count = len(frame_paths)
+                track.add(i, results)
+
+    if frame_count == 0:
+        return _no_frames_result()
+
+    record("hands.detect", process_seconds)
+    avg_frame_ms = round(process_seconds * 1000 / processed, 1) if processed else 0.0
+    logger.info(f"手部检测 [{mode}]: {processed} 帧, 平均 {avg_frame_ms}ms/帧")
+
+    landmarks, handedness = track.landmarks, track.handedness
+    detected = ~np.isnan(landmarks[:, :, 0, 0])
+    detected_count = int(detected.any(axis=1).sum())
     detection_rate = detected_count / frame_count if frame_count > 0 else 0
 
-    # 评估手型
-    if len(angle_records) > 0:
-        issues, angle_score = _evaluate_hand_form(angle_records)
-        all_issues.extend(issues)
-    else:
-        angle_score = 0
+    # 评估手型：所有检测到的手一次性计算关节角度
+    all_issues = []
+    with span("hands.angles"):
+        angles = finger_joint_angles(landmarks[detected])
+        if len(angles) > 0:
+            issues, angle_score = _evaluate_hand_form(angles)
+            all_issues.extend(issues)
+        else:
+            angle_score = 0
 
     # 检测率也影响评分
     if detection_rate < 0.3:
@@ -135,79 +252,189 @@ def analyze_hands(frame_paths: list[str]) -> dict:
         "detectedFrames": detected_count,
         "overallScore": overall,
         "issues": all_issues,
-        "handPoints": hand_points_samples[:20]  # 限制返回数量
+        "handPoints": _sample_hand_points(landmarks, handedness, detected, frame_times),
+        "fingerAngles": _average_angles(angles),
+        "detectorMode": mode,
+        "avgFrameMs": avg_frame_ms,
     }
 
 
-def _calculate_finger_angles(hand_landmarks) -> dict:
-    """计算各手指的弯曲角度"""
-    lm = hand_landmarks.landmark
+class LandmarkTrack:
+    """
+    按帧存放关键点的预分配数组
+
+    landmarks:  (frames, MAX_HANDS, 21, 3) float32，未检测到的手为 NaN
+    handedness: (frames, MAX_HANDS) int8，0=Left 1=Right -1=未知
+    """
+
+    def __init__(self, capacity: int = 0):
+        capacity = max(16, capacity)
+        self._landmarks = np.full((capacity, MAX_HANDS, NUM_LANDMARKS, 3), np.nan, dtype=np.float32)
+        self._handedness = np.full((capacity, MAX_HANDS), -1, dtype=np.int8)
+        self.frames = 0
+
+    @property
+    def landmarks(self) -> np.ndarray:
+        return self._landmarks[:self.frames]
+
+    @property
+    def handedness(self) -> np.ndarray:
+        return self._handedness[:self.frames]
+
+    def add(self, frame_index: int, results):
+        """写入一帧 MediaPipe 检测结果，frame_index 之前未写入的帧保持 NaN"""
+        if frame_index >= len(self._landmarks):
+            self._grow(frame_index + 1)
+        self.frames = max(self.frames, frame_index + 1)
+
+        for hand_idx, hand_landmarks in enumerate(results.multi_hand_landmarks[:MAX_HANDS]):
+            self._landmarks[frame_index, hand_idx] = [
+                (lm.x, lm.y, lm.z) for lm in hand_landmarks.landmark
+            ]
+            if results.multi_handedness:
+                label = results.multi_handedness[hand_idx].classification[0].label
+                if label in HANDEDNESS_LABELS:
+                    self._handedness[frame_index, hand_idx] = HANDEDNESS_LABELS.index(label)
+
+    def _grow(self, min_capacity: int):
+        capacity = max(min_capacity, len(self._landmarks) * 2)
+        landmarks = np.full((capacity, MAX_HANDS, NUM_LANDMARKS, 3), np.nan, dtype=np.float32)
+        handedness = np.full((capacity, MAX_HANDS), -1, dtype=np.int8)
+        landmarks[:len(self._landmarks)] = self._landmarks
+        handedness[:len(self._handedness)] = self._handedness
+        self._landmarks, self._handedness = landmarks, handedness
+
+
+def finger_joint_angles(landmarks: np.ndarray) -> np.ndarray:
+    """
+    一次计算所有手指的 DIP/PIP/MCP 关节角度（度）
 
-    # 手指关节索引: [指尖, DIP, PIP, MCP]
-    fingers = {
-        "thumb":  [4, 3, 2, 1],
-        "index":  [8, 7, 6, 5],
-        "middle": [12, 11, 10, 9],
-        "ring":   [16, 15, 14, 13],
-        "pinky":  [20, 19, 18, 17],
+    参数:
+        landmarks: (..., 21, 3) 关键点
+    返回:
+        (..., 5, 3) 角度，最后一维依次为 DIP、PIP、MCP
+    """
+    wrist = np.broadcast_to(landmarks[..., [WRIST], :], landmarks.shape[:-2] + (1, 3))
+    # 每根手指的关节链：指尖 → DIP → PIP → MCP → 腕部
+    chain = np.concatenate([
+        landmarks[..., FINGER_JOINTS.ravel(), :].reshape(landmarks.shape[:-2] + (5, 4, 3)),
+        np.broadcast_to(wrist[..., None, :, :], landmarks.shape[:-2] + (5, 1, 3)),
+    ], axis=-2)
+
+    # 第 k 个关节的角度由 chain[k] 与 chain[k+2] 相对 chain[k+1] 的夹角给出
+    v1 = chain[..., :3, :] - chain[..., 1:4, :]
+    v2 = chain[..., 2:5, :] - chain[..., 1:4, :]
+    cos_angle = np.sum(v1 * v2, axis=-1) / (
+        np.linalg.norm(v1, axis=-1) * np.linalg.norm(v2, axis=-1) + 1e-8
+    )
+    return np.degrees(np.arccos(np.clip(cos_angle, -1, 1)))
+
+
+def _sample_hand_points(landmarks: np.ndarray, handedness: np.ndarray,
+                        detected: np.ndarray, frame_times: list = None) -> list:
+    """只为采样帧构建关键点 JSON"""
+    frame_idx, hand_idx = np.nonzero(detected)
+    keep = frame_idx % HAND_POINTS_EVERY == 0
+    frame_idx, hand_idx = frame_idx[keep][:MAX_HAND_POINTS], hand_idx[keep][:MAX_HAND_POINTS]
+
+    samples = []
+    for i, h in zip(frame_idx.tolist(), hand_idx.tolist()):
+        label = handedness[i, h]
+        sample = {
+            "frameIndex": i,
+            "hand": HANDEDNESS_LABELS[label] if label >= 0 else "unknown",
+            "landmarks": [
+                {"x": x, "y": y, "z": z}
+                for x, y, z in np.round(landmarks[i, h].astype(np.float64), 4).tolist()
+            ],
+        }
+        if frame_times is not None and i < len(frame_times):
+            sample["time"] = frame_times[i]
+        samples.append(sample)
+    return samples
+
+
+def _average_angles(angles: np.ndarray) -> dict:
+    if len(angles) == 0:
+        return {}
+    avg = np.mean(angles, axis=0)
+    return {
+        finger: {joint: round(float(avg[f, j]), 1) for j, joint in enumerate(JOINT_NAMES)}
+        for f, finger in enumerate(FINGER_NAMES)
     }
 
-    angles = {}
-    for name, indices in fingers.items():
-        tip = np.array([lm[indices[0]].x, lm[indices[0]].y, lm[indices[0]].z])
-        dip = np.array([lm[indices[1]].x, lm[indices[1]].y, lm[indices[1]].z])
-        pip = np.array([lm[indices[2]].x, lm[indices[2]].y, lm[indices[2]].z])
 
-        # 计算 DIP 关节处的角度
-        v1 = tip - dip
-        v2 = pip - dip
-        cos_angle = np.dot(v1, v2) / (np.linalg.norm(v1) * np.linalg.norm(v2) + 1e-8)
-        angle = math.degrees(math.acos(np.clip(cos_angle, -1, 1)))
-        angles[name] = round(angle, 1)
+def _no_frames_result() -> dict:
+    return {
+        "handDetected": False,
+        "frameCount": 0,
+        "detectedFrames": 0,
+        "overallScore": 0,
+        "issues": [{"severity": "error", "title": "无视频帧",
+                    "description": "未提取到视频帧", "suggestion": "请重新录制视频"}],
+        "handPoints": []
+    }
 
-    return angles
 
+def _to_rgb(frame):
+    """图片路径读取后转为 RGB；数组视为已是 RGB 画面"""
+    if isinstance(frame, str):
+        img = cv2.imread(frame)
+        if img is None:
+            return None
+        # BGR → RGB
+        return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    return frame
 
-def _evaluate_hand_form(angle_records: list[dict]) -> tuple[list, int]:
-    """评估手型是否符合古筝演奏标准"""
-    issues = []
 
-    # 汇总各手指平均角度
-    finger_names = ["thumb", "index", "middle", "ring", "pinky"]
-    avg_angles = {}
-    for name in finger_names:
-        values = [r[name] for r in angle_records if name in r]
-        if values:
-            avg_angles[name] = np.mean(values)
+def _evaluate_hand_form(angles: np.ndarray) -> tuple[list, int]:
+    """
+    评估手型是否符合古筝演奏标准
 
+    参数:
+        angles: (n, 5, 3) 每只检测到的手的 DIP/PIP/MCP 角度
+    """
+    issues = []
+    avg_angles = np.mean(angles, axis=0)
     score = 100
 
     # 古筝演奏手型标准（简化版）：
-    # - 手指自然弯曲，DIP 关节角度约 140-170°
-    # - 大指角度约 130-160°
-    for name, avg in avg_angles.items():
-        if name == "thumb":
-            ideal_min, ideal_max = 130, 160
-        else:
-            ideal_min, ideal_max = 140, 170
-
-        if avg < ideal_min - 15:
+    # - 手指自然弯曲，DIP 关节角度约 140-170°，大指约 130-160°
+    # - PIP 关节保持弯曲（约 110-160°），伸直或折得过紧都会影响触弦
+    for f, name in enumerate(FINGER_NAMES):
+        finger = "大指" if name == "thumb" else _finger_cn(name)
+        dip, pip = avg_angles[f, 0], avg_angles[f, 1]
+        ideal_min, ideal_max = DIP_IDEAL[name]
+
+        if dip < ideal_min - 15:
             score -= 10
             issues.append({
                 "severity": "warning",
-                "title": f"{'大指' if name == 'thumb' else _finger_cn(name)}过度弯曲",
-                "description": f"平均角度 {avg:.0f}°，建议保持 {ideal_min}-{ideal_max}°",
+                "title": f"{finger}过度弯曲",
+                "description": f"平均角度 {dip:.0f}°，建议保持 {ideal_min}-{ideal_max}°",
                 "suggestion": "放松手指，保持自然弯曲的半握拳状态"
             })
-        elif avg > ideal_max + 15:
+        elif dip > ideal_max + 15:
             score -= 10
             issues.append({
                 "severity": "warning",
-                "title": f"{'大指' if name == 'thumb' else _finger_cn(name)}过于伸直",
-                "description": f"平均角度 {avg:.0f}°，建议保持 {ideal_min}-{ideal_max}°",
+                "title": f"{finger}过于伸直",
+                "description": f"平均角度 {dip:.0f}°，建议保持 {ideal_min}-{ideal_max}°",
                 "suggestion": "手指应自然弯曲，避免僵直"
             })
 
+        if name == "thumb":
+            continue
+        pip_min, pip_max = PIP_IDEAL
+        if pip < pip_min - 15 or pip > pip_max + 15:
+            score -= 5
+            issues.append({
+                "severity": "info",
+                "title": f"{finger}第二关节{'弯曲过紧' if pip < pip_min else '伸直'}",
+                "description": f"第二关节平均角度 {pip:.0f}°，建议保持 {pip_min}-{pip_max}°",
+                "suggestion": "以掌关节带动发力，第二关节保持自然弧度"
+            })
+
     score = max(0, min(100, score))
     return issues, score
 
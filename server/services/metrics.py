@@ -0,0 +1,194 @@
+"""
+耗时统计 - 分阶段计时（span）与 Prometheus 文本格式的指标导出
+
+计时：
+    timings = Timings()
+    with use_timings(timings):
+        with span("audio.pitch"):
+            ...
+    timings.to_dict()   # {"audio.pitch": 1.234, ...}（秒，同名阶段累加）
+
+当前 Timings 通过 contextvars 传递，未设置时 span 不做任何记录；
+新线程不继承上下文，需用 bind() 包装线程函数
+"""
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from typing import Callable, Optional
+
+_current: contextvars.ContextVar[Optional["Timings"]] = contextvars.ContextVar(
+    "timings", default=None
+)
+
+
+class Timings:
+    """一次请求内各阶段的累计耗时，线程安全"""
+
+    def __init__(self):
+        self._seconds: dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def add(self, name: str, seconds: float):
+        with self._lock:
+            self._seconds[name] = self._seconds.get(name, 0.0) + seconds
+
+    def update(self, timings: dict):
+        for name, seconds in timings.items():
+            self.add(name, seconds)
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {name: round(seconds, 3) for name, seconds in self._seconds.items()}
+
+
+@contextmanager
+def use_timings(timings: Timings):
+    """在当前上下文中启用计时"""
+    token = _current.set(timings)
+    try:
+        yield timings
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def span(name: str):
+    """记录代码块耗时到当前 Timings（未启用时为空操作）"""
+    timings = _current.get()
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(name, time.perf_counter() - start)
+
+
+def record(name: str, seconds: float):
+    """直接记录一段已测得的耗时（如跨线程、逐帧累加的阶段）"""
+    timings = _current.get()
+    if timings is not None:
+        timings.add(name, seconds)
+
+
+def bind(fn: Callable) -> Callable:
+    """把当前上下文（含 Timings）绑定到 fn，用于提交给线程执行"""
+    ctx = contextvars.copy_context()
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        return ctx.run(fn, *args, **kwargs)
+    return wrapper
+
+
+# ---- Prometheus 指标 ----
+
+# 阶段耗时直方图分桶（秒）
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+class Histogram:
+    """按标签值分组的累积直方图"""
+
+    def __init__(self, name: str, help_text: str, label: str,
+                 buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.buckets = tuple(sorted(buckets))
+        self._series: dict[str, list] = {}   # 标签值 -> [各桶计数..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, label_value: str, value: float):
+        with self._lock:
+            series = self._series.setdefault(label_value, [0] * len(self.buckets) + [0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for value, series in sorted(self._series.items()):
+                label = f'{self.label}="{_escape(value)}"'
+                for bound, count in zip(self.buckets, series):
+                    lines.append(f'{self.name}_bucket{{{label},le="{bound:g}"}} {count}')
+                lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {series[-1]}')
+                lines.append(f"{self.name}_sum{{{label}}} {series[-2]:.6f}")
+                lines.append(f"{self.name}_count{{{label}}} {series[-1]}")
+        return lines
+
+
+class Counter:
+    """按标签值分组的计数器"""
+
+    def __init__(self, name: str, help_text: str, label: str):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self._values: dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, label_value: str, amount: float = 1):
+        with self._lock:
+            self._values[label_value] = self._values.get(label_value, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for value, count in sorted(self._values.items()):
+                lines.append(f'{self.name}{{{self.label}="{_escape(value)}"}} {count:g}')
+        return lines
+
+
+class Gauge:
+    """取值时调用回调的瞬时指标"""
+
+    def __init__(self, name: str, help_text: str, fn: Callable[[], float]):
+        self.name = name
+        self.help_text = help_text
+        self.fn = fn
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge",
+                f"{self.name} {self.fn():g}"]
+
+
+class Registry:
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+registry = Registry()
+
+stage_seconds = registry.register(Histogram(
+    "guzheng_stage_seconds", "每个请求各分析阶段的耗时（秒）", "stage"
+))
+
+# 手部检测每帧耗时分桶（秒）
+HAND_FRAME_BUCKETS = (0.005, 0.01, 0.02, 0.05, 0.1, 0.25, 0.5, 1)
+
+hand_frame_seconds = registry.register(Histogram(
+    "guzheng_hand_frame_seconds", "每个视频手部检测的平均每帧耗时（秒）", "mode",
+    buckets=HAND_FRAME_BUCKETS,
+))
@@ -0,0 +1,402 @@
+"""
+分析流水线 - 在分析进程中执行视频的完整分析（音频 + 手型）
+"""
+import os
+import shutil
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from config import (
+    FRAME_FPS, FRAME_MAX_SIDE, FRAME_PREFETCH, PITCH_MODE, HAND_DETECTOR_MODE,
+    AUDIO_STREAMING, AUDIO_STREAMING_MIN_SECONDS, AUDIO_BLOCK_SECONDS,
+    FRAME_SAMPLING, FRAME_BUDGET, MOTION_FPS, MOTION_MAX_SIDE, ANALYSIS_SR,
+    RESUMABLE_EARLY_AUDIO_STALL,
+)
+from services.cancel import AnalysisCancelled, CancelToken, current_cancel, use_cancel
+from services.resumable import UPLOAD_ABORT_MARKER, UPLOAD_DONE_MARKER
+from services.video_processor import PrefixAudioDecoder, VideoDemuxer, probe_video
+from services.frame_sampling import motion_scores, select_frame_times
+from services.metrics import Timings, bind, span, use_timings
+
+# 音频分析（librosa/numba）与手部分析（MediaPipe）模块在函数内导入：
+# 服务进程导入本模块只为提交任务，不加载它们；分析进程在 init_worker 中预热
+
+logger = logging.getLogger(__name__)
+
+
+# 分析逻辑版本，评分算法变化时递增，使旧的缓存结果失效
+ANALYSIS_VERSION = 2
+
+# 分析分支失败时降级结果的问题标题
+AUDIO_FAILED_TITLE = "音频分析失败"
+HAND_FAILED_TITLE = "手部分析失败"
+
+
+def analysis_params(song_id: str = "") -> dict:
+    """影响分析结果的全部参数，用于结果缓存键"""
+    return {
+        "version": ANALYSIS_VERSION,
+        "fps": FRAME_FPS,
+        "frameMaxSide": FRAME_MAX_SIDE,
+        "pitchMode": PITCH_MODE,
+        "sampleRate": ANALYSIS_SR,
+        "handMode": HAND_DETECTOR_MODE,
+        "audioStreaming": AUDIO_STREAMING,
+        "frameSampling": FRAME_SAMPLING,
+        "frameBudget": FRAME_BUDGET if FRAME_SAMPLING == "adaptive" else 0,
+        "songId": song_id,
+    }
+
+
+def audio_analysis_params(song_id: str = "") -> dict:
+    """纯音频分析的结果缓存参数（与视频分析的缓存键不重叠）"""
+    return {
+        "kind": "audio",
+        "version": ANALYSIS_VERSION,
+        "pitchMode": PITCH_MODE,
+        "sampleRate": ANALYSIS_SR,
+        "songId": song_id,
+    }
+
+
+def init_worker():
+    """分析进程初始化：加载并预热常驻的手部检测器，完成音频分析的 numba JIT 编译"""
+    from services.hand_analyzer import warm_up_detectors
+    from services.warmup import warm_up_audio
+
+    warm_up_detectors()
+    try:
+        warm_up_audio(ANALYSIS_SR)
+    except Exception as e:
+        # 预热失败不影响进程可用，首个任务时再编译
+        logger.warning(f"音频分析预热失败: {e}")
+
+
+def init_audio_worker():
+    """纯音频分析进程初始化：只预热音频分析，不加载 MediaPipe"""
+    from services.warmup import warm_up_audio
+
+    try:
+        warm_up_audio(ANALYSIS_SR)
+    except Exception as e:
+        logger.warning(f"音频分析预热失败: {e}")
+
+
+def run_audio_analysis(task_id: str, audio: np.ndarray, song_id: str = "",
+                       cancel: CancelToken = None) -> dict:
+    """
+    纯音频分析（录音模式）：服务进程已把上传的压缩音频在内存中解码为 ANALYSIS_SR 的 PCM，
+    这里只做音准、节奏、力度分析（及参考演奏对比），不探测视频、不抽帧、不做手部分析；
+    cancel 同 run_video_analysis
+    """
+    from services.audio_analyzer import analyze_audio
+
+    cancel = cancel or CancelToken()
+    timings = Timings()
+    with use_timings(timings), use_cancel(cancel), span("analysis"):
+        _check_start(cancel)
+        audio_result = analyze_audio(audio, ANALYSIS_SR, song_id=song_id)
+    cancel.check()
+    logger.info(f"[{task_id}] 音频分析完成: {audio_result['duration']}s, "
+                f"综合 {audio_result.get('overallScore', 0)} 分")
+    result = {"taskId": task_id, **audio_result}
+    _mark_partial(task_id, result, cancel)
+    result["timings"] = timings.to_dict()
+    return result
+
+
+def _check_start(cancel: CancelToken):
+    """开始分析前：已取消或已过截止时间（排队太久）则不再分析"""
+    cancel.check()
+    if cancel.expired:
+        raise AnalysisCancelled("超过截止时间，未开始分析")
+
+
+def _mark_partial(task_id: str, result: dict, cancel: CancelToken):
+    """截止时间到达时被跳过或截断的阶段记入结果的 "partial"（此类结果不缓存）"""
+    if cancel.incomplete:
+        result["partial"] = sorted(cancel.incomplete)
+        logger.warning(f"[{task_id}] 超过截止时间，返回部分结果: {result['partial']}")
+
+
+def run_video_analysis(task_id: str, task_dir: str, song_id: str = "",
+                       info: dict = None, audio_result: dict = None,
+                       cancel: CancelToken = None) -> dict:
+    """
+    对任务目录中的 input.mp4 执行综合分析，完成后清理任务目录
+
+    该函数运行在分析进程池中，参数和返回值都必须可序列化；
+    info 为服务进程准入时已做的 probe_video 结果，省去再次探测；
+    audio_result 为上传过程中已完成的音频分析（run_prefix_audio），给定时只做手部分析；
+    cancel 为取消标记与截止时间（services/cancel.py）：客户端断开时抛出 AnalysisCancelled，
+    超过截止时间时终止解码、跳过未开始的阶段，返回已完成的部分（"partial" 列出被截断的阶段）
+    """
+    video_path = os.path.join(task_dir, "input.mp4")
+    cancel = cancel or CancelToken()
+    timings = Timings()
+    try:
+        with use_timings(timings), use_cancel(cancel), span("analysis"):
+            _check_start(cancel)
+            audio_result, hand_result, duration = _analyze(task_id, video_path, song_id, info,
+                                                           audio_result)
+        cancel.check()
+
+        # 5. 合并结果
+        all_issues = audio_result.get("issues", []) + hand_result.get("issues", [])
+
+        # 综合评分：音频 60% + 手型 40%
+        overall = int(
+            audio_result.get("overallScore", 0) * 0.6 +
+            hand_result.get("overallScore", 0) * 0.4
+        )
+
+        result = {
+            "taskId": task_id,
+            "duration": round(duration, 1),
+            "overallScore": overall,
+            "pitchAccuracy": audio_result.get("pitchAccuracy", 0),
+            "rhythmAccuracy": audio_result.get("rhythmAccuracy", 0),
+            "dynamics": audio_result.get("dynamics", 0),
+            "handScore": hand_result.get("overallScore", 0),
+            "handDetected": hand_result.get("handDetected", False),
+            "pitchCurve": audio_result.get("pitchCurve", []),
+            "beatAlignment": audio_result.get("beatAlignment", []),
+            "handPoints": hand_result.get("handPoints", []),
+            "fingerAngles": hand_result.get("fingerAngles", {}),
+            # 手部检测模式与每帧检测耗时（毫秒），服务进程据此记录 /metrics
+            "handDetectorMode": hand_result.get("detectorMode", ""),
+            "handFrameMs": hand_result.get("avgFrameMs", 0.0),
+            "issues": all_issues,
+        }
+        if "reference" in audio_result:
+            result["reference"] = audio_result["reference"]
+        _mark_partial(task_id, result, cancel)
+        # 各阶段耗时（秒），由服务进程决定是否返回给客户端
+        result["timings"] = timings.to_dict()
+        return result
+    finally:
+        # 清理临时文件
+        shutil.rmtree(task_dir, ignore_errors=True)
+
+
+def _analyze(task_id: str, video_path: str, song_id: str, info: dict = None,
+             audio_result: dict = None) -> tuple[dict, dict, float]:
+    """探测视频并按抽帧方式执行音频 + 手部分析，返回 (音频结果, 手部结果, 时长)"""
+    # 获取视频时长（与解码共用一次探测）
+    info = info or probe_video(video_path)
+    duration = info["duration"]
+    logger.info(f"[{task_id}] 视频时长: {duration:.1f}s")
+    streaming = use_audio_streaming(duration)
+    if audio_result is not None:
+        logger.info(f"[{task_id}] 使用上传过程中完成的音频分析")
+    elif streaming:
+        logger.info(f"[{task_id}] 使用流式音频分析")
+
+    if FRAME_SAMPLING == "adaptive" and info["hasVideo"]:
+        audio_result, hand_result = _analyze_adaptive(task_id, video_path, info, song_id, streaming,
+                                                      audio_result)
+    else:
+        audio_result, hand_result = _analyze_fixed(task_id, video_path, info, song_id, streaming,
+                                                   audio_result)
+    return audio_result, hand_result, duration
+
+
+def _analyze_fixed(task_id: str, video_path: str, info: dict, song_id: str,
+                   streaming: bool, audio_result: dict = None) -> tuple[dict, dict]:
+    """
+    按固定帧率抽帧：单次解码，音频分析与手部分析并行
+
+    手部分析线程边解码边消费画面；音频管道读完后立即开始音频评分，
+    不等待剩余画面的手部分析；已有音频结果时只解码画面
+    """
+    demuxer = VideoDemuxer(video_path, sr=ANALYSIS_SR, fps=FRAME_FPS, max_side=FRAME_MAX_SIDE,
+                           audio=audio_result is None, info=info)
+    if streaming and audio_result is None:
+        demuxer.stream_audio(int(AUDIO_BLOCK_SECONDS * ANALYSIS_SR))
+
+    with demuxer, ThreadPoolExecutor(max_workers=2) as executor:
+        frames = demuxer.iter_frames(prefetch=FRAME_PREFETCH)
+        expected_frames = int(demuxer.duration * FRAME_FPS) + 1
+        hand_future = executor.submit(bind(_run_hands), task_id, frames, expected_frames)
+        if audio_result is None:
+            audio_future = executor.submit(bind(_run_audio), task_id, demuxer, song_id, streaming)
+            audio_result = audio_future.result()
+        return audio_result, hand_future.result()
+
+
+def _analyze_adaptive(task_id: str, video_path: str, info: dict, song_id: str,
+                      streaming: bool, audio_result: dict = None) -> tuple[dict, dict]:
+    """
+    自适应抽帧：
+    1. 第一次解码输出音频和低分辨率灰度小图，音频分析与运动量计算并行
+       （已有音频结果时只解码小图）
+    2. 按音符起始点、运动峰值在 FRAME_BUDGET 内挑选时间点
+    3. 第二次解码只输出选中的帧做手部分析
+    """
+    demuxer = VideoDemuxer(video_path, sr=ANALYSIS_SR, fps=MOTION_FPS, max_side=MOTION_MAX_SIDE,
+                           audio=audio_result is None, gray=True, info=info)
+    if streaming and audio_result is None:
+        demuxer.stream_audio(int(AUDIO_BLOCK_SECONDS * ANALYSIS_SR))
+
+    with demuxer, ThreadPoolExecutor(max_workers=2) as executor:
+        frames = demuxer.iter_frames(prefetch=FRAME_PREFETCH)
+        motion_future = executor.submit(bind(_run_motion), task_id, frames)
+        if audio_result is None:
+            audio_future = executor.submit(bind(_run_audio), task_id, demuxer, song_id,
+                                           streaming, True)
+            audio_result = audio_future.result()
+        motion = motion_future.result()
+
+    onset_times = audio_result.pop("onsetTimes", [])
+    cancel = current_cancel()
+    if cancel.stopped:
+        # 已过截止时间：不再做第二遍解码
+        cancel.check()
+        cancel.mark_incomplete("hands")
+        return audio_result, _hands_skipped()
+    with span("frames.select"):
+        frame_times = select_frame_times(info["duration"], onset_times, motion, MOTION_FPS,
+                                         FRAME_BUDGET, info["fps"])
+
+    frames_demuxer = VideoDemuxer(video_path, max_side=FRAME_MAX_SIDE, audio=False,
+                                  frame_times=frame_times, info=info)
+    with frames_demuxer:
+        hand_result = _run_hands(task_id, frames_demuxer.iter_frames(), len(frame_times), frame_times)
+    return audio_result, hand_result
+
+
+def _hands_skipped() -> dict:
+    return {
+        "handDetected": False, "frameCount": 0, "detectedFrames": 0,
+        "overallScore": 0, "issues": [], "handPoints": [],
+    }
+
+
+def _run_motion(task_id: str, frames) -> np.ndarray:
+    """运动量计算，失败时返回空数组（只按起始点和覆盖帧抽帧）"""
+    try:
+        with span("frames.motion"):
+            return motion_scores(frames)
+    except Exception as e:
+        logger.error(f"[{task_id}] 运动量计算失败: {e}")
+        return np.zeros(0, dtype=np.float32)
+    finally:
+        for _ in frames:
+            pass
+
+
+def run_prefix_audio(task_id: str, task_dir: str) -> dict:
+    """
+    上传过程中对已收到的部分做流式音频分析，上传完成后返回音频结果（含 onsetTimes）
+
+    该函数运行在分析进程池中，等待数据期间占用一个分析进程；不清理任务目录，
+    结果交给随后提交的 run_video_analysis(audio_result=...)。
+    RESUMABLE_EARLY_AUDIO_STALL 秒收不到新数据时放弃（任务失败），释放分析进程，
+    finalize 时改为完整分析
+    """
+    from services.audio_stream import analyze_audio_stream
+
+    timings = Timings()
+    decoder = PrefixAudioDecoder(
+        os.path.join(task_dir, "input.mp4"), ANALYSIS_SR,
+        done_path=os.path.join(task_dir, UPLOAD_DONE_MARKER),
+        abort_path=os.path.join(task_dir, UPLOAD_ABORT_MARKER),
+        stall_timeout=RESUMABLE_EARLY_AUDIO_STALL,
+    )
+    with use_timings(timings), decoder:
+        blocks = decoder.iter_audio(int(AUDIO_BLOCK_SECONDS * ANALYSIS_SR))
+        audio_result = analyze_audio_stream(blocks, ANALYSIS_SR, with_onsets=True)
+    logger.info(f"[{task_id}] 上传期间音频分析完成: 综合 {audio_result.get('overallScore', 0)} 分")
+    audio_result["timings"] = timings.to_dict()
+    return audio_result
+
+
+def use_audio_streaming(duration: float) -> bool:
+    """是否对该时长的录音使用分块流式音频分析"""
+    if AUDIO_STREAMING == "on":
+        return True
+    if AUDIO_STREAMING == "off":
+        return False
+    return duration >= AUDIO_STREAMING_MIN_SECONDS
+
+
+def _run_audio(task_id: str, demuxer: VideoDemuxer, song_id: str, streaming: bool = False,
+               with_onsets: bool = False) -> dict:
+    """音频分析，失败时返回降级结果"""
+    if streaming:
+        return _run_audio_stream(task_id, demuxer, with_onsets)
+    from services.audio_analyzer import analyze_audio
+    try:
+        audio = demuxer.read_audio()
+        logger.info(f"[{task_id}] 音频解码完成: {len(audio) / demuxer.sr:.1f}s")
+        audio_result = analyze_audio(audio, demuxer.sr, song_id=song_id, with_onsets=with_onsets)
+        logger.info(f"[{task_id}] 音频分析完成: 综合 {audio_result.get('overallScore', 0)} 分")
+        return audio_result
+    except AnalysisCancelled:
+        raise
+    except Exception as e:
+        logger.error(f"[{task_id}] 音频分析失败: {e}")
+        return _audio_failed(e)
+
+
+def _audio_failed(error: Exception) -> dict:
+    return {
+        "pitchAccuracy": 0, "rhythmAccuracy": 0, "dynamics": 0,
+        "overallScore": 0, "pitchCurve": [], "beatAlignment": [],
+        "issues": [{"severity": "error", "title": AUDIO_FAILED_TITLE,
+                   "description": str(error), "suggestion": "请重新录制"}]
+    }
+
+
+def _run_audio_stream(task_id: str, demuxer: VideoDemuxer, with_onsets: bool = False) -> dict:
+    """流式音频分析（不做参考演奏对比），失败时返回降级结果"""
+    from services.audio_stream import analyze_audio_stream
+    blocks = demuxer.iter_audio()
+    try:
+        audio_result = analyze_audio_stream(blocks, demuxer.sr, with_onsets=with_onsets)
+        logger.info(f"[{task_id}] 流式音频分析完成: 综合 {audio_result.get('overallScore', 0)} 分")
+        return audio_result
+    except AnalysisCancelled:
+        raise
+    except Exception as e:
+        logger.error(f"[{task_id}] 音频分析失败: {e}")
+        return _audio_failed(e)
+    finally:
+        # 与手部分支相同：提前结束时读空剩余音频块
+        for _ in blocks:
+            pass
+
+
+def _run_hands(task_id: str, frames, expected_frames: int = 0, frame_times: list = None) -> dict:
+    """手部分析，失败时返回降级结果"""
+    from services.hand_analyzer import analyze_hands
+    try:
+        hand_result = analyze_hands(frames, expected_frames=expected_frames, frame_times=frame_times)
+        logger.info(f"[{task_id}] 手部分析完成: {hand_result.get('overallScore', 0)} 分")
+        return hand_result
+    except AnalysisCancelled:
+        raise
+    except Exception as e:
+        logger.error(f"[{task_id}] 手部分析失败: {e}")
+        return {
+            "handDetected": False, "frameCount": 0, "detectedFrames": 0,
+            "overallScore": 0, "issues": [{"severity": "error", "title": HAND_FAILED_TITLE,
+                                            "description": str(e), "suggestion": "请重新录制"}],
+            "handPoints": []
+        }
+    finally:
+        # 手部分析提前结束时继续消费剩余画面，避免 ffmpeg 阻塞导致音频管道读不完
+        for _ in frames:
+            pass
+
+
+def is_complete(result: dict) -> bool:
+    """结果是否来自完整分析（没有任何分支降级，也没有被截止时间截断）"""
+    if result.get("partial"):
+        return False
+    return not any(
+        issue.get("title") in (AUDIO_FAILED_TITLE, HAND_FAILED_TITLE)
+        for issue in result.get("issues", [])
+    )
@@ -0,0 +1,152 @@
+"""
+音高检测 - 可选 pyin（精确）或向量化 YIN（快速）两种模式
+"""
+import logging
+
+import librosa
+import numpy as np
+
+from config import PITCH_MODE
+
+logger = logging.getLogger(__name__)
+
+PITCH_MODES = ("accurate", "fast")
+
+# 帧移 512 @ 44.1kHz（pyin 默认值），其他采样率与快速模式保持相同的时间分辨率
+HOP_SECONDS = 512 / 44100
+
+# 快速模式：21 弦古筝音域 D2-D6，上下各留一点余量以覆盖按音/滑音
+FAST_FMIN = librosa.note_to_hz("C#2")
+FAST_FMAX = librosa.note_to_hz("E6")
+FAST_SR = 11025
+FAST_FRAME_LENGTH = 512
+FAST_THRESHOLD = 0.15
+# 每批处理的帧数，限制 FFT 中间结果的内存
+FAST_BATCH_FRAMES = 2048
+
+
+def frame_sizes(sr: int) -> tuple[int, int]:
+    """(n_fft, hop_length)：44.1kHz 时为 2048 / 512，其他采样率按时长等比缩放"""
+    hop_length = max(1, int(round(HOP_SECONDS * sr)))
+    return hop_length * 4, hop_length
+
+
+def track_pitch(y: np.ndarray, sr: int, mode: str = None, center: bool = True) -> tuple:
+    """
+    逐帧基频检测
+
+    center=False 时不做首尾填充，第 k 帧覆盖 y[k*hop : k*hop + frame_length]，
+    用于分块流式分析（帧与 frame_sizes(sr) 的 STFT 帧对齐）
+
+    返回:
+        (f0, voiced_flag, voiced_prob, times)，f0 在无声帧为 NaN
+    """
+    mode = mode or PITCH_MODE
+    if mode == "accurate":
+        return _track_pyin(y, sr, center)
+    if mode == "fast":
+        return _track_yin(y, sr, center)
+    raise ValueError(f"未知的音高检测模式: {mode}")
+
+
+def _track_pyin(y: np.ndarray, sr: int, center: bool = True) -> tuple:
+    """精确模式 - librosa.pyin（适合单音乐器），帧长 / 帧移随采样率缩放"""
+    frame_length, hop_length = frame_sizes(sr)
+    f0, voiced_flag, voiced_probs = librosa.pyin(
+        y, fmin=librosa.note_to_hz("C2"),
+        fmax=librosa.note_to_hz("C7"),
+        sr=sr, frame_length=frame_length, hop_length=hop_length, center=center
+    )
+    times = librosa.times_like(f0, sr=sr, hop_length=hop_length)
+    return f0, voiced_flag, voiced_probs, times
+
+
+def _track_yin(y: np.ndarray, sr: int, center: bool = True) -> tuple:
+    """
+    快速模式 - 降采样后批量计算 YIN
+
+    - 先降采样到 FAST_SR，音域限制在古筝实际范围
+    - 差分函数通过批量 FFT 自相关一次算出，无逐帧 Python 循环
+    - 累积均值归一化差分低于阈值的第一个局部极小值为周期，抛物线插值细化
+    """
+    if sr != FAST_SR:
+        y = librosa.resample(y, orig_sr=sr, target_sr=FAST_SR)
+    sr = FAST_SR
+
+    frame_length = FAST_FRAME_LENGTH
+    hop_length = max(1, int(round(HOP_SECONDS * sr)))
+    min_period = max(2, int(np.floor(sr / FAST_FMAX)))
+    max_period = int(np.ceil(sr / FAST_FMIN))
+    win_length = frame_length - max_period - 1
+
+    # 与 pyin 一致：帧中心对齐到 t * hop
+    y = np.asarray(y, dtype=np.float32)
+    if center:
+        y = np.pad(y, frame_length // 2)
+    if len(y) < frame_length:
+        y = np.pad(y, (0, frame_length - len(y)))
+    frames = librosa.util.frame(y, frame_length=frame_length, hop_length=hop_length, axis=0)
+
+    n_frames = frames.shape[0]
+    f0 = np.full(n_frames, np.nan, dtype=np.float64)
+    voiced_flag = np.zeros(n_frames, dtype=bool)
+    voiced_prob = np.zeros(n_frames, dtype=np.float64)
+
+    for start in range(0, n_frames, FAST_BATCH_FRAMES):
+        batch = frames[start:start + FAST_BATCH_FRAMES]
+        f0_b, voiced_b, prob_b = _yin_batch(batch, sr, win_length, min_period, max_period)
+        f0[start:start + len(batch)] = f0_b
+        voiced_flag[start:start + len(batch)] = voiced_b
+        voiced_prob[start:start + len(batch)] = prob_b
+
+    times = np.arange(n_frames) * hop_length / sr
+    return f0, voiced_flag, voiced_prob, times
+
+
+def _yin_batch(frames: np.ndarray, sr: int, win_length: int,
+               min_period: int, max_period: int) -> tuple:
+    """对 (n, frame_length) 的一批帧计算 YIN 基频"""
+    n, frame_length = frames.shape
+    frames = frames.astype(np.float64)
+
+    # 自相关 r(τ) = Σ_{j<W} x[j]·x[j+τ]，τ + W < frame_length，不会发生循环卷绕
+    spectrum = np.fft.rfft(frames, frame_length, axis=1)
+    head = np.fft.rfft(frames[:, :win_length], frame_length, axis=1)
+    acf = np.fft.irfft(np.conj(head) * spectrum, frame_length, axis=1)[:, :max_period + 2]
+
+    # 能量项 e(τ) = Σ_{j<W} x[j+τ]²
+    energy = np.concatenate([np.zeros((n, 1)), np.cumsum(frames ** 2, axis=1)], axis=1)
+    taus = np.arange(max_period + 2)
+    energy_tau = energy[:, taus + win_length] - energy[:, taus]
+
+    # 差分函数与累积均值归一化
+    diff = energy_tau[:, :1] + energy_tau - 2 * acf
+    diff[:, 0] = 0
+    diff = np.maximum(diff, 0)
+    cumulative = np.cumsum(diff[:, 1:], axis=1) / np.arange(1, max_period + 2)
+    cmnd = np.ones_like(diff)
+    cmnd[:, 1:] = diff[:, 1:] / (cumulative + 1e-12)
+
+    # 候选周期：阈值以下的局部极小值，取最短周期
+    lags = np.arange(min_period, max_period + 1)
+    center = cmnd[:, lags]
+    is_min = (center <= cmnd[:, lags - 1]) & (center < cmnd[:, lags + 1])
+    candidates = is_min & (center < FAST_THRESHOLD)
+    has_candidate = candidates.any(axis=1)
+    best = np.where(has_candidate, candidates.argmax(axis=1), center.argmin(axis=1))
+    period = lags[best]
+
+    # 抛物线插值
+    rows = np.arange(n)
+    left, mid, right = cmnd[rows, period - 1], cmnd[rows, period], cmnd[rows, period + 1]
+    denom = left - 2 * mid + right
+    shift = np.where(np.abs(denom) > 1e-12, 0.5 * (left - right) / np.where(denom == 0, 1, denom), 0)
+    shift = np.clip(shift, -1, 1)
+
+    # 静音帧不计为有声
+    rms = np.sqrt(energy[:, win_length] / win_length)
+    voiced = has_candidate & (rms > 1e-3)
+
+    f0 = np.where(voiced, sr / (period + shift), np.nan)
+    prob = np.clip(1 - mid, 0, 1) * voiced
+    return f0, voiced, prob
@@ -0,0 +1,121 @@
+"""
+实时练习反馈 - 对小程序边录边发的 PCM 分块做增量音频分析
+"""
+import logging
+import time
+from collections import deque
+
+import librosa
+import numpy as np
+
+from services.audio_stream import StreamingAudioAnalyzer
+from services.pitch_tracker import frame_sizes
+
+logger = logging.getLogger(__name__)
+
+# 局部速度的滑动窗口（秒）
+TEMPO_WINDOW_SECONDS = 8.0
+
+# 支持的 PCM 格式 -> (numpy dtype, 归一化系数)
+PCM_FORMATS = {
+    "s16le": (np.dtype("<i2"), 1 / 32768),
+    "f32le": (np.dtype("<f4"), 1.0),
+}
+
+
+class PracticeSession:
+    """
+    单个 WebSocket 连接的练习状态
+
+    每个 PCM 分块交给 StreamingAudioAnalyzer（快速音高模式），返回：
+    - 该块有声帧的平均音分偏差（带符号，正为偏高）与主要音名
+    - 最近 TEMPO_WINDOW_SECONDS 秒的局部速度，以及相对目标速度的漂移
+      （未指定目标速度时以到目前为止的全曲平均速度为准）
+    """
+
+    def __init__(self, sr: int, pcm_format: str = "s16le", target_tempo: float = 0.0):
+        if pcm_format not in PCM_FORMATS:
+            raise ValueError(f"不支持的 PCM 格式: {pcm_format}")
+        if not 8000 <= sr <= 48000:
+            raise ValueError(f"不支持的采样率: {sr}")
+        self.sr = sr
+        self.dtype, self.scale = PCM_FORMATS[pcm_format]
+        self.target_tempo = target_tempo
+
+        # 帧移与 pyin 默认的 512 @ 44.1kHz 保持相同时长，与快速 YIN 逐帧对齐
+        n_fft, hop_length = frame_sizes(sr)
+        self.analyzer = StreamingAudioAnalyzer(sr, n_fft=n_fft, hop_length=hop_length,
+                                               pitch_mode="fast")
+        self._onsets = deque()
+        self._pending = b""
+        self.chunks = 0
+        self.slow_chunks = 0
+
+    def feed(self, data: bytes) -> dict:
+        """处理一块 PCM 字节，返回实时反馈"""
+        start = time.perf_counter()
+
+        # 分块可能不在采样边界上，余下的字节留到下一块
+        data = self._pending + data
+        usable = len(data) - len(data) % self.dtype.itemsize
+        self._pending = data[usable:]
+        block = np.frombuffer(data[:usable], dtype=self.dtype).astype(np.float32) * self.scale
+
+        update = self.analyzer.process(block)
+        now = self.analyzer.duration
+        self._onsets.extend(float(t) for t in update["onsets"])
+        while self._onsets and self._onsets[0] < now - TEMPO_WINDOW_SECONDS:
+            self._onsets.popleft()
+
+        latency_ms = (time.perf_counter() - start) * 1000
+        chunk_ms = len(block) / self.sr * 1000
+        self.chunks += 1
+        if latency_ms > chunk_ms:
+            self.slow_chunks += 1
+
+        feedback = {
+            "type": "update",
+            "time": round(now, 2),
+            **self._pitch_feedback(update["f0"], update["voiced"]),
+            **self._tempo_feedback(),
+            "onsets": [round(float(t), 2) for t in update["onsets"]],
+            "latencyMs": round(latency_ms, 1),
+            "chunkMs": round(chunk_ms, 1),
+        }
+        return feedback
+
+    def finish(self) -> dict:
+        """结束练习，返回与批量分析相同格式的总结"""
+        result = self.analyzer.finalize()
+        logger.info(
+            f"实时练习结束: {result['duration']}秒, {self.chunks} 块, "
+            f"超时块 {self.slow_chunks}, 综合 {result['overallScore']} 分"
+        )
+        return {"type": "summary", "data": result}
+
+    def _pitch_feedback(self, f0: np.ndarray, voiced: np.ndarray) -> dict:
+        voiced_f0 = f0[voiced]
+        if len(voiced_f0) == 0:
+            return {"note": None, "frequency": None, "centsOff": None}
+        midi = librosa.hz_to_midi(voiced_f0)
+        cents = (midi - np.round(midi)) * 100
+        frequency = float(np.median(voiced_f0))
+        return {
+            "note": librosa.hz_to_note(frequency),
+            "frequency": round(frequency, 1),
+            "centsOff": round(float(np.mean(cents)), 1),
+        }
+
+    def _tempo_feedback(self) -> dict:
+        local_tempo = 0.0
+        if len(self._onsets) >= 3:
+            interval = float(np.median(np.diff(self._onsets)))
+            local_tempo = 60.0 / interval if interval > 0 else 0.0
+
+        target = self.target_tempo or self.analyzer.tempo
+        drift = (local_tempo / target - 1) if local_tempo and target else None
+        return {
+            "tempo": round(local_tempo, 1) if local_tempo else None,
+            "targetTempo": round(target, 1) if target else None,
+            "tempoDrift": round(drift, 3) if drift is not None else None,
+        }
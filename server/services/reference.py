@@ -0,0 +1,344 @@
+"""
+参考演奏对比 - 离线预处理参考录音为特征索引，请求时与学生演奏做带约束 DTW 对齐
+
+索引目录结构（REFERENCE_DIR/<songId>/）:
+    chroma.npy    (12, T) float16  低帧率色度特征
+    pitch.npy     (T,)    float32  低帧率音高（MIDI，无声为 NaN）
+    onsets.npy    (N,)    float32  音符起始时间（秒）
+    measures.npy  (M+1,)  float32  小节边界时间（秒）
+    meta.json     {"frameRate", "sampleRate", "duration", "beatsPerMeasure"}
+
+离线构建（在 server 目录下）:
+    python -m services.reference build --song-id <songId> --audio <参考录音> [--beats-per-measure 4]
+"""
+import argparse
+import json
+import logging
+import os
+import re
+from functools import lru_cache
+from typing import Optional
+
+import librosa
+import numpy as np
+
+from config import ANALYSIS_SR, REFERENCE_DIR, REFERENCE_BAND_RADIUS
+from services.audio_features import AudioFeatures
+
+logger = logging.getLogger(__name__)
+
+# 对齐特征帧率（约 10 帧/秒）
+FEATURE_RATE = 10.0
+
+# 超过该偏差的小节生成问题提示
+PITCH_ISSUE_CENTS = 30
+TEMPO_ISSUE_RATIO = 0.15
+MAX_MEASURE_ISSUES = 3
+
+_SONG_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+
+def extract_alignment_features(features: AudioFeatures) -> dict:
+    """
+    从共享特征上下文提取低帧率对齐特征
+
+    返回:
+        {"chroma": (12, T), "pitch": (T,), "onsets": (N,), "frameRate": float}
+    """
+    step = max(1, int(round(features.sr / features.hop_length / FEATURE_RATE)))
+    frame_rate = features.sr / features.hop_length / step
+
+    # 色度：按 step 帧分块取均值
+    chroma = librosa.feature.chroma_stft(S=features.power, sr=features.sr)
+    n_blocks = chroma.shape[1] // step
+    chroma = chroma[:, :n_blocks * step].reshape(12, n_blocks, step).mean(axis=2)
+
+    # 音高：有声帧的 MIDI 值按时间落入分块后取均值
+    f0, voiced_flag, _, times = features.pitch
+    pitch = np.full(n_blocks, np.nan, dtype=np.float32)
+    blocks = (times[voiced_flag] * frame_rate).astype(int)
+    keep = blocks < n_blocks
+    if np.any(keep):
+        midi = librosa.hz_to_midi(f0[voiced_flag][keep])
+        sums = np.bincount(blocks[keep], weights=midi, minlength=n_blocks)
+        counts = np.bincount(blocks[keep], minlength=n_blocks)
+        voiced_blocks = counts > 0
+        pitch[voiced_blocks] = sums[voiced_blocks] / counts[voiced_blocks]
+
+    return {
+        "chroma": chroma.astype(np.float32),
+        "pitch": pitch,
+        "onsets": features.onset_times.astype(np.float32),
+        "frameRate": frame_rate,
+    }
+
+
+def build_reference_index(audio_path: str, song_id: str, beats_per_measure: int = 4,
+                          sr: int = ANALYSIS_SR, out_dir: str = REFERENCE_DIR) -> str:
+    """离线预处理参考录音，写入特征索引目录"""
+    _check_song_id(song_id)
+    y, sr = librosa.load(audio_path, sr=sr, mono=True)
+    features = AudioFeatures(y, sr)
+    aligned = extract_alignment_features(features)
+
+    # 小节边界：每 beats_per_measure 拍一个小节
+    _, beat_frames = librosa.beat.beat_track(
+        onset_envelope=features.onset_envelope, sr=sr, hop_length=features.hop_length
+    )
+    beat_times = librosa.frames_to_time(beat_frames, sr=sr, hop_length=features.hop_length)
+    measures = beat_times[::beats_per_measure]
+    if len(measures) == 0 or measures[0] > 0:
+        measures = np.concatenate([[0.0], measures])
+    measures = np.concatenate([measures, [features.duration]])
+
+    song_dir = os.path.join(out_dir, song_id)
+    os.makedirs(song_dir, exist_ok=True)
+    np.save(os.path.join(song_dir, "chroma.npy"), aligned["chroma"].astype(np.float16))
+    np.save(os.path.join(song_dir, "pitch.npy"), aligned["pitch"])
+    np.save(os.path.join(song_dir, "onsets.npy"), aligned["onsets"])
+    np.save(os.path.join(song_dir, "measures.npy"), measures.astype(np.float32))
+    with open(os.path.join(song_dir, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump({
+            "frameRate": aligned["frameRate"],
+            "sampleRate": sr,
+            "duration": round(features.duration, 3),
+            "beatsPerMeasure": beats_per_measure,
+        }, f, ensure_ascii=False, indent=2)
+
+    logger.info(f"参考索引已生成: {song_id}, {len(measures) - 1} 小节, {len(aligned['onsets'])} 个音符")
+    return song_dir
+
+
+@lru_cache(maxsize=32)
+def load_reference(song_id: str) -> Optional[dict]:
+    """以内存映射方式加载参考索引，不存在时返回 None"""
+    if not _SONG_ID_PATTERN.match(song_id):
+        return None
+    song_dir = os.path.join(REFERENCE_DIR, song_id)
+    meta_path = os.path.join(song_dir, "meta.json")
+    if not os.path.exists(meta_path):
+        return None
+
+    with open(meta_path, "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    return {
+        "meta": meta,
+        "chroma": np.load(os.path.join(song_dir, "chroma.npy"), mmap_mode="r"),
+        "pitch": np.load(os.path.join(song_dir, "pitch.npy"), mmap_mode="r"),
+        "onsets": np.load(os.path.join(song_dir, "onsets.npy"), mmap_mode="r"),
+        "measures": np.load(os.path.join(song_dir, "measures.npy"), mmap_mode="r"),
+    }
+
+
+def compare_with_reference(features: AudioFeatures, song_id: str) -> Optional[dict]:
+    """
+    与参考演奏对齐，给出逐小节的音准与节奏偏差
+
+    返回 None 表示该曲目没有参考索引
+    """
+    reference = load_reference(song_id) if song_id else None
+    if reference is None:
+        return None
+
+    student = extract_alignment_features(features)
+    if student["chroma"].shape[1] < 2 or reference["chroma"].shape[1] < 2:
+        return None
+
+    path = _align(student["chroma"], np.asarray(reference["chroma"], dtype=np.float32))
+    student_rate = student["frameRate"]
+    ref_rate = reference["meta"]["frameRate"]
+
+    # 每个参考帧对应的学生帧（取路径上的平均位置）
+    n_ref = reference["chroma"].shape[1]
+    sums = np.bincount(path[:, 1], weights=path[:, 0], minlength=n_ref)
+    counts = np.maximum(np.bincount(path[:, 1], minlength=n_ref), 1)
+    ref_to_student = sums / counts
+
+    # 逐路径点的音高差（音分），双方都有声才计入
+    student_pitch = student["pitch"][path[:, 0]]
+    ref_pitch = np.asarray(reference["pitch"])[path[:, 1]]
+    both_voiced = ~np.isnan(student_pitch) & ~np.isnan(ref_pitch)
+    cents = (student_pitch - ref_pitch) * 100
+
+    # 参考音符起始点映射到学生时间轴，与最近的学生起始点比较
+    ref_onsets = np.asarray(reference["onsets"])
+    ref_onset_frames = np.minimum((ref_onsets * ref_rate).astype(int), n_ref - 1)
+    expected = ref_to_student[ref_onset_frames] / student_rate
+    student_onsets = student["onsets"]
+    if len(student_onsets) > 0:
+        nearest = np.abs(expected[:, None] - student_onsets[None, :]).min(axis=1)
+    else:
+        nearest = np.full(len(expected), np.nan)
+
+    # 全曲速度比（学生时长 / 参考时长）
+    global_ratio = (path[-1, 0] + 1) / student_rate / ((path[-1, 1] + 1) / ref_rate)
+
+    measures = []
+    boundaries = np.asarray(reference["measures"])
+    path_ref_times = path[:, 1] / ref_rate
+    for m in range(len(boundaries) - 1):
+        start, end = boundaries[m], boundaries[m + 1]
+        in_measure = (path_ref_times >= start) & (path_ref_times < end)
+        voiced = in_measure & both_voiced
+        onset_mask = (ref_onsets >= start) & (ref_onsets < end)
+
+        start_frame = min(int(start * ref_rate), n_ref - 1)
+        end_frame = min(int(end * ref_rate), n_ref - 1)
+        student_start = ref_to_student[start_frame] / student_rate
+        student_end = ref_to_student[end_frame] / student_rate
+        ref_duration = end - start
+        tempo_ratio = ((student_end - student_start) / ref_duration / global_ratio
+                       if ref_duration > 0 else 1.0)
+
+        measures.append({
+            "index": m + 1,
+            "start": round(float(student_start), 2),
+            "end": round(float(student_end), 2),
+            "pitchOffset": _round_or_none(np.mean(cents[voiced]) if voiced.any() else None),
+            "pitchDeviation": _round_or_none(np.mean(np.abs(cents[voiced])) if voiced.any() else None),
+            "timingDeviationMs": _round_or_none(
+                np.nanmean(nearest[onset_mask]) * 1000 if onset_mask.any() and len(student_onsets) else None
+            ),
+            "tempoRatio": round(float(tempo_ratio), 2),
+        })
+
+    return {
+        "songId": song_id,
+        "pitchDeviation": _round_or_none(np.mean(np.abs(cents[both_voiced])) if both_voiced.any() else None),
+        "timingDeviationMs": _round_or_none(
+            np.nanmean(nearest) * 1000 if len(nearest) and len(student_onsets) else None
+        ),
+        "tempoRatio": round(float(global_ratio), 2),
+        "measures": measures,
+        "issues": _measure_issues(measures),
+    }
+
+
+def _align(student_chroma: np.ndarray, ref_chroma: np.ndarray) -> np.ndarray:
+    """
+    色度余弦距离上的 Sakoe-Chiba 带约束 DTW，返回按时间正序的 (学生帧, 参考帧) 路径
+
+    只在对角线附近的带内计算距离和累积代价（每个学生帧一段参考帧窗口），
+    耗时与内存为 O(N × 带宽)，不构建完整的 N × M 矩阵；
+    步进与 librosa.sequence.dtw 默认相同（对角、水平、垂直，权重均为 1）
+    """
+    x = student_chroma / (np.linalg.norm(student_chroma, axis=0, keepdims=True) + 1e-8)
+    y = ref_chroma / (np.linalg.norm(ref_chroma, axis=0, keepdims=True) + 1e-8)
+    x, y = x.astype(np.float64), y.astype(np.float64)
+    n, m = x.shape[1], y.shape[1]
+    lo, hi = _band(n, m, REFERENCE_BAND_RADIUS)
+
+    # acc[i, k]：学生帧 i 与参考帧 lo[i] + k 的累积代价，带外为 inf
+    acc = np.full((n, int(np.max(hi - lo)) + 1), np.inf)
+    for i in range(n):
+        cols = np.arange(lo[i], hi[i] + 1)
+        cost = 1.0 - x[:, i] @ y[:, lo[i]:hi[i] + 1]
+        if i == 0:
+            # 路径从 (0, 0) 开始
+            entry = np.full(len(cols), np.inf)
+            entry[0] = 0.0
+        else:
+            # 上一行两侧补 inf，带外的位置都落到 inf 上
+            prev = np.concatenate([[np.inf], acc[i - 1, :hi[i - 1] - lo[i - 1] + 1], [np.inf]])
+            last = len(prev) - 1
+            up = prev[np.clip(cols - lo[i - 1] + 1, 0, last)]
+            diag = prev[np.clip(cols - lo[i - 1], 0, last)]
+            entry = np.minimum(up, diag)
+        # 行内水平步进 D[j] = C[j] + min(entry[j], D[j-1]) 展开为前缀和 + 前缀最小值
+        prefix = np.cumsum(cost)
+        acc[i, :len(cols)] = prefix + np.minimum.accumulate(entry - (prefix - cost))
+
+    return _backtrack(acc, lo, hi)
+
+
+def _band(n: int, m: int, radius: float) -> tuple[np.ndarray, np.ndarray]:
+    """
+    每个学生帧在带内的参考帧范围 [lo, hi]：沿 (0, 0) 到 (n-1, m-1) 的对角线，
+    半径为 radius × min(n, m) 帧；相邻行的窗口相互衔接，保证路径连通
+    """
+    r = max(1, int(radius * min(n, m)))
+    slope = (m - 1) / max(n - 1, 1)
+    rows = np.arange(n)
+    lo = np.maximum(0, np.floor(rows * slope).astype(int) - r)
+    hi = np.minimum(m - 1, np.ceil((rows + 1) * slope).astype(int) + r)
+    return lo, hi
+
+
+def _backtrack(acc: np.ndarray, lo: np.ndarray, hi: np.ndarray) -> np.ndarray:
+    """从 (n-1, m-1) 沿最小累积代价回溯到 (0, 0)，同代价时依次优先对角、水平、垂直"""
+    def at(i: int, j: int) -> float:
+        if i < 0 or j < lo[i] or j > hi[i]:
+            return np.inf
+        return acc[i, j - lo[i]]
+
+    i, j = len(lo) - 1, int(hi[-1])
+    path = [(i, j)]
+    while i > 0 or j > 0:
+        steps = ((i - 1, j - 1), (i, j - 1), (i - 1, j))
+        i, j = min(steps, key=lambda step: at(*step))
+        path.append((i, j))
+    return np.array(path[::-1], dtype=int)
+
+
+def _measure_issues(measures: list[dict]) -> list[dict]:
+    issues = []
+    pitch_bad = sorted(
+        (m for m in measures if m["pitchDeviation"] is not None
+         and abs(m["pitchOffset"]) > PITCH_ISSUE_CENTS),
+        key=lambda m: -abs(m["pitchOffset"]),
+    )
+    for m in pitch_bad[:MAX_MEASURE_ISSUES]:
+        direction = "偏高" if m["pitchOffset"] > 0 else "偏低"
+        issues.append({
+            "severity": "warning",
+            "title": f"第{m['index']}小节音准{direction}",
+            "description": f"与参考演奏相比整体{direction}约 {abs(m['pitchOffset']):.0f} 音分",
+            "suggestion": "对照参考录音慢速练习该小节，注意左手按弦力度",
+            "startTime": m["start"],
+            "endTime": m["end"],
+        })
+
+    tempo_bad = sorted(
+        (m for m in measures if abs(m["tempoRatio"] - 1) > TEMPO_ISSUE_RATIO),
+        key=lambda m: -abs(m["tempoRatio"] - 1),
+    )
+    for m in tempo_bad[:MAX_MEASURE_ISSUES]:
+        direction = "拖慢" if m["tempoRatio"] > 1 else "赶拍"
+        issues.append({
+            "severity": "info",
+            "title": f"第{m['index']}小节{direction}",
+            "description": f"该小节速度与全曲平均相差 {abs(m['tempoRatio'] - 1) * 100:.0f}%",
+            "suggestion": "搭配节拍器练习该小节，保持速度均匀",
+            "startTime": m["start"],
+            "endTime": m["end"],
+        })
+    return issues
+
+
+def _round_or_none(value) -> Optional[float]:
+    if value is None or np.isnan(value):
+        return None
+    return round(float(value), 1)
+
+
+def _check_song_id(song_id: str):
+    if not _SONG_ID_PATTERN.match(song_id):
+        raise ValueError(f"songId 只能包含字母、数字、下划线和连字符: {song_id}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="参考演奏特征索引")
+    sub = parser.add_subparsers(dest="command", required=True)
+    build = sub.add_parser("build", help="预处理参考录音")
+    build.add_argument("--song-id", required=True)
+    build.add_argument("--audio", required=True)
+    build.add_argument("--beats-per-measure", type=int, default=4)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command == "build":
+        print(build_reference_index(args.audio, args.song_id, args.beats_per_measure))
+
+
+if __name__ == "__main__":
+    main()
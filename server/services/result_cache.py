@@ -0,0 +1,171 @@
+"""
+分析结果缓存 - 按上传内容哈希 + 分析参数缓存结果
+
+两级缓存：
+- 内存 LRU（条目数上限）
+- 可选磁盘层（JSON 文件，总大小上限 + TTL 过期）
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+def make_cache_key(content_hash: str, **params) -> str:
+    """内容哈希与分析参数组合成缓存键"""
+    payload = json.dumps({"content": content_hash, **params}, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+
+    def __init__(self, max_entries: int, disk_dir: str = "", disk_max_bytes: int = 0,
+                 ttl: int = 0):
+        self.max_entries = max_entries
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self.ttl = ttl
+
+        self._memory: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+        self._disk_index: dict[str, tuple[float, int]] = {}   # key -> (写入时间, 字节数)
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            self._load_disk_index()
+
+    def get(self, key: str) -> Optional[dict]:
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and not self._expired(entry[0], now):
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._memory[key]
+
+        result = self._disk_get(key, now)
+        with self._lock:
+            if result is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._memory_put(key, result, now)
+        return result
+
+    def put(self, key: str, result: dict):
+        now = time.time()
+        with self._lock:
+            self._memory_put(key, result, now)
+        self._disk_put(key, result, now)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "memoryHits": self.memory_hits,
+                "diskHits": self.disk_hits,
+                "misses": self.misses,
+                "hitRate": round((self.memory_hits + self.disk_hits) / lookups, 3) if lookups else 0.0,
+                "memoryEntries": len(self._memory),
+                "diskEntries": len(self._disk_index),
+                "diskBytes": self._disk_bytes,
+            }
+
+    def _expired(self, stored_at: float, now: float) -> bool:
+        return self.ttl > 0 and now - stored_at > self.ttl
+
+    def _memory_put(self, key: str, result: dict, now: float):
+        if self.max_entries <= 0:
+            return
+        self._memory[key] = (now, result)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.json")
+
+    def _load_disk_index(self):
+        for name in os.listdir(self.disk_dir):
+            if not name.endswith(".json"):
+                continue
+            stat = os.stat(os.path.join(self.disk_dir, name))
+            self._disk_index[name[:-5]] = (stat.st_mtime, stat.st_size)
+            self._disk_bytes += stat.st_size
+        logger.info(f"结果缓存磁盘层: {len(self._disk_index)} 条, {self._disk_bytes} bytes")
+
+    def _disk_get(self, key: str, now: float) -> Optional[dict]:
+        if not self.disk_dir:
+            return None
+        with self._lock:
+            entry = self._disk_index.get(key)
+            if entry is None:
+                return None
+            if self._expired(entry[0], now):
+                self._disk_remove(key)
+                return None
+        try:
+            with open(self._path(key), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"读取结果缓存失败: {e}")
+            with self._lock:
+                self._disk_remove(key)
+            return None
+
+    def _disk_put(self, key: str, result: dict, now: float):
+        if not self.disk_dir or self.disk_max_bytes <= 0:
+            return
+        data = json.dumps(result, ensure_ascii=False).encode("utf-8")
+        if len(data) > self.disk_max_bytes:
+            return
+
+        path = self._path(key)
+        tmp_path = f"{path}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"写入结果缓存失败: {e}")
+            return
+
+        with self._lock:
+            if key in self._disk_index:
+                self._disk_bytes -= self._disk_index[key][1]
+            self._disk_index[key] = (now, len(data))
+            self._disk_bytes += len(data)
+            self._disk_evict(now)
+
+    def _disk_evict(self, now: float):
+        """先淘汰过期条目，再按写入时间从旧到新淘汰直到低于大小上限"""
+        for key in [k for k, (stored_at, _) in self._disk_index.items()
+                    if self._expired(stored_at, now)]:
+            self._disk_remove(key)
+        if self._disk_bytes <= self.disk_max_bytes:
+            return
+        for key, _ in sorted(self._disk_index.items(), key=lambda item: item[1][0]):
+            if self._disk_bytes <= self.disk_max_bytes:
+                break
+            self._disk_remove(key)
+
+    def _disk_remove(self, key: str):
+        _, size = self._disk_index.pop(key)
+        self._disk_bytes -= size
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
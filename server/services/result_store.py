@@ -0,0 +1,394 @@
+"""
+分析结果存储 - SQLite（WAL）保存每次分析的评分、问题列表和紧凑曲线，供历史记录与进步趋势查询
+
+表结构：
+- results：每个任务一行，按 (用户, 时间)、(用户, 曲目, 时间) 建索引；
+  曲线以 encoding.py 的 packed 格式保存；同一用户在同一曲目下重复上传同一文件只记一次
+- user_rollups / song_rollups / daily_rollups：按用户、用户 × 曲目、用户 × 日期的汇总，
+  写入结果时在同一事务中增量更新，查询趋势时不扫描历史记录
+
+kind 区分视频分析（video，综合分含手型）和纯音频分析（audio，综合分只含音准、节奏、力度），
+两者综合分的构成不同，结果与汇总都按 kind 分开
+
+每个汇总对各评分维度保存：有效次数、总和、最好、最差和指数滑动平均（近期水平）；
+未检测到手部时手型分不计入
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+from services.encoding import encode_result
+
+logger = logging.getLogger(__name__)
+
+# 评分维度：(列名前缀, 分析结果中的字段)
+DIMENSIONS = (
+    ("overall", "overallScore"),
+    ("pitch", "pitchAccuracy"),
+    ("rhythm", "rhythmAccuracy"),
+    ("dynamics", "dynamics"),
+    ("hand", "handScore"),
+)
+
+# 按曲目比较强弱项的维度（不含综合分）
+SKILL_DIMENSIONS = ("pitch", "rhythm", "dynamics", "hand")
+
+# 近期水平的指数滑动平均系数（约等于最近 5 次的平均）
+RECENT_ALPHA = 0.3
+
+# 以紧凑格式保存的序列字段
+CURVE_FIELDS = ("pitchCurve", "beatAlignment", "handPoints")
+
+# 分析类型
+KINDS = ("video", "audio")
+
+# 汇总表及其键（不含 user_id、kind）
+ROLLUP_TABLES = (
+    ("user_rollups", ()),
+    ("song_rollups", ("song_id",)),
+    ("daily_rollups", ("day",)),
+)
+
+# 数据库结构版本（PRAGMA user_version）；版本 1 没有 kind 列
+SCHEMA_VERSION = 2
+
+_ROLLUP_COLUMNS = ", ".join(
+    f"{dim}_n INTEGER NOT NULL DEFAULT 0, {dim}_sum REAL NOT NULL DEFAULT 0, "
+    f"{dim}_best REAL, {dim}_worst REAL, {dim}_recent REAL"
+    for dim, _ in DIMENSIONS
+)
+
+_SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS results (
+    task_id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    kind TEXT NOT NULL DEFAULT 'video',
+    song_id TEXT NOT NULL,
+    content_hash TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    duration REAL NOT NULL,
+    overall INTEGER,
+    pitch INTEGER,
+    rhythm INTEGER,
+    dynamics INTEGER,
+    hand INTEGER,
+    issues TEXT NOT NULL,
+    curves TEXT NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS results_user_song_content
+    ON results (user_id, kind, song_id, content_hash);
+CREATE INDEX IF NOT EXISTS results_user_time ON results (user_id, created_at);
+CREATE INDEX IF NOT EXISTS results_user_song_time ON results (user_id, song_id, created_at);
+
+CREATE TABLE IF NOT EXISTS user_rollups (
+    user_id TEXT NOT NULL, kind TEXT NOT NULL,
+    count INTEGER NOT NULL, first_at REAL NOT NULL, last_at REAL NOT NULL,
+    {_ROLLUP_COLUMNS},
+    PRIMARY KEY (user_id, kind)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS song_rollups (
+    user_id TEXT NOT NULL, kind TEXT NOT NULL, song_id TEXT NOT NULL,
+    count INTEGER NOT NULL, first_at REAL NOT NULL, last_at REAL NOT NULL,
+    {_ROLLUP_COLUMNS},
+    PRIMARY KEY (user_id, kind, song_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS daily_rollups (
+    user_id TEXT NOT NULL, kind TEXT NOT NULL, day TEXT NOT NULL,
+    count INTEGER NOT NULL, first_at REAL NOT NULL, last_at REAL NOT NULL,
+    {_ROLLUP_COLUMNS},
+    PRIMARY KEY (user_id, kind, day)
+) WITHOUT ROWID;
+"""
+
+
+def scores_of(result: dict) -> dict:
+    """分析结果中各维度的评分；未检测到手部时手型分为 None"""
+    scores = {dim: result.get(key) for dim, key in DIMENSIONS}
+    if not result.get("handDetected", True):
+        scores["hand"] = None
+    return scores
+
+
+def fold_rollup(row: Optional[sqlite3.Row], scores: dict, created_at: float) -> dict:
+    """把一次评分累加到汇总行上，返回新的列值（row 为 None 表示第一次）"""
+    if row is None:
+        values = {"count": 1, "first_at": created_at, "last_at": created_at}
+    else:
+        values = {
+            "count": row["count"] + 1,
+            "first_at": min(row["first_at"], created_at),
+            "last_at": max(row["last_at"], created_at),
+        }
+    for dim, _ in DIMENSIONS:
+        if row is None:
+            n, total, best, worst, recent = 0, 0.0, None, None, None
+        else:
+            n, total = row[f"{dim}_n"], row[f"{dim}_sum"]
+            best, worst, recent = row[f"{dim}_best"], row[f"{dim}_worst"], row[f"{dim}_recent"]
+        score = scores.get(dim)
+        if score is not None:
+            n += 1
+            total += score
+            best = score if best is None else max(best, score)
+            worst = score if worst is None else min(worst, score)
+            recent = score if recent is None else recent + RECENT_ALPHA * (score - recent)
+        values.update({
+            f"{dim}_n": n, f"{dim}_sum": total,
+            f"{dim}_best": best, f"{dim}_worst": worst, f"{dim}_recent": recent,
+        })
+    return values
+
+
+class ResultStore:
+    """
+    分析结果存储：单个写连接（加锁，写入由服务进程串行执行），
+    读操作使用线程各自的连接，WAL 模式下读写互不阻塞
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._write_lock = threading.Lock()
+        self._local = threading.local()
+        self._writer = self._connect()
+        self._writer.execute("PRAGMA journal_mode=WAL")
+        self._migrate()
+        count = self._writer.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+        logger.info(f"分析结果存储: {path}, {count} 条记录")
+
+    def _migrate(self):
+        """
+        创建或升级表结构。版本 1 升级时：纯音频任务（ID 以 audio_ 开头）标记为 audio，
+        去重索引加入曲目，按新的汇总键从 results 重建汇总表
+        """
+        conn = self._writer
+        if conn.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+            return
+        columns = {row["name"] for row in conn.execute("PRAGMA table_info(results)")}
+        upgrade = bool(columns) and "kind" not in columns
+        if upgrade:
+            with conn:
+                conn.execute("ALTER TABLE results ADD COLUMN kind TEXT NOT NULL DEFAULT 'video'")
+                conn.execute(r"UPDATE results SET kind = 'audio' "
+                             r"WHERE task_id LIKE 'audio\_%' ESCAPE '\'")
+                conn.execute("DROP INDEX IF EXISTS results_user_content")
+                for table, _ in ROLLUP_TABLES:
+                    conn.execute(f"DROP TABLE IF EXISTS {table}")
+        conn.executescript(_SCHEMA)
+        with conn:
+            if upgrade:
+                rows = conn.execute("SELECT * FROM results ORDER BY created_at").fetchall()
+                for row in rows:
+                    scores = {dim: row[dim] for dim, _ in DIMENSIONS}
+                    self._fold_all(conn, row["user_id"], row["kind"], row["song_id"], scores,
+                                   row["created_at"])
+                logger.info(f"分析结果存储已升级到版本 {SCHEMA_VERSION}: {len(rows)} 条记录")
+            conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        conn.row_factory = sqlite3.Row
+        # WAL 下 NORMAL 只在检查点时同步，断电最多丢失最近的少量提交
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _reader(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    def close(self):
+        with self._write_lock:
+            self._writer.close()
+
+    def record(self, task_id: str, user_id: str, song_id: str, content_hash: str,
+               result: dict, created_at: Optional[float] = None, kind: str = "video") -> bool:
+        """
+        保存一次分析结果并增量更新各级汇总（同一事务）
+
+        同一用户在同一曲目下重复上传同一文件（content_hash 相同）时不重复记录，返回 False
+        """
+        if kind not in KINDS:
+            raise ValueError(f"未知的分析类型: {kind}")
+        created_at = created_at or time.time()
+        scores = scores_of(result)
+        curves = encode_result({k: result[k] for k in CURVE_FIELDS if k in result}, "packed")
+
+        with self._write_lock, self._writer as conn:
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO results (task_id, user_id, kind, song_id, content_hash, "
+                "created_at, duration, overall, pitch, rhythm, dynamics, hand, issues, curves) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (task_id, user_id, kind, song_id, content_hash, created_at,
+                 result.get("duration", 0), scores["overall"], scores["pitch"], scores["rhythm"],
+                 scores["dynamics"], scores["hand"],
+                 json.dumps(result.get("issues", []), ensure_ascii=False), json.dumps(curves)),
+            )
+            if cursor.rowcount == 0:
+                return False
+            self._fold_all(conn, user_id, kind, song_id, scores, created_at)
+        return True
+
+    @classmethod
+    def _fold_all(cls, conn: sqlite3.Connection, user_id: str, kind: str, song_id: str,
+                  scores: dict, created_at: float):
+        """把一次评分累加到用户、曲目、日期三级汇总"""
+        keys = {
+            "song_id": song_id,
+            "day": time.strftime("%Y-%m-%d", time.localtime(created_at)),
+        }
+        for table, columns in ROLLUP_TABLES:
+            cls._fold(conn, table, {"user_id": user_id, "kind": kind,
+                                    **{column: keys[column] for column in columns}},
+                      scores, created_at)
+
+    @staticmethod
+    def _fold(conn: sqlite3.Connection, table: str, keys: dict, scores: dict,
+              created_at: float):
+        where = " AND ".join(f"{k} = ?" for k in keys)
+        row = conn.execute(f"SELECT * FROM {table} WHERE {where}", tuple(keys.values())).fetchone()
+        values = {**keys, **fold_rollup(row, scores, created_at)}
+        conn.execute(
+            f"INSERT OR REPLACE INTO {table} ({', '.join(values)}) "
+            f"VALUES ({', '.join('?' * len(values))})",
+            tuple(values.values()),
+        )
+
+    def history(self, user_id: str, song_id: str = "", limit: int = 20,
+                before: Optional[float] = None, kind: str = "") -> list[dict]:
+        """
+        按时间倒序的历史记录（评分与问题列表，不含曲线），before 为上一页最后一条的时间；
+        kind 为空时包含视频和纯音频记录
+        """
+        sql = "SELECT * FROM results WHERE user_id = ?"
+        params: list = [user_id]
+        if kind:
+            sql += " AND kind = ?"
+            params.append(kind)
+        if song_id:
+            sql += " AND song_id = ?"
+            params.append(song_id)
+        if before is not None:
+            sql += " AND created_at < ?"
+            params.append(before)
+        sql += " ORDER BY created_at DESC LIMIT ?"
+        params.append(limit)
+        return [_result_row(row) for row in self._reader().execute(sql, params)]
+
+    def get(self, user_id: str, task_id: str) -> Optional[dict]:
+        """单次分析的完整记录，曲线为 packed 格式"""
+        row = self._reader().execute(
+            "SELECT * FROM results WHERE user_id = ? AND task_id = ?", (user_id, task_id)
+        ).fetchone()
+        if row is None:
+            return None
+        return {**_result_row(row), **json.loads(row["curves"])}
+
+    def progress(self, user_id: str, days: int = 30, kind: str = "video") -> dict:
+        """
+        进步趋势：总体与各曲目的平均 / 最好 / 近期水平，近 7 天与 30 天平均，
+        以及最近 days 天的逐日平均；全部来自 kind 对应的汇总
+        """
+        conn = self._reader()
+        now = time.time()
+        user = conn.execute("SELECT * FROM user_rollups WHERE user_id = ? AND kind = ?",
+                            (user_id, kind)).fetchone()
+        since = _day_before(now, max(days, 30))
+        daily = conn.execute(
+            "SELECT * FROM daily_rollups WHERE user_id = ? AND kind = ? AND day >= ? ORDER BY day",
+            (user_id, kind, since),
+        ).fetchall()
+        songs = conn.execute(
+            "SELECT * FROM song_rollups WHERE user_id = ? AND kind = ? ORDER BY last_at DESC",
+            (user_id, kind),
+        ).fetchall()
+
+        return {
+            "userId": user_id,
+            "kind": kind,
+            "total": _rollup(user) if user else None,
+            "rolling": {
+                "last7Days": _merge_days(daily, _day_before(now, 7)),
+                "last30Days": _merge_days(daily, _day_before(now, 30)),
+            },
+            "daily": [
+                {"date": row["day"], "count": row["count"], "average": _averages(row)}
+                for row in daily if row["day"] >= _day_before(now, days)
+            ],
+            "songs": [{"songId": row["song_id"], **_song_rollup(row)} for row in songs],
+        }
+
+
+def _day_before(now: float, days: int) -> str:
+    """包含今天在内最近 days 天的第一天"""
+    return time.strftime("%Y-%m-%d", time.localtime(now - (days - 1) * 86400))
+
+
+def _result_row(row: sqlite3.Row) -> dict:
+    data = {
+        "taskId": row["task_id"],
+        "kind": row["kind"],
+        "songId": row["song_id"],
+        "createdAt": row["created_at"],
+        "duration": row["duration"],
+        "issues": json.loads(row["issues"]),
+    }
+    for dim, key in DIMENSIONS:
+        data[key] = row[dim]
+    data["handDetected"] = row["hand"] is not None
+    return data
+
+
+def _averages(row) -> dict:
+    return {
+        key: round(row[f"{dim}_sum"] / row[f"{dim}_n"], 1) if row[f"{dim}_n"] else None
+        for dim, key in DIMENSIONS
+    }
+
+
+def _rollup(row: sqlite3.Row) -> dict:
+    return {
+        "count": row["count"],
+        "firstAt": row["first_at"],
+        "lastAt": row["last_at"],
+        "average": _averages(row),
+        "recent": {key: _round(row[f"{dim}_recent"]) for dim, key in DIMENSIONS},
+        "best": {key: row[f"{dim}_best"] for dim, key in DIMENSIONS},
+        "worst": {key: row[f"{dim}_worst"] for dim, key in DIMENSIONS},
+    }
+
+
+def _song_rollup(row: sqlite3.Row) -> dict:
+    """曲目汇总，附平均分最高 / 最低的维度（强项 / 弱项）"""
+    data = _rollup(row)
+    keys = dict(DIMENSIONS)
+    averages = {keys[dim]: data["average"][keys[dim]] for dim in SKILL_DIMENSIONS
+                if data["average"][keys[dim]] is not None}
+    data["strongest"] = max(averages, key=averages.get) if averages else None
+    data["weakest"] = min(averages, key=averages.get) if averages else None
+    return data
+
+
+def _merge_days(rows: list, since: str) -> dict:
+    """合并 since 之后的逐日汇总，返回次数与各维度平均"""
+    merged = {"count": 0}
+    for dim, _ in DIMENSIONS:
+        merged[f"{dim}_n"] = 0
+        merged[f"{dim}_sum"] = 0.0
+    for row in rows:
+        if row["day"] < since:
+            continue
+        merged["count"] += row["count"]
+        for dim, _ in DIMENSIONS:
+            merged[f"{dim}_n"] += row[f"{dim}_n"]
+            merged[f"{dim}_sum"] += row[f"{dim}_sum"]
+    return {"count": merged["count"], "average": _averages(merged)}
+
+
+def _round(value: Optional[float]) -> Optional[float]:
+    return round(value, 1) if value is not None else None
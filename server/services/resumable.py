@@ -0,0 +1,224 @@
+"""
+断点续传上传 - 分块按偏移追加到任务目录，弱网中断后从已收到的位置继续
+
+协议：
+    POST /api/uploads                      {size, songId} → {uploadId, offset: 0, chunkSize}
+    PUT  /api/uploads/{uploadId}?offset=N  请求体为原始字节，offset 必须等于已收到的字节数
+    GET  /api/uploads/{uploadId}           查询已收到的字节数（断线后据此续传）
+    POST /api/uploads/{uploadId}/finalize  收齐后提交分析，参数与 /api/analyze/video 相同
+
+已收到的数据直接写入任务目录的 input.mp4；可边收边解复用的容器
+（WebM、moov 在前的 MP4 / fragmented MP4）在上传过程中即可开始音频分析，
+分析进程通过任务目录中的标记文件得知上传已完成或已放弃
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import shutil
+import time
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Optional
+
+from services.uploads import UploadTooLargeError
+
+logger = logging.getLogger(__name__)
+
+# 任务目录中的标记文件：上传已完成 / 上传已放弃
+UPLOAD_DONE_MARKER = "upload.done"
+UPLOAD_ABORT_MARKER = "upload.abort"
+
+# 定期检查超时上传的最长间隔（秒）
+SWEEP_INTERVAL = 60
+
+# 判断容器能否边收边解复用所需的文件头字节数
+SNIFF_BYTES = 64 * 1024
+
+_EBML_MAGIC = b"\x1a\x45\xdf\xa3"
+
+
+class UploadOffsetError(Exception):
+    """分块偏移与已收到的字节数不一致，offset 为服务端已收到的字节数"""
+
+    def __init__(self, message: str, offset: int):
+        super().__init__(message)
+        self.offset = offset
+
+
+def streamable_container(head: bytes) -> bool:
+    """
+    根据文件头判断容器能否从前缀顺序解复用（不需要回跳到文件末尾）
+
+    - WebM / Matroska：可以
+    - MP4 / MOV：顶层 moov 出现在 mdat 之前（faststart 或 fragmented）时可以
+    """
+    if head.startswith(_EBML_MAGIC):
+        return True
+    pos = 0
+    while pos + 8 <= len(head):
+        size = int.from_bytes(head[pos:pos + 4], "big")
+        box = head[pos + 4:pos + 8]
+        if box == b"moov":
+            return True
+        if box == b"mdat":
+            return False
+        if size == 1:
+            if pos + 16 > len(head):
+                return False
+            size = int.from_bytes(head[pos + 8:pos + 16], "big")
+        if size < 8:
+            return False
+        pos += size
+    return False
+
+
+@dataclass
+class UploadSession:
+    upload_id: str
+    task_dir: str
+    size: int
+    song_id: str = ""
+    user_id: str = ""
+    offset: int = 0
+    streamable: Optional[bool] = None
+    early_task: Any = None          # 上传过程中的音频分析任务（task_queue.Task）
+    updated_at: float = field(default_factory=time.time)
+    _digest: Any = field(default_factory=hashlib.sha256, repr=False)
+    _head: bytes = field(default=b"", repr=False)
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock, repr=False)
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.task_dir, "input.mp4")
+
+    @property
+    def complete(self) -> bool:
+        return self.offset == self.size
+
+    @property
+    def sha256(self) -> str:
+        return self._digest.hexdigest()
+
+    async def append(self, offset: int, chunks: AsyncIterator[bytes]) -> int:
+        """
+        把一个分块追加到文件末尾，返回新的已收到字节数
+
+        连接中途断开时已写入的部分照常计入，客户端按 GET 返回的 offset 续传
+        """
+        async with self.lock:
+            if offset != self.offset:
+                raise UploadOffsetError(f"偏移不一致: 期望 {self.offset}，收到 {offset}", self.offset)
+            try:
+                with open(self.path, "ab") as f:
+                    async for chunk in chunks:
+                        if self.offset + len(chunk) > self.size:
+                            raise UploadTooLargeError(f"超过声明的文件大小 {self.size} 字节")
+                        f.write(chunk)
+                        self._digest.update(chunk)
+                        self.offset += len(chunk)
+                        if self.streamable is None:
+                            self._sniff(chunk)
+            finally:
+                self.updated_at = time.time()
+            return self.offset
+
+    def _sniff(self, chunk: bytes):
+        self._head += chunk[:SNIFF_BYTES - len(self._head)]
+        if len(self._head) >= SNIFF_BYTES or self.complete:
+            self.streamable = streamable_container(self._head)
+            self._head = b""
+
+    def mark(self, marker: str):
+        """写入标记文件，通知读取该上传的分析进程"""
+        with open(os.path.join(self.task_dir, marker), "w"):
+            pass
+
+    def to_dict(self) -> dict:
+        return {
+            "uploadId": self.upload_id,
+            "offset": self.offset,
+            "size": self.size,
+            "complete": self.complete,
+            "earlyAudio": self.early_task is not None,
+        }
+
+
+class UploadRegistry:
+    """
+    进行中的断点续传上传，超过 ttl 秒没有新分块的上传被放弃并清理
+
+    start() 后台定期检查，服务空闲、没有新请求时超时的上传同样会被清理
+    """
+
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+        self._sessions: dict[str, UploadSession] = {}
+        self._sweeper: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self._sweeper = asyncio.create_task(self._sweep_loop())
+
+    async def stop(self):
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            await asyncio.gather(self._sweeper, return_exceptions=True)
+            self._sweeper = None
+
+    def create(self, upload_id: str, task_dir: str, size: int, song_id: str = "",
+               user_id: str = "") -> UploadSession:
+        self._evict_expired()
+        session = UploadSession(upload_id=upload_id, task_dir=task_dir, size=size,
+                                song_id=song_id, user_id=user_id)
+        # 先创建空文件，分块一律以追加方式写入
+        open(session.path, "wb").close()
+        self._sessions[upload_id] = session
+        return session
+
+    def get(self, upload_id: str) -> Optional[UploadSession]:
+        self._evict_expired()
+        return self._sessions.get(upload_id)
+
+    def pop(self, upload_id: str) -> Optional[UploadSession]:
+        """移出登记（任务目录交给分析任务，不再清理）"""
+        return self._sessions.pop(upload_id, None)
+
+    def discard(self, upload_id: str):
+        """放弃上传：通知分析进程停止读取，并删除任务目录"""
+        session = self._sessions.pop(upload_id, None)
+        if session is None:
+            return
+        try:
+            session.mark(UPLOAD_ABORT_MARKER)
+        except OSError:
+            pass
+        if session.early_task is not None and not session.early_task.finished:
+            # 分析进程看到放弃标记后退出，结束后再删除目录
+            asyncio.create_task(_remove_after(session.early_task, session.task_dir))
+        else:
+            shutil.rmtree(session.task_dir, ignore_errors=True)
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(min(SWEEP_INTERVAL, max(1, self.ttl)))
+            try:
+                self._evict_expired()
+            except Exception as e:
+                logger.error(f"清理超时上传失败: {e}")
+
+    def _evict_expired(self):
+        now = time.time()
+        expired = [
+            upload_id for upload_id, session in self._sessions.items()
+            if now - session.updated_at > self.ttl and not session.lock.locked()
+        ]
+        for upload_id in expired:
+            logger.info(f"[{upload_id}] 上传超时未完成，已清理")
+            self.discard(upload_id)
+
+
+async def _remove_after(task, task_dir: str):
+    await task.done.wait()
+    shutil.rmtree(task_dir, ignore_errors=True)
@@ -0,0 +1,343 @@
+"""
+任务队列 - 有界等待队列 + 分析进程池，支持提交后轮询结果
+"""
+import asyncio
+import json
+import logging
+import math
+import multiprocessing
+import time
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, field
+from typing import Any, Callable, Optional
+
+from services.cancel import AnalysisCancelled
+
+logger = logging.getLogger(__name__)
+
+# 分析速率滑动平均的平滑系数
+RATE_SMOOTHING = 0.2
+
+
+class QueueFullError(Exception):
+    """等待队列已满，retry_after 为建议的重试等待秒数"""
+
+    def __init__(self, message: str, retry_after: int = 0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+@dataclass
+class Task:
+    task_id: str
+    status: str = "queued"          # queued / running / done / failed / cancelled
+    result: Optional[dict] = None
+    error: Optional[str] = None
+    callback_url: str = ""
+    weight: float = 1.0             # 任务权重（视频时长，秒）
+    reserve: bool = False           # 运行时占用一个进程，不参与耗时估算
+    created_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    timings: dict = field(default_factory=dict)   # 服务进程内的阶段耗时（上传等）
+    done: asyncio.Event = field(default_factory=asyncio.Event, repr=False)
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("done", "failed", "cancelled")
+
+    @property
+    def queue_seconds(self) -> Optional[float]:
+        """排队等待分析进程的时间"""
+        if self.started_at is None:
+            return None
+        return self.started_at - self.created_at
+
+    def all_timings(self) -> dict:
+        """服务进程与分析进程的阶段耗时合并（秒）"""
+        timings = dict(self.timings)
+        if self.queue_seconds is not None:
+            timings["queue.wait"] = round(self.queue_seconds, 3)
+        if self.result is not None:
+            timings.update(self.result.get("timings", {}))
+        if self.finished_at is not None:
+            timings["total"] = round(self.finished_at - self.created_at + timings.get("upload", 0), 3)
+        return timings
+
+    def to_dict(self, with_timings: bool = False) -> dict:
+        data = {
+            "taskId": self.task_id,
+            "status": self.status,
+            "createdAt": round(self.created_at, 3),
+        }
+        if self.started_at is not None:
+            data["startedAt"] = round(self.started_at, 3)
+        if self.finished_at is not None:
+            data["finishedAt"] = round(self.finished_at, 3)
+        if self.result is not None:
+            data["result"] = {k: v for k, v in self.result.items() if k != "timings"}
+            if with_timings:
+                data["result"]["timings"] = self.all_timings()
+        if self.error is not None:
+            data["error"] = self.error
+        return data
+
+
+class TaskQueue:
+    """
+    有界任务队列
+
+    - 提交时放入 asyncio 等待队列，队列满时抛出 QueueFullError
+    - 任务按权重（视频时长）计入排队总量，超过 max_queued_weight 时同样拒绝；
+      队列为空时总是接受，避免单个超长视频永远无法提交
+    - 与进程数相同的调度协程从队列取任务，交给进程池执行
+    - 已完成任务保留 result_ttl 秒供轮询查询
+    - 排队中的任务可以取消，不再交给分析进程；运行中的任务由调用方通知分析进程停止
+    - 按最近完成任务的“分析耗时 / 权重”（指数滑动平均）估算排队等待时间；
+      reserve=True 的任务（如上传期间等待数据的音频分析）运行时占用一个进程，
+      估算时从可用进程数中扣除，不参与耗时滑动平均
+    """
+
+    def __init__(self, workers: int, queue_size: int, result_ttl: int,
+                 initializer: Optional[Callable[[], None]] = None,
+                 max_queued_weight: float = 0.0, seconds_per_weight: float = 1.0):
+        self.workers = max(1, workers)
+        self.initializer = initializer
+        self.queue_size = max(1, queue_size)
+        self.result_ttl = result_ttl
+        self.max_queued_weight = max_queued_weight
+        self.seconds_per_weight = seconds_per_weight
+        self.queued_weight = 0.0
+        self.running_weight = 0.0
+        self.reserved = 0
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._dispatchers: list[asyncio.Task] = []
+        self._tasks: dict[str, Task] = {}
+
+    async def start(self):
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._pool = self._create_pool()
+        self._dispatchers = [
+            asyncio.create_task(self._dispatch_loop()) for _ in range(self.workers)
+        ]
+        logger.info(f"任务队列启动: {self.workers} 个分析进程, 队列长度 {self.queue_size}")
+
+    async def prestart(self):
+        """立即拉起全部分析进程并执行初始化（加载模型等），不等第一个请求"""
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        await asyncio.gather(*(
+            loop.run_in_executor(self._pool, _noop) for _ in range(self.workers)
+        ))
+        logger.info(f"分析进程已就绪: {self.workers} 个, 耗时 {time.perf_counter() - start:.1f}s")
+
+    async def stop(self):
+        for dispatcher in self._dispatchers:
+            dispatcher.cancel()
+        await asyncio.gather(*self._dispatchers, return_exceptions=True)
+        self._dispatchers = []
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+        logger.info("任务队列已关闭")
+
+    @property
+    def depth(self) -> int:
+        """等待中的任务数"""
+        return self._queue.qsize() if self._queue is not None else 0
+
+    @property
+    def saturated(self) -> bool:
+        """排队数或排队权重已达上限，新任务会被拒绝"""
+        if self.depth >= self.queue_size:
+            return True
+        return self.max_queued_weight > 0 and self.depth > 0 \
+            and self.queued_weight >= self.max_queued_weight
+
+    def estimate_wait(self, weight: float = 0.0) -> float:
+        """
+        估算新任务从提交到完成的时间（秒）
+
+        排队中和运行中（按剩余一半计）的权重由未被占用的进程分摊，再加上任务自身的分析耗时
+        """
+        backlog = self.queued_weight + self.running_weight / 2
+        return (backlog / self.available_workers + weight) * self.seconds_per_weight
+
+    def retry_after(self) -> int:
+        """队列满时建议客户端的重试等待秒数：约为当前排队完成一半所需的时间"""
+        backlog = self.queued_weight + self.running_weight / 2
+        return max(1, math.ceil(backlog / self.available_workers * self.seconds_per_weight / 2))
+
+    @property
+    def available_workers(self) -> int:
+        """未被 reserve 任务占用的进程数（至少按 1 个计）"""
+        return max(1, self.workers - self.reserved)
+
+    @property
+    def running(self) -> int:
+        """正在分析的任务数"""
+        return sum(1 for task in self._tasks.values() if task.status == "running")
+
+    def submit(self, task_id: str, fn: Callable[..., dict], *args: Any,
+               callback_url: str = "", timings: Optional[dict] = None,
+               weight: float = 1.0, reserve: bool = False) -> Task:
+        """提交任务，立即返回任务对象；reserve 见类说明"""
+        if self._queue is None:
+            raise RuntimeError("任务队列未启动")
+
+        self._evict_expired()
+        if self.max_queued_weight > 0 and self.depth > 0 \
+                and self.queued_weight + weight > self.max_queued_weight:
+            raise QueueFullError(
+                f"排队视频总时长超过上限（{self.max_queued_weight:.0f}s）", self.retry_after()
+            )
+
+        task = Task(task_id=task_id, callback_url=callback_url, weight=weight,
+                    timings=timings or {}, reserve=reserve)
+        try:
+            self._queue.put_nowait((task, fn, args))
+        except asyncio.QueueFull:
+            raise QueueFullError(f"分析队列已满（{self.queue_size}）", self.retry_after())
+
+        self.queued_weight += weight
+        self._tasks[task_id] = task
+        logger.info(f"[{task_id}] 已加入队列, 当前排队 {self.depth}, "
+                    f"排队时长 {self.queued_weight:.0f}s")
+        return task
+
+    def add_finished(self, task_id: str, result: dict, callback_url: str = "",
+                     timings: Optional[dict] = None) -> Task:
+        """登记一个无需执行的已完成任务（如命中结果缓存），同样可轮询查询"""
+        now = time.time()
+        task = Task(task_id=task_id, status="done", result=result, callback_url=callback_url,
+                    started_at=now, finished_at=now, timings=timings or {})
+        task.done.set()
+        self._tasks[task_id] = task
+        if task.callback_url:
+            asyncio.create_task(self._notify(task))
+        return task
+
+    def cancel(self, task_id: str) -> bool:
+        """取消排队中的任务，返回是否已取消（任务不存在或已开始运行时返回 False）"""
+        task = self._tasks.get(task_id)
+        if task is None or task.status != "queued":
+            return False
+        task.status = "cancelled"
+        task.error = "任务已取消"
+        task.finished_at = time.time()
+        self.queued_weight -= task.weight
+        task.done.set()
+        logger.info(f"[{task_id}] 已取消排队中的任务")
+        return True
+
+    def get(self, task_id: str) -> Optional[Task]:
+        return self._tasks.get(task_id)
+
+    async def wait(self, task: Task, timeout: float) -> Task:
+        """等待任务完成，超时后返回当前状态（长轮询）"""
+        if not task.finished and timeout > 0:
+            try:
+                await asyncio.wait_for(task.done.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return task
+
+    def _create_pool(self) -> ProcessPoolExecutor:
+        # 使用 spawn 启动分析进程，避免在多线程的服务进程中 fork
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(self.initializer,),
+        )
+
+    async def _dispatch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            task, fn, args = await self._queue.get()
+            if task.status == "cancelled":
+                self._queue.task_done()
+                continue
+            task.status = "running"
+            task.started_at = time.time()
+            self.queued_weight -= task.weight
+            self.running_weight += task.weight
+            self.reserved += task.reserve
+            pool = self._pool
+            try:
+                task.result = await loop.run_in_executor(pool, fn, *args)
+                task.status = "done"
+                self._update_rate(task)
+            except BrokenProcessPool as e:
+                # 分析进程异常退出（如原生库崩溃），重建进程池
+                logger.error(f"[{task.task_id}] 分析进程异常退出，重建进程池: {e}")
+                task.status = "failed"
+                task.error = "分析进程异常退出"
+                if self._pool is pool:
+                    pool.shutdown(wait=False, cancel_futures=True)
+                    self._pool = self._create_pool()
+            except AnalysisCancelled as e:
+                logger.info(f"[{task.task_id}] 分析已停止: {e}")
+                task.status = "cancelled"
+                task.error = str(e)
+            except Exception as e:
+                logger.error(f"[{task.task_id}] 分析失败: {e}")
+                task.status = "failed"
+                task.error = str(e)
+            finally:
+                task.finished_at = time.time()
+                self.running_weight -= task.weight
+                self.reserved -= task.reserve
+                task.done.set()
+                self._queue.task_done()
+
+            if task.callback_url:
+                asyncio.create_task(self._notify(task))
+
+    def _update_rate(self, task: Task):
+        """用刚完成的任务更新“分析耗时 / 权重”的滑动平均"""
+        if task.weight <= 0 or task.reserve:
+            return
+        rate = (time.time() - task.started_at) / task.weight
+        self.seconds_per_weight += RATE_SMOOTHING * (rate - self.seconds_per_weight)
+
+    async def _notify(self, task: Task):
+        """任务完成后回调通知"""
+        body = json.dumps({"success": task.status == "done", "data": task.to_dict()},
+                          ensure_ascii=False).encode("utf-8")
+        request = urllib.request.Request(
+            task.callback_url, data=body, method="POST",
+            headers={"Content-Type": "application/json"},
+        )
+        try:
+            await asyncio.to_thread(_post, request)
+        except Exception as e:
+            logger.warning(f"[{task.task_id}] 回调通知失败: {e}")
+
+    def _evict_expired(self):
+        now = time.time()
+        expired = [
+            task_id for task_id, task in self._tasks.items()
+            if task.finished and now - task.finished_at > self.result_ttl
+        ]
+        for task_id in expired:
+            del self._tasks[task_id]
+
+
+def _init_worker(initializer: Optional[Callable[[], None]]):
+    """分析进程初始化"""
+    logging.basicConfig(level=logging.INFO)
+    if initializer is not None:
+        initializer()
+
+
+def _noop():
+    pass
+
+
+def _post(request: urllib.request.Request):
+    with urllib.request.urlopen(request, timeout=10) as response:
+        response.read()
@@ -0,0 +1,117 @@
+"""
+上传处理 - 分块落盘，避免整段视频读入内存
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import resource
+import time
+import zipfile
+from typing import BinaryIO
+
+from fastapi import UploadFile
+
+logger = logging.getLogger(__name__)
+
+
+class UploadTooLargeError(Exception):
+    """上传文件超过大小上限"""
+
+
+async def save_upload(file: UploadFile, path: str, max_bytes: int, chunk_size: int) -> dict:
+    """
+    按固定大小分块读取上传文件并写入 path，复制和 sha256 在线程中执行，不阻塞事件循环
+
+    超过 max_bytes 时立即中止并抛出 UploadTooLargeError。
+    注意：multipart 上传在进入处理函数前已由 Starlette 整体缓存到临时文件
+    （SpooledTemporaryFile），这里是第二次完整复制；需要避免的客户端使用断点续传接口
+    （PUT 原始字节直接追加到任务目录，见 services/resumable.py）
+
+    返回:
+        {"size": int, "sha256": str, "seconds": float, "throughputMBps": float,
+         "rssGrowthMB": float}
+    """
+    return await asyncio.to_thread(save_stream, file.file, path, max_bytes, chunk_size)
+
+
+async def read_upload(file: UploadFile, max_bytes: int, chunk_size: int) -> tuple[bytes, str]:
+    """
+    把上传文件整个读入内存（用于较小的音频文件），返回 (数据, sha256)
+
+    超过 max_bytes 时立即中止并抛出 UploadTooLargeError
+    """
+    data = bytearray()
+    digest = hashlib.sha256()
+    while True:
+        chunk = await file.read(chunk_size)
+        if not chunk:
+            break
+        if len(data) + len(chunk) > max_bytes:
+            raise UploadTooLargeError(f"文件超过 {max_bytes // (1024 * 1024)}MB 上限")
+        data += chunk
+        digest.update(chunk)
+    return bytes(data), digest.hexdigest()
+
+
+def save_stream(stream: BinaryIO, path: str, max_bytes: int, chunk_size: int) -> dict:
+    """
+    save_upload 的同步版本，用于压缩包成员等普通文件对象，返回值相同
+
+    rssGrowthMB 为复制期间进程常驻内存比开始时增长的峰值（逐块采样），
+    反映本次复制的内存占用；同时进行的其他请求也会计入
+    """
+    start = time.perf_counter()
+    size = 0
+    digest = hashlib.sha256()
+    rss_start = rss_peak = current_rss_mb()
+    with open(path, "wb") as f:
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > max_bytes:
+                raise UploadTooLargeError(f"文件超过 {max_bytes // (1024 * 1024)}MB 上限")
+            f.write(chunk)
+            digest.update(chunk)
+            rss_peak = max(rss_peak, current_rss_mb())
+
+    seconds = time.perf_counter() - start
+    return {
+        "size": size,
+        "sha256": digest.hexdigest(),
+        "seconds": round(seconds, 3),
+        "throughputMBps": round(size / (1024 * 1024) / seconds, 1) if seconds > 0 else 0.0,
+        "rssGrowthMB": round(rss_peak - rss_start, 1),
+    }
+
+
+def archive_videos(archive_path: str, extensions: tuple) -> list[zipfile.ZipInfo]:
+    """列出 zip 压缩包中的视频文件（跳过目录和 macOS 资源文件）"""
+    with zipfile.ZipFile(archive_path) as zf:
+        return [
+            info for info in zf.infolist()
+            if not info.is_dir()
+            and not os.path.basename(info.filename).startswith(".")
+            and "__MACOSX" not in info.filename
+            and info.filename.lower().endswith(extensions)
+        ]
+
+
+def peak_rss_mb() -> float:
+    """当前进程的峰值常驻内存（MB，Linux 下 ru_maxrss 单位为 KB）"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def current_rss_mb() -> float:
+    """当前进程的常驻内存（MB，读取 /proc/self/statm；不支持的平台返回 0）"""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return 0.0
+    return pages * _PAGE_SIZE / (1024 * 1024)
+
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
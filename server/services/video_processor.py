@@ -1,84 +1,648 @@
 """
-视频处理服务 - FFmpeg 提取音频和抽帧
+视频处理服务 - FFmpeg 单次解码，通过管道输出音频 PCM 和视频帧
 """
-import subprocess
+import json
 import os
-import tempfile
+import queue
+import subprocess
+import threading
+import time
 import logging
 
+import numpy as np
+
+from services.cancel import current_cancel
+from services.metrics import bind, record, span
+
 logger = logging.getLogger(__name__)
 
+# 管道读取的分块大小
+PIPE_CHUNK_SIZE = 1 << 20
+
+# 流式音频模式下缓冲的音频块数
+AUDIO_QUEUE_BLOCKS = 4
+
+# 超时检查间隔（秒）
+WATCHDOG_INTERVAL = 1.0
+
+
+class VideoProbeError(RuntimeError):
+    """ffprobe 无法解析视频"""
+
+
+class AudioDecodeError(RuntimeError):
+    """ffmpeg 无法解码音频"""
+
 
-def extract_audio(video_path: str, output_path: str = None) -> str:
-    """从视频中提取音频为 WAV 格式"""
-    if output_path is None:
-        output_path = os.path.splitext(video_path)[0] + ".wav"
+def probe_video(video_path: str) -> dict:
+    """
+    一次 ffprobe 获取时长、画面尺寸（已考虑旋转）以及音视频流信息
 
+    返回:
+        {"duration": float, "width": int, "height": int, "fps": float,
+         "hasAudio": bool, "hasVideo": bool}
+    """
     cmd = [
-        "ffmpeg", "-i", video_path,
-        "-vn",                    # 不要视频
-        "-acodec", "pcm_s16le",   # 16-bit PCM
-        "-ar", "44100",           # 44.1kHz 采样率
-        "-ac", "1",               # 单声道
-        "-y",                     # 覆盖输出
-        output_path
+        "ffprobe",
+        "-v", "error",
+        "-show_entries",
+        "format=duration:stream=codec_type,width,height,avg_frame_rate"
+        ":stream_tags=rotate:stream_side_data=rotation",
+        "-of", "json",
+        video_path
     ]
 
     try:
-        subprocess.run(cmd, capture_output=True, check=True, timeout=60)
-        logger.info(f"音频提取成功: {output_path}")
-        return output_path
-    except subprocess.CalledProcessError as e:
-        logger.error(f"音频提取失败: {e.stderr.decode()}")
-        raise RuntimeError(f"音频提取失败: {e.stderr.decode()}")
+        with span("ffprobe"):
+            result = subprocess.run(cmd, capture_output=True, check=True, timeout=10)
+        probe = json.loads(result.stdout.decode() or "{}")
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired, ValueError) as e:
+        logger.error(f"视频探测失败: {e}")
+        raise VideoProbeError(f"视频探测失败: {e}")
 
+    streams = probe.get("streams", [])
+    video = next((s for s in streams if s.get("codec_type") == "video"), None)
+    audio = next((s for s in streams if s.get("codec_type") == "audio"), None)
 
-def extract_frames(video_path: str, output_dir: str = None, fps: int = 2) -> list[str]:
-    """从视频中按指定帧率抽帧"""
-    if output_dir is None:
-        output_dir = tempfile.mkdtemp(prefix="frames_")
+    try:
+        duration = float(probe.get("format", {}).get("duration", 0.0))
+    except ValueError:
+        duration = 0.0
 
-    os.makedirs(output_dir, exist_ok=True)
-    output_pattern = os.path.join(output_dir, "frame_%04d.jpg")
+    width = height = 0
+    fps = 0.0
+    if video is not None:
+        width, height = int(video.get("width", 0)), int(video.get("height", 0))
+        fps = _frame_rate(video.get("avg_frame_rate", ""))
+        # 手机竖拍视频带旋转信息，解码输出的画面会被自动旋转
+        if abs(_rotation(video)) % 180 == 90:
+            width, height = height, width
 
-    cmd = [
-        "ffmpeg", "-i", video_path,
-        "-vf", f"fps={fps}",     # 每秒抽取帧数
-        "-q:v", "2",             # JPEG 质量
-        "-y",
-        output_pattern
-    ]
+    return {
+        "duration": duration,
+        "width": width,
+        "height": height,
+        "fps": fps,
+        "hasAudio": audio is not None,
+        "hasVideo": video is not None and width > 0 and height > 0,
+    }
+
+
+class VideoDemuxer:
+    """
+    单次 FFmpeg 解码
+
+    同一个 ffmpeg 进程输出两路管道：
+    - 音频：单声道 float32 PCM（pipe:N，由后台线程读入预分配缓冲区）
+    - 视频：按 fps 抽取并缩放后的 RGB 原始帧（stdout，逐帧读取）
+
+    用法:
+        with VideoDemuxer(path, sr=44100, fps=2) as demuxer:
+            frames = list(demuxer.iter_frames())
+            audio = demuxer.read_audio()
+
+    长录音可在 start() 前调用 stream_audio(block_samples)，之后用 iter_audio()
+    按块消费音频，内存只占有限个音频块
+
+    gray=True 输出单通道灰度帧 (height, width)；frame_times 给定时不按 fps 抽帧，
+    只解码这些时间点（秒）的画面；audio=False 不输出音频
+
+    超时只统计解码耗时：预读队列已满、等待下游消费的时间不计入。
+    创建时所在上下文的取消标记（services/cancel.py）由超时检查线程一并检查：
+    已取消时终止 ffmpeg 并在 close() 抛出 AnalysisCancelled；已过截止时间时终止 ffmpeg，
+    已输出的音频和画面照常可用
+    """
+
+    def __init__(self, video_path: str, sr: int = 44100, fps: int = 2,
+                 max_side: int = 640, timeout: float = 120.0, audio: bool = True,
+                 gray: bool = False, frame_times: list = None, info: dict = None):
+        self.video_path = video_path
+        self.sr = sr
+        self.fps = fps
+        self.info = info or probe_video(video_path)
+        self.timeout = timeout
+        self.width, self.height = _scaled_size(self.info["width"], self.info["height"], max_side)
+        self.has_audio = audio and self.info["hasAudio"]
+        self.channels = 1 if gray else 3
+        self.frame_times = frame_times
+
+        self._proc = None
+        self._started_at = 0.0
+        self._audio = None
+        self._audio_thread = None
+        self._stderr = b""
+        self._stderr_thread = None
+        self._watchdog = None
+        self._watchdog_stop = threading.Event()
+        self._timed_out = False
+        self._cancel = current_cancel()
+        self._stopped = False
+        self._closing = False
+        self._frame_thread = None
+        self._audio_blocks = None
+        self._block_samples = 0
+
+        # 背压计时：有生产线程阻塞在满队列上的累计时间
+        self._blocked_lock = threading.Lock()
+        self._blocked_count = 0
+        self._blocked_since = 0.0
+        self._blocked_total = 0.0
+
+    @property
+    def duration(self) -> float:
+        return self.info["duration"]
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.kill()
+        self.close(check=exc_type is None)
+
+    def stream_audio(self, block_samples: int):
+        """切换为流式音频模式，需在 start() 前调用"""
+        if self._proc is not None:
+            raise RuntimeError("流式音频模式需在解码开始前设置")
+        self._block_samples = max(1, block_samples)
+        self._audio_blocks = queue.Queue(maxsize=AUDIO_QUEUE_BLOCKS)
+
+    def start(self):
+        """启动 ffmpeg 进程"""
+        if not self.has_audio and not self.info["hasVideo"]:
+            raise RuntimeError("视频中没有可解码的音频或画面")
+
+        cmd = ["ffmpeg", "-v", "error", "-nostdin", "-i", self.video_path]
+        audio_read = audio_write = None
+        pass_fds = ()
+
+        if self.has_audio:
+            audio_read, audio_write = os.pipe()
+            pass_fds = (audio_write,)
+            cmd += [
+                "-map", "0:a:0",
+                "-ac", "1",                  # 单声道
+                "-ar", str(self.sr),         # 分析采样率
+                "-acodec", "pcm_f32le",      # float32 PCM
+                "-f", "f32le",
+                f"pipe:{audio_write}",
+            ]
+
+        if self.info["hasVideo"]:
+            if self.frame_times is not None:
+                # 只解码指定时间点的帧，不复制填充
+                vf = f"{_select_filter(self.frame_times, self.info['fps'])},scale={self.width}:{self.height}"
+                cmd += ["-map", "0:v:0", "-vf", vf, "-vsync", "vfr"]
+            else:
+                cmd += ["-map", "0:v:0", "-vf", f"fps={self.fps},scale={self.width}:{self.height}"]
+            cmd += [
+                "-pix_fmt", "gray" if self.channels == 1 else "rgb24",
+                "-f", "rawvideo",
+                "pipe:1",
+            ]
+
+        self._started_at = time.perf_counter()
+        self._proc = subprocess.Popen(
+            cmd,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE if self.info["hasVideo"] else subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            pass_fds=pass_fds,
+        )
+
+        self._stderr_thread = threading.Thread(target=self._drain_stderr, daemon=True)
+        self._stderr_thread.start()
+
+        if audio_read is not None:
+            os.close(audio_write)
+            reader = self._stream_audio_pipe if self._audio_blocks is not None else self._read_audio_pipe
+            self._audio_thread = threading.Thread(
+                target=bind(reader), args=(audio_read,), daemon=True
+            )
+            self._audio_thread.start()
+        else:
+            self._audio = np.zeros(0, dtype=np.float32)
+            if self._audio_blocks is not None:
+                self._audio_blocks.put(None)
+
+        self._watchdog = threading.Thread(target=self._watch, daemon=True)
+        self._watchdog.start()
+
+    def iter_frames(self, prefetch: int = 0):
+        """
+        逐帧读取画面，每帧为 (height, width, 3) 的 uint8 RGB 数组（灰度模式为 (height, width)）
+
+        prefetch > 0 时由后台线程预读最多 prefetch 帧，消费较慢时 ffmpeg
+        仍能继续解码，音频管道可以更早读完
+        """
+        if prefetch <= 0:
+            yield from self._read_frames()
+            return
+
+        frames = queue.Queue(maxsize=prefetch)
+        self._frame_thread = threading.Thread(
+            target=bind(self._prefetch_frames), args=(frames,), daemon=True
+        )
+        self._frame_thread.start()
+        while True:
+            frame = frames.get()
+            if frame is None:
+                break
+            yield frame
+
+    def _prefetch_frames(self, frames: queue.Queue):
+        for frame in self._read_frames():
+            if not self._put(frames, frame):
+                return
+        self._put(frames, None)
+
+    def _put(self, items: queue.Queue, item) -> bool:
+        try:
+            items.put_nowait(item)
+            return True
+        except queue.Full:
+            pass
 
+        self._set_blocked(True)
+        try:
+            while not self._closing:
+                try:
+                    items.put(item, timeout=0.5)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+        finally:
+            self._set_blocked(False)
+
+    def _set_blocked(self, blocked: bool):
+        with self._blocked_lock:
+            now = time.monotonic()
+            if blocked:
+                if self._blocked_count == 0:
+                    self._blocked_since = now
+                self._blocked_count += 1
+            else:
+                self._blocked_count -= 1
+                if self._blocked_count == 0:
+                    self._blocked_total += now - self._blocked_since
+
+    def _busy_seconds(self, started: float) -> float:
+        """启动以来扣除背压阻塞后的解码耗时"""
+        with self._blocked_lock:
+            now = time.monotonic()
+            blocked = self._blocked_total
+            if self._blocked_count > 0:
+                blocked += now - self._blocked_since
+        return now - started - blocked
+
+    def _read_frames(self):
+        if self._proc is None or self._proc.stdout is None:
+            return
+
+        frame_bytes = self.width * self.height * self.channels
+        shape = (self.height, self.width) if self.channels == 1 else (self.height, self.width, 3)
+        # 只统计等待 ffmpeg 输出画面的时间，不含下游处理
+        read_seconds = 0.0
+        try:
+            while True:
+                buf = bytearray(frame_bytes)
+                start = time.perf_counter()
+                size = _readinto_full(self._proc.stdout, buf)
+                read_seconds += time.perf_counter() - start
+                if size < frame_bytes:
+                    break
+                yield np.frombuffer(buf, dtype=np.uint8).reshape(shape)
+        finally:
+            record("decode.frames", read_seconds)
+
+    def iter_audio(self):
+        """流式音频模式下逐块返回 float32 PCM（最后一块可能不足 block_samples）"""
+        if self._audio_blocks is None:
+            raise RuntimeError("未启用流式音频模式")
+        while True:
+            block = self._audio_blocks.get()
+            if block is None:
+                break
+            yield block
+        if self._audio is None:
+            raise RuntimeError(f"音频解码失败: {self._stderr.decode(errors='ignore')}")
+
+    def read_audio(self) -> np.ndarray:
+        """等待音频管道读完，返回 float32 单声道 PCM"""
+        if self._audio_blocks is not None:
+            raise RuntimeError("流式音频模式下请使用 iter_audio()")
+        if self._audio_thread is not None:
+            self._audio_thread.join()
+        if self._audio is None:
+            raise RuntimeError(f"音频解码失败: {self._stderr.decode(errors='ignore')}")
+        return self._audio
+
+    def kill(self):
+        if self._proc is not None and self._proc.poll() is None:
+            self._proc.kill()
+
+    def close(self, check: bool = True):
+        """等待 ffmpeg 退出，check=True 时检查退出码"""
+        if self._proc is None:
+            return
+        self._closing = True
+        if self._proc.stdout is not None:
+            # 丢弃未读取的画面，避免 ffmpeg 阻塞在写管道
+            while self._proc.stdout.read(PIPE_CHUNK_SIZE):
+                pass
+            if self._frame_thread is not None:
+                self._frame_thread.join()
+            self._proc.stdout.close()
+        self._proc.wait()
+        record("decode", time.perf_counter() - self._started_at)
+        if self._audio_thread is not None:
+            self._audio_thread.join()
+        self._stderr_thread.join()
+        self._watchdog_stop.set()
+        self._watchdog.join()
+
+        if self._stopped:
+            self._cancel.check()
+            # 截止时间已到：解码被截断，已读取的部分照常使用
+            self._cancel.mark_incomplete("decode")
+            return
+        if not check:
+            return
+        if self._timed_out:
+            raise RuntimeError(f"视频解码超时（{self.timeout}s）")
+        if self._proc.returncode != 0:
+            stderr = self._stderr.decode(errors="ignore")
+            logger.error(f"视频解码失败: {stderr}")
+            raise RuntimeError(f"视频解码失败: {stderr}")
+
+    def _watch(self):
+        started = time.monotonic()
+        while not self._watchdog_stop.wait(WATCHDOG_INTERVAL):
+            if self._busy_seconds(started) > self.timeout:
+                self._timed_out = True
+                self.kill()
+                return
+            if self._cancel.stopped:
+                self._stopped = True
+                self.kill()
+                return
+
+    def _drain_stderr(self):
+        self._stderr = self._proc.stderr.read()
+
+    def _read_audio_pipe(self, fd: int):
+        # 按时长预分配缓冲区，直接 readinto，不产生中间 bytes 对象
+        expected = int((self.duration + 1) * self.sr) * 4
+        buf = bytearray(max(expected, PIPE_CHUNK_SIZE))
+        size = 0
+        with os.fdopen(fd, "rb", buffering=0) as pipe:
+            while True:
+                if size == len(buf):
+                    buf.extend(bytes(len(buf) // 2))
+                with memoryview(buf) as view:
+                    n = pipe.readinto(view[size:size + PIPE_CHUNK_SIZE])
+                if not n:
+                    break
+                size += n
+        del buf[size - size % 4:]
+        self._audio = np.frombuffer(buf, dtype=np.float32)
+        record("decode.audio", time.perf_counter() - self._started_at)
+
+    def _stream_audio_pipe(self, fd: int):
+        block_bytes = self._block_samples * 4
+        try:
+            with os.fdopen(fd, "rb", buffering=0) as pipe:
+                while True:
+                    buf = bytearray(block_bytes)
+                    size = _readinto_full(pipe, buf)
+                    if size < 4:
+                        break
+                    del buf[size - size % 4:]
+                    if not self._put(self._audio_blocks, np.frombuffer(buf, dtype=np.float32)):
+                        # 已在关闭：继续读空管道，避免 ffmpeg 阻塞在写音频
+                        while pipe.read(PIPE_CHUNK_SIZE):
+                            pass
+                        return
+                    if size < block_bytes:
+                        break
+            self._audio = np.zeros(0, dtype=np.float32)
+            record("decode.audio", time.perf_counter() - self._started_at)
+        finally:
+            self._put(self._audio_blocks, None)
+
+
+class PrefixAudioDecoder:
+    """
+    边上传边解码：从仍在写入的文件中读取已收到的部分，经 ffmpeg 标准输入解码音频
+
+    只适用于无需回跳即可解复用的容器（WebM、moov 在前的 MP4）。文件读到末尾时：
+    - done_path 存在：上传已完成，读完剩余字节后结束输入
+    - abort_path 存在、文件已删除，或 stall_timeout 秒没有新数据：终止解码
+
+    用法:
+        with PrefixAudioDecoder(path, 22050, done_path, abort_path) as decoder:
+            for block in decoder.iter_audio(block_samples):
+                ...
+    """
+
+    def __init__(self, path: str, sr: int, done_path: str, abort_path: str,
+                 stall_timeout: float = 600.0, poll_interval: float = 0.2):
+        self.path = path
+        self.sr = sr
+        self.done_path = done_path
+        self.abort_path = abort_path
+        self.stall_timeout = stall_timeout
+        self.poll_interval = poll_interval
+        self.aborted = False
+        self._proc = None
+        self._stderr = b""
+        self._feeder = None
+        self._stderr_thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def start(self):
+        cmd = [
+            "ffmpeg", "-v", "error", "-i", "pipe:0",
+            "-vn", "-ac", "1", "-ar", str(self.sr),
+            "-acodec", "pcm_f32le", "-f", "f32le", "pipe:1",
+        ]
+        self._proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                      stderr=subprocess.PIPE)
+        self._stderr_thread = threading.Thread(target=self._drain_stderr, daemon=True)
+        self._stderr_thread.start()
+        self._feeder = threading.Thread(target=self._feed, daemon=True)
+        self._feeder.start()
+
+    def iter_audio(self, block_samples: int):
+        """逐块返回 float32 PCM（最后一块可能不足 block_samples）"""
+        block_bytes = max(1, block_samples) * 4
+        while True:
+            buf = bytearray(block_bytes)
+            size = _readinto_full(self._proc.stdout, buf)
+            if size >= 4:
+                del buf[size - size % 4:]
+                yield np.frombuffer(buf, dtype=np.float32)
+            if size < block_bytes:
+                break
+        self._proc.wait()
+        if self.aborted:
+            raise RuntimeError("上传已放弃")
+        if self._proc.returncode != 0:
+            self._stderr_thread.join()
+            raise RuntimeError(f"音频解码失败: {self._stderr.decode(errors='ignore')}")
+
+    def close(self):
+        if self._proc is None:
+            return
+        if self._proc.poll() is None:
+            self._proc.kill()
+        self._proc.wait()
+        self._feeder.join()
+        self._stderr_thread.join()
+        self._proc.stdout.close()
+
+    def _feed(self):
+        """把文件中新写入的字节送入 ffmpeg，直到上传完成或放弃"""
+        last_growth = time.monotonic()
+        try:
+            with open(self.path, "rb") as f:
+                while self._proc.poll() is None:
+                    chunk = f.read(PIPE_CHUNK_SIZE)
+                    if chunk:
+                        self._proc.stdin.write(chunk)
+                        last_growth = time.monotonic()
+                        continue
+                    if os.path.exists(self.done_path):
+                        # 标记写入前的数据可能刚刚落盘，再读一次确认已到末尾
+                        chunk = f.read(PIPE_CHUNK_SIZE)
+                        if chunk:
+                            self._proc.stdin.write(chunk)
+                            continue
+                        break
+                    if (os.path.exists(self.abort_path) or not os.path.exists(self.path)
+                            or time.monotonic() - last_growth > self.stall_timeout):
+                        self.aborted = True
+                        self._proc.kill()
+                        break
+                    time.sleep(self.poll_interval)
+        except (BrokenPipeError, OSError) as e:
+            # ffmpeg 已退出（无法解复用等），错误信息由 stderr 给出
+            logger.warning(f"前缀音频输入中止: {e}")
+        finally:
+            try:
+                self._proc.stdin.close()
+            except OSError:
+                pass
+
+    def _drain_stderr(self):
+        self._stderr = self._proc.stderr.read()
+
+
+def decode_audio(data: bytes, sr: int, timeout: float = 60.0) -> np.ndarray:
+    """
+    把内存中的压缩音频（AAC/M4A/MP3/WAV 等）解码为单声道 float32 PCM，不落临时文件
+
+    Linux 上通过 memfd 交给 ffmpeg：输入可回跳，moov 在文件末尾的 M4A 也能解复用；
+    其他平台经标准输入传入
+    """
+    cmd = ["ffmpeg", "-v", "error", "-i", "pipe:0",
+           "-vn", "-ac", "1", "-ar", str(sr), "-acodec", "pcm_f32le", "-f", "f32le", "pipe:1"]
+    memfd = _memfd(data)
+    kwargs = {"input": data}
+    if memfd is not None:
+        cmd[4] = f"/dev/fd/{memfd}"
+        kwargs = {"stdin": subprocess.DEVNULL, "pass_fds": (memfd,)}
     try:
-        subprocess.run(cmd, capture_output=True, check=True, timeout=120)
-    except subprocess.CalledProcessError as e:
-        logger.error(f"抽帧失败: {e.stderr.decode()}")
-        raise RuntimeError(f"抽帧失败: {e.stderr.decode()}")
+        with span("decode.audio"):
+            proc = subprocess.run(cmd, capture_output=True, timeout=timeout, **kwargs)
+    except subprocess.TimeoutExpired:
+        raise AudioDecodeError(f"音频解码超时（{timeout:.0f}s）")
+    finally:
+        if memfd is not None:
+            os.close(memfd)
 
-    # 收集生成的帧文件路径
-    frames = sorted([
-        os.path.join(output_dir, f)
-        for f in os.listdir(output_dir)
-        if f.startswith("frame_") and f.endswith(".jpg")
-    ])
+    if proc.returncode != 0:
+        raise AudioDecodeError(proc.stderr.decode(errors="ignore").strip() or "ffmpeg 解码失败")
+    size = len(proc.stdout) - len(proc.stdout) % 4
+    if size == 0:
+        raise AudioDecodeError("没有音频数据")
+    return np.frombuffer(proc.stdout, dtype=np.float32, count=size // 4)
 
-    logger.info(f"抽帧完成: {len(frames)} 帧")
-    return frames
 
+def _memfd(data: bytes):
+    """把数据写入匿名内存文件，返回文件描述符；平台不支持时返回 None"""
+    if not hasattr(os, "memfd_create"):
+        return None
+    fd = os.memfd_create("guzheng-audio")
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+    except OSError:
+        os.close(fd)
+        raise
+    return fd
+
+
+def _readinto_full(stream, buf: bytearray) -> int:
+    """读满 buf，返回实际读取的字节数（EOF 时可能不足）"""
+    size = 0
+    with memoryview(buf) as view:
+        while size < len(buf):
+            n = stream.readinto(view[size:])
+            if not n:
+                break
+            size += n
+    return size
 
-def get_video_duration(video_path: str) -> float:
-    """获取视频时长（秒）"""
-    cmd = [
-        "ffprobe",
-        "-v", "error",
-        "-show_entries", "format=duration",
-        "-of", "default=noprint_wrappers=1:nokey=1",
-        video_path
-    ]
 
+def _scaled_size(width: int, height: int, max_side: int) -> tuple[int, int]:
+    """按最长边缩放，宽高取偶数"""
+    if width <= 0 or height <= 0:
+        return 0, 0
+    scale = min(1.0, max_side / max(width, height))
+    return max(2, int(width * scale) // 2 * 2), max(2, int(height * scale) // 2 * 2)
+
+
+def _frame_rate(rate: str) -> float:
+    """解析 ffprobe 的 "30000/1001" 形式帧率"""
     try:
-        result = subprocess.run(cmd, capture_output=True, check=True, timeout=10)
-        return float(result.stdout.decode().strip())
-    except (subprocess.CalledProcessError, ValueError) as e:
-        logger.error(f"获取视频时长失败: {e}")
+        num, _, den = rate.partition("/")
+        return float(num) / float(den or 1)
+    except (ValueError, ZeroDivisionError):
         return 0.0
+
+
+def _select_filter(times: list, native_fps: float) -> str:
+    """
+    生成只保留指定时间点的 select 滤镜
+
+    每个时间点取 [t, t + 1/原始帧率) 内的第一帧；调用方保证时间点间隔不小于一帧
+    """
+    if not times:
+        return "select=0"
+    width = 1.0 / native_fps if native_fps > 0 else 1.0 / 30
+    terms = "+".join(f"gte(t,{t:.3f})*lt(t,{t + width:.3f})" for t in times)
+    return f"select='{terms}'"
+
+
+def _rotation(stream: dict) -> int:
+    """读取视频流的旋转角度（旧版 tags.rotate 或新版 side_data rotation）"""
+    try:
+        rotate = stream.get("tags", {}).get("rotate")
+        if rotate is not None:
+            return int(float(rotate))
+        for side_data in stream.get("side_data_list", []):
+            if "rotation" in side_data:
+                return int(float(side_data["rotation"]))
+    except ValueError:
+        pass
+    return 0
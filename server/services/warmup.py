@@ -0,0 +1,136 @@
+"""
+启动预热 - 在后台提前加载重量级依赖并完成 numba JIT 编译，记录冷启动耗时
+
+librosa（连带 numba/scipy/sklearn）和 MediaPipe 的导入都要数秒，librosa 中
+onset/beat/pyin 等 numba 函数首次调用时还要 JIT 编译。服务进程和分析进程
+都不在导入阶段加载它们，而是启动后在后台预热：
+- 服务进程：实时练习用到的 librosa 路径（warm_up_practice）
+- 分析进程：进程池 initializer 中预热 MediaPipe 检测器和音频分析（warm_up_audio）
+"""
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Optional
+
+import numpy as np
+
+from config import ANALYSIS_SR
+
+logger = logging.getLogger(__name__)
+
+# 预热用合成音频的时长（秒），需覆盖节拍检测所需的最少起始点
+WARMUP_SECONDS = 3.0
+WARMUP_TEMPO = 120
+
+
+def warmup_signal(sr: int, seconds: float = WARMUP_SECONDS) -> np.ndarray:
+    """按 WARMUP_TEMPO 重复弹奏的衰减正弦音（A4 / E5 交替），单声道 float32"""
+    y = np.zeros(int(seconds * sr), dtype=np.float32)
+    interval = 60.0 / WARMUP_TEMPO
+    t = np.arange(int(interval * sr)) / sr
+    for i, onset in enumerate(np.arange(0, seconds, interval)):
+        freq = 440.0 if i % 2 == 0 else 659.25
+        tone = (0.5 * np.sin(2 * np.pi * freq * t) * np.exp(-3 * t)).astype(np.float32)
+        start = int(onset * sr)
+        end = min(len(y), start + len(tone))
+        y[start:end] += tone[:end - start]
+    return y
+
+
+def warm_up_audio(sr: int = ANALYSIS_SR) -> float:
+    """导入音频分析模块，并在合成音频上各跑一遍整段 / 流式分析，返回耗时（秒）"""
+    start = time.perf_counter()
+    from services.audio_analyzer import analyze_audio
+    from services.audio_stream import analyze_audio_stream
+
+    y = warmup_signal(sr)
+    analyze_audio(y, sr, with_onsets=True)
+    analyze_audio_stream([y], sr, with_onsets=True)
+    seconds = time.perf_counter() - start
+    logger.info(f"音频分析预热完成, 耗时 {seconds:.1f}s")
+    return seconds
+
+
+def warm_up_practice(sr: int = 44100) -> float:
+    """导入实时练习模块，并用合成 PCM 走一遍逐块反馈路径（快速音高模式），返回耗时（秒）"""
+    start = time.perf_counter()
+    from services.practice import PracticeSession
+
+    pcm = (warmup_signal(sr) * 32767).astype("<i2").tobytes()
+    session = PracticeSession(sr)
+    chunk = len(pcm) // 4
+    for i in range(0, len(pcm), chunk):
+        session.feed(pcm[i:i + chunk])
+    session.finish()
+    seconds = time.perf_counter() - start
+    logger.info(f"实时练习预热完成, 耗时 {seconds:.1f}s")
+    return seconds
+
+
+class Readiness:
+    """
+    服务就绪状态：后台并行执行各预热步骤，全部成功后视为就绪
+
+    started 为进程开始导入服务代码的时刻（time.perf_counter()），
+    冷启动耗时 = 就绪时刻 - started
+    """
+
+    def __init__(self, started: float):
+        self.started = started
+        self.import_seconds = time.perf_counter() - started
+        self.steps: dict[str, dict] = {}
+        self.ready_seconds: Optional[float] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def ready(self) -> bool:
+        return self.ready_seconds is not None
+
+    def start(self, steps: dict[str, Callable[[], Awaitable]]):
+        """在后台并行执行预热步骤（不阻塞启动，/api/health 立即可用）"""
+        self.steps = {name: {"status": "pending"} for name in steps}
+        self._task = asyncio.create_task(self._run(steps))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self, steps: dict[str, Callable[[], Awaitable]]):
+        results = await asyncio.gather(*(
+            self._run_step(name, step) for name, step in steps.items()
+        ))
+        if all(results):
+            self.ready_seconds = time.perf_counter() - self.started
+            logger.info(f"服务就绪, 冷启动耗时 {self.ready_seconds:.1f}s "
+                        f"(导入 {self.import_seconds:.1f}s)")
+
+    async def _run_step(self, name: str, step: Callable[[], Awaitable]) -> bool:
+        self.steps[name]["status"] = "running"
+        start = time.perf_counter()
+        try:
+            await step()
+        except Exception as e:
+            logger.error(f"预热失败: {name}: {e}")
+            self.steps[name].update(status="failed", error=str(e))
+            return False
+        finally:
+            self.steps[name]["seconds"] = round(time.perf_counter() - start, 2)
+        self.steps[name]["status"] = "ready"
+        return True
+
+    def to_dict(self) -> dict:
+        if self.ready:
+            status = "ready"
+        elif any(step["status"] == "failed" for step in self.steps.values()):
+            status = "failed"
+        else:
+            status = "warming"
+        return {
+            "status": status,
+            "importSeconds": round(self.import_seconds, 2),
+            "coldStartSeconds": round(self.ready_seconds, 2) if self.ready else None,
+            "uptimeSeconds": round(time.perf_counter() - self.started, 1),
+            "steps": self.steps,
+        }
@@ -3,6 +3,7 @@
  */
 
 const { wxPromise } = require('../utils/util');
+const { unpackResult } = require('../utils/packed');
 
 /**
  * 录音配置（古筝音频优化参数）
@@ -17,8 +18,9 @@ const RECORD_OPTIONS = {
 
 /**
  * 上传音频文件到服务器进行分析
+ * 服务端直接在内存中解码音频，只做音准、节奏、力度分析（不走视频流程）
  * @param {string} filePath - 音频文件临时路径
- * @param {object} options - 额外参数（曲目ID等）
+ * @param {object} options - 额外参数（songId、duration、userId；compact: false 时不使用紧凑格式）
  * @returns {Promise<object>} 分析结果
  */
 async function analyzeAudio(filePath, options = {}) {
@@ -36,10 +38,15 @@ async function analyzeAudio(filePath, options = {}) {
       formData: {
         songId: options.songId || '',
         duration: options.duration || 0,
+        userId: options.userId || '',
+        encoding: options.compact === false ? 'json' : 'packed',
       },
     });
 
     const result = JSON.parse(uploadRes.data);
+    if (result.success) {
+      result.data = unpackResult(result.data);
+    }
     return result;
   } catch (err) {
     console.error('音频分析失败', err);
@@ -71,8 +78,61 @@ function getAudioInfo(filePath) {
   });
 }
 
+/**
+ * 实时练习录音配置：PCM 分帧回调，每帧约 0.2 秒
+ */
+const LIVE_RECORD_OPTIONS = {
+  duration: 600000,
+  sampleRate: 44100,
+  numberOfChannels: 1,
+  format: 'PCM',
+  frameSize: 17,          // KB，16bit 单声道 44.1kHz 约 0.2 秒
+};
+
+/**
+ * 开始实时练习反馈：边录音边通过 WebSocket 发送 PCM 分帧
+ * @param {object} handlers - { onUpdate(update), onSummary(data), onError(err) }
+ * @param {object} options - { tempo: 目标速度 BPM }
+ * @returns {{ stop: Function }} 调用 stop() 结束录音并获取总结
+ */
+function startLiveFeedback(handlers = {}, options = {}) {
+  const app = getApp();
+  const wsUrl = app.globalData.apiBaseUrl.replace(/^http/, 'ws');
+  const query = `sampleRate=${LIVE_RECORD_OPTIONS.sampleRate}&format=s16le&tempo=${options.tempo || 0}`;
+  const socket = wx.connectSocket({ url: `${wsUrl}/ws/practice?${query}` });
+  const recorder = wx.getRecorderManager();
+
+  socket.onOpen(() => recorder.start(LIVE_RECORD_OPTIONS));
+  socket.onMessage((res) => {
+    const message = JSON.parse(res.data);
+    if (message.type === 'update' && handlers.onUpdate) {
+      handlers.onUpdate(message);
+    } else if (message.type === 'summary' && handlers.onSummary) {
+      handlers.onSummary(message.data);
+    }
+  });
+  socket.onError((err) => handlers.onError && handlers.onError(err));
+
+  recorder.onFrameRecorded(({ frameBuffer }) => {
+    socket.send({ data: frameBuffer });
+  });
+  recorder.onStop(() => {
+    socket.send({ data: JSON.stringify({ type: 'stop' }) });
+  });
+  recorder.onError((err) => {
+    socket.close();
+    if (handlers.onError) handlers.onError(err);
+  });
+
+  return {
+    stop: () => recorder.stop(),
+  };
+}
+
 module.exports = {
   RECORD_OPTIONS,
+  LIVE_RECORD_OPTIONS,
   analyzeAudio,
   getAudioInfo,
+  startLiveFeedback,
 };
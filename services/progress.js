@@ -0,0 +1,53 @@
+/**
+ * 练习记录服务 - 查询服务端保存的历史分析记录与进步趋势
+ */
+
+const { get } = require('./api');
+const { unpackResult } = require('../utils/packed');
+
+/**
+ * 历史分析记录（按时间倒序，不含曲线）
+ * @param {string} userId - 用户标识（与上传分析时的 userId 一致）
+ * @param {object} options - songId 按曲目筛选；kind 'video' / 'audio' 按类型筛选；
+ *   limit 每页条数；before 上一页最后一条的 createdAt
+ * @returns {Promise<object>}
+ */
+function getHistory(userId, options = {}) {
+  const data = { userId, limit: options.limit || 20 };
+  if (options.songId) data.songId = options.songId;
+  if (options.kind) data.kind = options.kind;
+  if (options.before) data.before = options.before;
+  return get('/api/history', data);
+}
+
+/**
+ * 单次分析的完整记录（含音准曲线、节拍点、手部关键点），可直接交给报告页
+ * @param {string} userId
+ * @param {string} taskId
+ * @returns {Promise<object>}
+ */
+async function getHistoryRecord(userId, taskId) {
+  const result = await get(`/api/history/${taskId}`, { userId });
+  if (result.success) {
+    result.data = unpackResult(result.data);
+  }
+  return result;
+}
+
+/**
+ * 进步趋势：总体 / 近 7 天 / 近 30 天平均、逐日平均、各曲目的强项与弱项
+ * 视频分析与录音分析的综合分构成不同，分别统计
+ * @param {string} userId
+ * @param {number} days - 逐日趋势的天数
+ * @param {string} kind - 'video'（视频分析，默认）或 'audio'（录音分析）
+ * @returns {Promise<object>}
+ */
+function getProgress(userId, days = 30, kind = 'video') {
+  return get('/api/progress', { userId, days, kind });
+}
+
+module.exports = {
+  getHistory,
+  getHistoryRecord,
+  getProgress,
+};
@@ -3,11 +3,12 @@
  */
 
 const { wxPromise } = require('../utils/util');
+const { unpackResult } = require('../utils/packed');
 
 /**
  * 上传视频文件到服务器进行手部动作分析
  * @param {string} filePath - 视频文件临时路径
- * @param {object} options - 额外参数
+ * @param {object} options - 额外参数（songId、userId、deadline；compact: false 时不使用紧凑格式）
  * @returns {Promise<object>} 分析结果
  */
 async function analyzeVideo(filePath, options = {}) {
@@ -23,10 +24,100 @@ async function analyzeVideo(filePath, options = {}) {
       name: 'file',
       formData: {
         songId: options.songId || '',
+        // 指定用户时结果写入服务端历史记录
+        userId: options.userId || '',
+        // 分析截止时间（秒）：超时返回已完成的部分，结果中 partial 列出未完成的阶段
+        deadline: options.deadline || 0,
+        // 曲线与关键点以紧凑格式返回，减少移动网络流量
+        encoding: options.compact === false ? 'json' : 'packed',
       },
     });
 
     const result = JSON.parse(uploadRes.data);
+    if (result.success) {
+      result.data = unpackResult(result.data);
+    }
+    return result;
+  } catch (err) {
+    console.error('视频分析失败', err);
+    throw err;
+  }
+}
+
+/**
+ * 断点续传上传视频并分析（弱网下的长视频）
+ * 按服务端建议的分块大小依次上传，断线后查询已收到的字节数继续，
+ * 可边收边解复用的视频在上传过程中即开始音频分析
+ * @param {string} filePath - 视频文件临时路径
+ * @param {object} options - 额外参数（songId、userId、deadline、compact、maxRetries、onProgress）
+ * @returns {Promise<object>} 分析结果
+ */
+async function analyzeVideoResumable(filePath, options = {}) {
+  const app = getApp();
+  const baseUrl = `${app.globalData.apiBaseUrl}/api/uploads`;
+  const fs = wx.getFileSystemManager();
+  const form = { 'content-type': 'application/x-www-form-urlencoded' };
+  const maxRetries = options.maxRetries || 5;
+
+  try {
+    const { size } = await wxPromise(fs.getFileInfo.bind(fs), { filePath });
+    const created = await wxPromise(wx.request, {
+      url: baseUrl,
+      method: 'POST',
+      header: form,
+      data: { size, songId: options.songId || '', userId: options.userId || '' },
+    });
+    if (!created.data.success) return created.data;
+    const { uploadId, chunkSize } = created.data.data;
+    const uploadUrl = `${baseUrl}/${uploadId}`;
+
+    let offset = 0;
+    let retries = 0;
+    while (offset < size) {
+      try {
+        const chunk = await wxPromise(fs.readFile.bind(fs), {
+          filePath,
+          position: offset,
+          length: Math.min(chunkSize, size - offset),
+        });
+        const res = await wxPromise(wx.request, {
+          url: `${uploadUrl}?offset=${offset}`,
+          method: 'PUT',
+          header: { 'content-type': 'application/octet-stream' },
+          data: chunk.data,
+        });
+        if (res.statusCode === 200 || res.statusCode === 409) {
+          // 409：偏移不一致，以服务端已收到的字节数为准
+          offset = res.statusCode === 200 ? res.data.data.offset : res.data.offset;
+          retries = 0;
+          if (options.onProgress) options.onProgress(offset / size);
+          continue;
+        }
+        throw new Error(`上传分块失败: ${res.statusCode}`);
+      } catch (err) {
+        retries += 1;
+        if (retries > maxRetries) throw err;
+        console.warn(`上传中断，第 ${retries} 次重试`, err);
+        // 断线后查询服务端已收到的字节数，从该处继续
+        const status = await wxPromise(wx.request, { url: uploadUrl, method: 'GET' })
+          .catch(() => null);
+        if (status && status.statusCode === 200) offset = status.data.data.offset;
+      }
+    }
+
+    const finalized = await wxPromise(wx.request, {
+      url: `${uploadUrl}/finalize`,
+      method: 'POST',
+      header: form,
+      data: {
+        encoding: options.compact === false ? 'json' : 'packed',
+        deadline: options.deadline || 0,
+      },
+    });
+    const result = finalized.data;
+    if (result.success) {
+      result.data = unpackResult(result.data);
+    }
     return result;
   } catch (err) {
     console.error('视频分析失败', err);
@@ -102,6 +193,7 @@ async function compressVideo(filePath) {
 
 module.exports = {
   analyzeVideo,
+  analyzeVideoResumable,
   analyzeCombined,
   compressVideo,
 };
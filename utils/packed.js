@@ -0,0 +1,86 @@
+/**
+ * 紧凑响应解码 - 还原服务端 encoding=packed 打包的音准曲线、节拍点、手部关键点
+ * 格式说明见 server/services/encoding.py
+ */
+
+const ARRAY_TYPES = {
+  uint8: Uint8Array,
+  int8: Int8Array,
+  uint16: Uint16Array,
+  int16: Int16Array,
+  uint32: Uint32Array,
+};
+
+const NOTE_NAMES = ['C', 'C♯', 'D', 'D♯', 'E', 'F', 'F♯', 'G', 'G♯', 'A', 'A♯', 'B'];
+
+const HAND_LABELS = ['Left', 'Right'];
+
+/**
+ * 解码单个数组 {dtype, scale, data(base64)}，返回数值数组（已除以 scale）
+ * 服务端按小端序写入，小程序运行环境均为小端
+ */
+function unpackArray(packed) {
+  const Type = ARRAY_TYPES[packed.dtype];
+  const buffer = wx.base64ToArrayBuffer(packed.data);
+  const values = new Type(buffer, 0, buffer.byteLength / Type.BYTES_PER_ELEMENT);
+  return Array.from(values, (v) => v / packed.scale);
+}
+
+function midiToNote(midi) {
+  return `${NOTE_NAMES[midi % 12]}${Math.floor(midi / 12) - 1}`;
+}
+
+function unpackPitchCurve(packed) {
+  const time = unpackArray(packed.time);
+  const frequency = unpackArray(packed.frequency);
+  const centsOff = unpackArray(packed.centsOff);
+  const midi = unpackArray(packed.midi);
+  return time.map((t, i) => ({
+    time: t,
+    frequency: frequency[i],
+    note: midiToNote(midi[i]),
+    cents_off: centsOff[i],
+  }));
+}
+
+function unpackHandPoints(packed) {
+  const frameIndex = unpackArray(packed.frameIndex);
+  const hand = unpackArray(packed.hand);
+  const xyz = unpackArray(packed.xyz);
+  const time = packed.time ? unpackArray(packed.time) : null;
+  const n = packed.landmarks;
+  return frameIndex.map((frame, i) => {
+    const landmarks = [];
+    for (let j = 0; j < n; j++) {
+      const k = (i * n + j) * 3;
+      landmarks.push({ x: xyz[k], y: xyz[k + 1], z: xyz[k + 2] });
+    }
+    const sample = { frameIndex: frame, hand: HAND_LABELS[hand[i]] || 'unknown', landmarks };
+    if (time) sample.time = time[i];
+    return sample;
+  });
+}
+
+/**
+ * 把打包的分析结果还原为普通 JSON 格式（未打包的字段原样保留）
+ * @param {object} result - 分析结果
+ * @returns {object}
+ */
+function unpackResult(result) {
+  if (!result) return result;
+  const unpacked = { ...result };
+  if (result.pitchCurve && !Array.isArray(result.pitchCurve)) {
+    unpacked.pitchCurve = unpackPitchCurve(result.pitchCurve);
+  }
+  if (result.beatAlignment && !Array.isArray(result.beatAlignment)) {
+    unpacked.beatAlignment = unpackArray(result.beatAlignment.time).map((t) => ({ time: t }));
+  }
+  if (result.handPoints && !Array.isArray(result.handPoints)) {
+    unpacked.handPoints = unpackHandPoints(result.handPoints);
+  }
+  return unpacked;
+}
+
+module.exports = {
+  unpackResult,
+};